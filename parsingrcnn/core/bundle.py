@@ -0,0 +1,207 @@
+"""Self-contained inference bundles for fast worker start-up.
+
+A bundle is a single file holding the config the model was built with, the
+weights in this codebase's naming (after any Detectron weight mapping) and,
+optionally, a TorchScript trace of the conv body (backbone and FPN). Loading a
+bundle replaces the config merging, the Detectron weight name mapping and the
+random weight initialization done by test_engine.initialize_model_from_cfg;
+with the traced conv body its Python modules are not run either.
+
+The RPN proposal generation and the RoI heads mix tensor ops with numpy
+(rpn_ret blobs, RoI level assignment), so they cannot be traced; they are
+rebuilt from the stored config and weights.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import copy
+import io
+import logging
+
+import torch
+import torch.nn as nn
+
+from parsingrcnn.core.config import assert_and_infer_cfg
+from parsingrcnn.core.config import cfg
+from parsingrcnn.core.config import merge_cfg_from_cfg
+from parsingrcnn.core.quantize import is_quantized
+from parsingrcnn.core.quantize import quantize_model_from_cfg
+from parsingrcnn.modeling import model_builder
+import parsingrcnn.nn as mynn
+
+logger = logging.getLogger(__name__)
+
+_BUNDLE_VERSION = 1
+
+# torch.nn.init functions made no-ops while building a model whose weights are
+# loaded right after
+_INIT_FUNCS = (
+    'uniform_', 'normal_', 'constant_', 'zeros_', 'ones_', 'xavier_uniform_',
+    'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'trunc_normal_'
+)
+
+
+class TracedConvBody(nn.Module):
+    """Stand-in for the Conv_Body module of a model running a TorchScript trace
+    of it. Keeps the attributes read by the rest of the model.
+    """
+
+    def __init__(self, traced, spatial_scale, dim_out, returns_list):
+        super(TracedConvBody, self).__init__()
+        self.traced = traced
+        self.spatial_scale = spatial_scale
+        self.dim_out = dim_out
+        self.returns_list = returns_list
+
+    def forward(self, x):
+        blob_conv = self.traced(x)
+        if self.returns_list:
+            return list(blob_conv)
+        return blob_conv
+
+
+class _ConvBodyTraceWrapper(nn.Module):
+    """Return the FPN blob list as a tuple, which tracing supports."""
+
+    def __init__(self, conv_body):
+        super(_ConvBodyTraceWrapper, self).__init__()
+        self.conv_body = conv_body
+
+    def forward(self, x):
+        blob_conv = self.conv_body(x)
+        if isinstance(blob_conv, list):
+            return tuple(blob_conv)
+        return blob_conv
+
+
+def _check_traced_conv_body(conv_body, traced, inputs, rtol=1e-3, atol=1e-4):
+    """Raise if the trace of a conv body departs from it on any of the inputs,
+    e.g. when a shape-dependent branch was frozen by tracing.
+    """
+    for x in inputs:
+        expected = conv_body(x)
+        actual = traced(x)
+        if not isinstance(expected, tuple):
+            expected, actual = (expected,), (actual,)
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            if e.shape != a.shape or not torch.allclose(e, a, rtol=rtol, atol=atol):
+                raise RuntimeError(
+                    'The traced conv body differs from the model on an input of '
+                    'shape {} (output {:d}); not exporting it'.format(
+                        tuple(x.shape), i)
+                )
+
+
+@contextmanager
+def skip_weight_init():
+    """Make the torch.nn.init functions no-ops (they are also what the
+    parsingrcnn.nn.init fills call), e.g. to build a model whose weights are
+    loaded right after.
+    """
+    saved = {}
+    for name in _INIT_FUNCS:
+        if hasattr(nn.init, name):
+            saved[name] = getattr(nn.init, name)
+            setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        yield
+    finally:
+        for name, func in saved.items():
+            setattr(nn.init, name, func)
+
+
+def export_inference_bundle(model, bundle_file, trace_conv_body=True):
+    """Write the inference bundle of a Generalized_RCNN model, built from (and
+    loaded according to) the global cfg. The conv body is traced on the model's
+    device with an input of the test scale, and checked against the model on a
+    padded non-square input of the test scale and max size.
+    """
+    if isinstance(model, mynn.DataParallel):
+        model = model.module
+    assert isinstance(model, model_builder.Generalized_RCNN), \
+        'Only Generalized_RCNN models can be bundled'
+    assert not is_quantized(model), \
+        'Export the float model; the bundle is quantized on load (cfg.TEST.QUANTIZE)'
+    model.eval()
+    state_dict = model.state_dict()
+
+    conv_body = None
+    if trace_conv_body:
+        stride = max(cfg.FPN.COARSEST_STRIDE, 1) if cfg.FPN.FPN_ON else 32
+        size = -(-cfg.TEST.SCALE // stride) * stride
+        max_size = -(-cfg.TEST.MAX_SIZE // stride) * stride
+        device = next(model.parameters()).device
+        example = torch.zeros(1, 3, size, size, device=device)
+        # Test images are padded to the stride but rarely square
+        check_inputs = [
+            torch.randn(1, 3, size, max_size, device=device),
+            torch.randn(1, 3, max_size, size, device=device),
+        ]
+        with torch.no_grad():
+            returns_list = isinstance(model.Conv_Body(example), list)
+            wrapper = _ConvBodyTraceWrapper(model.Conv_Body)
+            traced = torch.jit.trace(wrapper, example)
+            _check_traced_conv_body(wrapper, traced, check_inputs)
+        buf = io.BytesIO()
+        torch.jit.save(traced, buf)
+        conv_body = dict(
+            traced=buf.getvalue(),
+            spatial_scale=copy.deepcopy(model.Conv_Body.spatial_scale),
+            dim_out=model.Conv_Body.dim_out,
+            returns_list=returns_list
+        )
+        state_dict = dict(
+            (k, v) for k, v in state_dict.items() if not k.startswith('Conv_Body.')
+        )
+
+    bundle = dict(
+        version=_BUNDLE_VERSION,
+        cfg=copy.deepcopy(cfg),
+        state_dict=dict((k, v.cpu()) for k, v in state_dict.items()),
+        conv_body=conv_body
+    )
+    torch.save(bundle, bundle_file)
+    logger.info('Wrote inference bundle to: {} (traced conv body: {})'.format(
+        bundle_file, conv_body is not None))
+
+
+def load_inference_bundle(bundle_file):
+    """Set the global cfg to the config of a bundle and return its model, in
+    evaluation mode and wrapped like test_engine.initialize_model_from_cfg.
+    The model runs on the device it was exported for (cfg.DEVICE). Its RoI
+    heads are quantized on load according to the bundled cfg.TEST.QUANTIZE.
+    """
+    bundle = torch.load(bundle_file, map_location=lambda storage, loc: storage)
+    assert bundle.get('version') == _BUNDLE_VERSION, \
+        'Unsupported inference bundle version: {}'.format(bundle.get('version'))
+    # The bundled cfg is complete: it replaces the global one as is
+    merge_cfg_from_cfg(bundle['cfg'])
+    assert_and_infer_cfg()
+    cuda = cfg.DEVICE == 'cuda'
+
+    with skip_weight_init():
+        model = model_builder.Generalized_RCNN()
+    conv_body = bundle['conv_body']
+    if conv_body is not None:
+        traced = torch.jit.load(
+            io.BytesIO(conv_body['traced']), map_location='cuda' if cuda else 'cpu')
+        model.Conv_Body = TracedConvBody(
+            traced, conv_body['spatial_scale'], conv_body['dim_out'],
+            conv_body['returns_list'])
+    missing, unexpected = model.load_state_dict(bundle['state_dict'], strict=False)
+    assert not unexpected and all(k.startswith('Conv_Body.') for k in missing), \
+        'Inference bundle does not match the model (missing: {}, unexpected: {})'.format(
+            missing, unexpected)
+    model.eval()
+    if cuda:
+        model.cuda()
+
+    model = mynn.DataParallel(
+        model, device_ids=None if cuda else [],
+        cpu_keywords=['im_info', 'roidb'], minibatch=True
+    )
+    return quantize_model_from_cfg(model)
@@ -198,6 +198,104 @@ __C.TEST.SCALE = 600
 # Max pixel size of the longest side of a scaled input image
 __C.TEST.MAX_SIZE = 1000
 
+# Number of images per test minibatch (per GPU). With more than one image the
+# backbone, RPN and every RoI head run once per minibatch instead of once per
+# image. Only supported with in-network proposals and without test-time
+# augmentation; other configurations fall back to one image at a time
+__C.TEST.IMS_PER_BATCH = 1
+
+# Put images with similar aspect ratios in the same test minibatch to reduce
+# padding (only used when TEST.IMS_PER_BATCH > 1)
+__C.TEST.ASPECT_GROUPING = True
+
+# Number of test minibatches decoded and preprocessed ahead of the one running
+# through the network (0 loads every minibatch synchronously)
+__C.TEST.PREFETCH_DEPTH = 2
+
+# Number of background threads used for prefetching test minibatches
+__C.TEST.PREFETCH_WORKERS = 1
+
+# Number of images per chunk file of the on-disk test result store (results
+# are held in memory for at most this many images)
+__C.TEST.RESULTS_CHUNK_SIZE = 50
+
+# Number of images per task handed out to the inference workers in multi-GPU
+# (or multi-process CPU) testing. Idle workers pull the next task from a shared
+# queue, so smaller tasks balance the load better at a small cost per task
+__C.TEST.WORKER_CHUNK_SIZE = 8
+
+# Number of inference worker processes when testing on the CPU (with CUDA
+# there is one worker per GPU)
+__C.TEST.NUM_WORKERS = 1
+
+# ---------------------------------------------------------------------------- #
+# Tiled inference of large images (see parsingrcnn/core/test_tiled.py)
+# ---------------------------------------------------------------------------- #
+__C.TEST.TILING = AttrDict()
+
+# Run images larger than a tile as overlapping tiles at native resolution
+# instead of downscaling them to TEST.SCALE / TEST.MAX_SIZE (one image at a
+# time; needs in-network proposals)
+__C.TEST.TILING.ENABLED = False
+
+# Side of the square tiles, in image pixels (bounds the peak memory)
+__C.TEST.TILING.TILE_SIZE = 1024
+
+# Minimum overlap of neighboring tiles, in pixels. Instances smaller than the
+# overlap are seen whole in at least one tile
+__C.TEST.TILING.OVERLAP = 256
+
+# Also run the whole image at the test scale, for instances larger than a tile
+__C.TEST.TILING.FULL_IMAGE = True
+
+# IoU threshold of the NMS merging the detections of the tiles
+__C.TEST.TILING.NMS = 0.5
+
+# ---------------------------------------------------------------------------- #
+# Video stream inference (see parsingrcnn/core/test_video.py)
+# ---------------------------------------------------------------------------- #
+__C.TEST.VIDEO = AttrDict()
+
+# Run the full detection (RPN, box head and NMS) every KEYFRAME_INTERVAL
+# frames; the frames in between only run the conv body and the RoI heads on
+# the boxes propagated from the last keyframes (1: every frame is a keyframe)
+__C.TEST.VIDEO.KEYFRAME_INTERVAL = 5
+
+# Adapt the keyframe interval to the detection change between consecutive
+# keyframes: halve it (down to MIN_KEYFRAME_INTERVAL) when the change is above
+# CHANGE_THRESH, else grow it by one frame (up to KEYFRAME_INTERVAL)
+__C.TEST.VIDEO.ADAPTIVE = False
+__C.TEST.VIDEO.MIN_KEYFRAME_INTERVAL = 1
+
+# Detection change between two keyframes: fraction of the detections without
+# a match (same class, IoU >= MATCH_IOU) in the other keyframe
+__C.TEST.VIDEO.CHANGE_THRESH = 0.2
+__C.TEST.VIDEO.MATCH_IOU = 0.5
+
+# Move the boxes of the intermediate frames with the per frame velocity of
+# the matched boxes of the last two keyframes (False: keep them in place)
+__C.TEST.VIDEO.PROPAGATE_MOTION = True
+
+# ---------------------------------------------------------------------------- #
+# Per-stage latency recording of test runs (see parsingrcnn/utils/latency.py)
+# ---------------------------------------------------------------------------- #
+__C.TEST.LATENCY = AttrDict()
+
+# Record the latency of every inference stage (decode, preprocess, backbone,
+# RPN, each head, post-processing, result I/O) and write its count, mean and
+# p50 / p90 / p99 to latency_*.json / .csv in the output directory
+__C.TEST.LATENCY.ENABLED = False
+
+# Wait for the CUDA kernels at the end of each stage, so that GPU time is
+# counted in the stage that launched it (slows inference down a little)
+__C.TEST.LATENCY.CUDA_SYNC = True
+
+# Capture a torch.autograd.profiler trace of every PROFILE_EVERY-th test
+# minibatch (0: never), at most PROFILE_LIMIT of them, as chrome traces in
+# the 'profile' subdirectory of the output directory
+__C.TEST.LATENCY.PROFILE_EVERY = 0
+__C.TEST.LATENCY.PROFILE_LIMIT = 10
+
 # Overlap threshold used for non-maximum suppression (suppress boxes with
 # IoU >= this threshold)
 __C.TEST.NMS = 0.3
@@ -471,6 +569,31 @@ __C.TEST.BBOX_VOTE.SCORING_METHOD = 'ID'
 # different methods)
 __C.TEST.BBOX_VOTE.SCORING_METHOD_BETA = 1.0
 
+# ---------------------------------------------------------------------------- #
+# Post-training int8 quantization of the RoI heads (CPU inference only)
+# ---------------------------------------------------------------------------- #
+__C.TEST.QUANTIZE = AttrDict()
+
+# Quantization mode: '' (disabled), 'dynamic' (int8 weights of the nn.Linear
+# layers, e.g. the MLP box heads) or 'static' (int8 conv / linear layers with
+# activation ranges calibrated on a few images, e.g. for the parsing heads).
+# See parsingrcnn/core/quantize.py
+__C.TEST.QUANTIZE.MODE = ''
+
+# Model attributes of the heads to quantize
+__C.TEST.QUANTIZE.HEADS = ('Box_Head', 'Parsing_Head')
+
+# Dataset whose images calibrate static quantization; '' for TRAIN.DATASETS[0].
+# Must not be a test dataset, whose metrics would be biased by the calibration
+__C.TEST.QUANTIZE.CALIBRATION_DATASET = ''
+
+# Number of images of the calibration dataset used to calibrate static
+# quantization
+__C.TEST.QUANTIZE.CALIBRATION_IMAGES = 16
+
+# Quantized kernel backend ('fbgemm' for x86, 'qnnpack' for ARM)
+__C.TEST.QUANTIZE.BACKEND = 'fbgemm'
+
 # ---------------------------------------------------------------------------- #
 # Model options
 # ---------------------------------------------------------------------------- #
@@ -1103,6 +1226,13 @@ __C.PRCNN.EVAL_AP = False
 # Use Finest level ROI for parsing head
 __C.PRCNN.FINEST_LEVEL_ROI = False
 
+# At test time, only run the parsing head on detections scoring at least
+# HEAD_MIN_SCORE (e.g. PRCNN.SCORE, below which parsing2png discards them) and
+# on at most HEAD_MAX_INSTANCES of them per image (0: no limit). The other
+# detections keep an empty parsing
+__C.PRCNN.HEAD_MIN_SCORE = 0.
+__C.PRCNN.HEAD_MAX_INSTANCES = 0
+
 
 # ---------------------------------------------------------------------------- #
 # UV R-CNN options
@@ -1173,6 +1303,12 @@ __C.UVRCNN.GPSM_ON = False
 # Use Finest level ROI for uv head
 __C.UVRCNN.FINEST_LEVEL_ROI = False
 
+# At test time, only run the UV head on detections scoring at least
+# HEAD_MIN_SCORE and on at most HEAD_MAX_INSTANCES of them per image (0: no
+# limit). The other detections keep an all background UV map
+__C.UVRCNN.HEAD_MIN_SCORE = 0.
+__C.UVRCNN.HEAD_MAX_INSTANCES = 0
+
 
 # ---------------------------------------------------------------------------- #
 # R-FCN options
@@ -1405,6 +1541,11 @@ __C.VIS.SHOW_UV.LINES_NUM = 15
 # Number of GPUs to use (applies to both training and testing)
 __C.NUM_GPUS = 1
 
+# Device to run inference on ('cuda' or 'cpu'). With 'cpu' the whole bbox,
+# parsing and uv pipeline runs without a CUDA device, using the pure PyTorch
+# RoIAlign / RoIPool / NMS fallbacks instead of the CUDA extensions
+__C.DEVICE = 'cuda'
+
 # The mapping from image coordinates to feature map coordinates might cause
 # some boxes that are distinct in image space to become identical in feature
 # coordinates. If DEDUP_BOXES > 0, then DEDUP_BOXES is used as the scale factor
@@ -1470,6 +1611,7 @@ __C.CROP_RESIZE_WITH_MAX_POOL = True
 # [Infered value]
 __C.CUDA = False
 
+# Debug mode: e.g. no roidb cache, sanity checks of the FPN RoI level split
 __C.DEBUG = False
 
 # [Infered value]
@@ -0,0 +1,309 @@
+"""Local HTTP inference service with dynamic request batching.
+
+Clients POST an encoded image (JPEG, PNG, ...) to /detect. Requests are queued
+and the batching thread runs them through the network together, up to
+`max_batch_size` images or until the oldest request has waited `max_wait`
+seconds. The response is a JSON document listing the detected instances
+(see encode_detections); instance parsings are box-local label maps stored as
+base64 PNG. GET /health answers {"status": "ok"}.
+
+InferenceClient is a minimal client for the service.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import base64
+import json
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+from six.moves import BaseHTTPServer
+from six.moves import http_client
+from six.moves import queue
+from six.moves import socketserver
+
+from parsingrcnn.core.config import cfg
+from parsingrcnn.core.test import im_detect_all
+from parsingrcnn.core.test import im_detect_all_batch
+from parsingrcnn.core.test_tiled import im_detect_all_tiled
+from parsingrcnn.core.test_engine import batched_inference_supported
+import parsingrcnn.utils.parsing as parsing_utils
+
+logger = logging.getLogger(__name__)
+
+
+class _Request(object):
+    """An image waiting for its results."""
+
+    def __init__(self, im):
+        self.im = im
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class DynamicBatcher(object):
+    """Run the requests submitted from any thread through the model in
+    minibatches, formed from the requests queued when the batching thread gets
+    to them. A minibatch is closed when it holds `max_batch_size` images or
+    `max_wait` seconds after its first request was taken from the queue.
+
+    Configurations not supported by im_detect_all_batch (see
+    test_engine.batched_inference_supported) run one image at a time.
+    """
+
+    def __init__(self, model, max_batch_size=4, max_wait=0.01):
+        self._model = model
+        self.max_batch_size = max(max_batch_size, 1)
+        if self.max_batch_size > 1 and not batched_inference_supported():
+            logger.warning(
+                'Batched inference needs in-network proposals and no test-time '
+                'augmentation; serving one image at a time')
+            self.max_batch_size = 1
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.num_batches = 0
+        self.num_images = 0
+        self.max_batch_seen = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, im):
+        """Return the results of image im, as returned by im_detect_all
+        (blocks until its minibatch has run).
+        """
+        request = _Request(im)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch):
+        ims = [request.im for request in batch]
+        try:
+            if len(ims) > 1:
+                results = im_detect_all_batch(self._model, ims)
+            elif cfg.TEST.TILING.ENABLED:
+                results = [im_detect_all_tiled(self._model, ims[0])]
+            else:
+                results = [im_detect_all(self._model, ims[0])]
+            for request, result in zip(batch, results):
+                request.result = result
+        except Exception as e:
+            logger.exception('Inference failed for a minibatch of %d images', len(ims))
+            for request in batch:
+                request.error = e
+        self.num_batches += 1
+        self.num_images += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        for request in batch:
+            request.done.set()
+
+    def stats(self):
+        """Return the batching counters as a dict."""
+        return dict(
+            num_batches=self.num_batches,
+            num_images=self.num_images,
+            mean_batch_size=self.num_images / max(self.num_batches, 1),
+            max_batch_size=self.max_batch_seen,
+        )
+
+
+def encode_detections(cls_boxes, cls_parsings=None, thresh=0.):
+    """Compact, JSON serializable encoding of the results of an image: a list
+    of instances {'class', 'score', 'box' (x1, y1, x2, y2) and, for the
+    instances with a parsing, 'parsing'}. A parsing is encoded as
+    {'offset': (x_0, y_0), 'size': (im_h, im_w), 'png': base64 PNG of the
+    box-local label map, None for an empty one, e.g. of an instance gated
+    off the parsing head by PRCNN.HEAD_MIN_SCORE} (see
+    parsing_utils.encode_parsing).
+    """
+    instances = []
+    for cls_idx in range(1, len(cls_boxes)):
+        boxes = cls_boxes[cls_idx]
+        if cls_parsings is not None and len(cls_parsings[cls_idx]) == len(boxes):
+            parsings = cls_parsings[cls_idx]
+        else:
+            parsings = [None] * len(boxes)
+        for box, parsing in zip(boxes, parsings):
+            if box[4] < thresh:
+                continue
+            instance = {
+                'class': cls_idx,
+                'score': round(float(box[4]), 4),
+                'box': [round(float(v), 1) for v in box[:4]],
+            }
+            if parsing is not None:
+                instance['parsing'] = _encode_parsing_png(parsing)
+            instances.append(instance)
+    return {'instances': instances}
+
+
+def decode_detections(detections):
+    """Inverse of encode_detections: instance parsings are returned in the
+    parsing_utils.encode_parsing format.
+    """
+    for instance in detections['instances']:
+        if 'parsing' in instance:
+            instance['parsing'] = _decode_parsing_png(instance['parsing'])
+    return detections
+
+
+def _encode_parsing_png(parsing):
+    crop, x_0, y_0 = parsing_utils.parsing_crop(parsing)
+    png = None
+    if crop.size > 0:
+        # cv2 does not encode empty images
+        ok, png = cv2.imencode('.png', crop)
+        assert ok, 'PNG encoding failed'
+        png = base64.b64encode(png.tobytes()).decode('ascii')
+    return {
+        'offset': [x_0, y_0],
+        'size': list(parsing['size']) if isinstance(parsing, dict) else list(crop.shape),
+        'png': png,
+    }
+
+
+def _decode_parsing_png(parsing):
+    if parsing['png'] is None:
+        crop = np.zeros((0, 0), dtype=np.uint8)
+    else:
+        png = np.frombuffer(base64.b64decode(parsing['png']), dtype=np.uint8)
+        crop = cv2.imdecode(png, cv2.IMREAD_UNCHANGED)
+    x_0, y_0 = parsing['offset']
+    im_h, im_w = parsing['size']
+    return parsing_utils.encode_parsing(crop, x_0, y_0, im_h, im_w)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_error(404)
+            return
+        self._send_json({'status': 'ok', 'stats': self.server.batcher.stats()})
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/detect':
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        data = np.frombuffer(self.rfile.read(length), dtype=np.uint8)
+        im = cv2.imdecode(data, cv2.IMREAD_COLOR) if length > 0 else None
+        if im is None:
+            self.send_error(400, 'Could not decode the image')
+            return
+        try:
+            cls_boxes, _, _, cls_parsings, _ = self.server.batcher.submit(im)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self._send_json(
+            encode_detections(cls_boxes, cls_parsings, self.server.thresh))
+
+    def _send_json(self, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class InferenceServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server handing the requests of each connection thread to a
+    DynamicBatcher. Instances scoring below `thresh` are left out of the
+    responses.
+    """
+    daemon_threads = True
+
+    def __init__(self, model, host='127.0.0.1', port=8000,
+                 max_batch_size=4, max_wait=0.01, thresh=0.):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _Handler)
+        self.batcher = DynamicBatcher(model, max_batch_size, max_wait)
+        self.thresh = thresh
+
+    def serve_forever(self, poll_interval=0.5):
+        self.batcher.start()
+        logger.info('Serving on http://{}:{:d} (device: {}, max batch size: {:d}, '
+                    'max wait: {:.3f}s)'.format(
+                        self.server_address[0], self.server_address[1],
+                        cfg.DEVICE, self.batcher.max_batch_size,
+                        self.batcher.max_wait))
+        try:
+            BaseHTTPServer.HTTPServer.serve_forever(self, poll_interval)
+        finally:
+            self.batcher.stop()
+
+
+class InferenceClient(object):
+    """Client of an InferenceServer."""
+
+    def __init__(self, host='127.0.0.1', port=8000, timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def detect(self, im):
+        """Return the decoded detections (see decode_detections) of an image,
+        given as a BGR array or as encoded image bytes.
+        """
+        if isinstance(im, np.ndarray):
+            ok, im = cv2.imencode('.png', im)
+            assert ok, 'PNG encoding failed'
+            im = im.tobytes()
+        return decode_detections(self._request('POST', '/detect', im))
+
+    def health(self):
+        return self._request('GET', '/health')
+
+    def _request(self, method, path, body=None):
+        conn = http_client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            headers = {'Content-Type': 'application/octet-stream'} if body else {}
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+            if response.status != 200:
+                raise RuntimeError('{} {} failed ({:d}): {}'.format(
+                    method, path, response.status, data.decode('utf-8', 'replace')))
+            return json.loads(data.decode('utf-8'))
+        finally:
+            conn.close()
@@ -0,0 +1,225 @@
+"""Post-training int8 quantization of the RoI heads for CPU inference.
+
+cfg.TEST.QUANTIZE.MODE selects the mode:
+
+  - 'dynamic': the nn.Linear layers of the heads (e.g. fc6 / fc7 of the MLP box
+    heads) get int8 weights; their activations are quantized on the fly.
+  - 'static': the nn.Conv2d / nn.Linear layers of the heads (e.g. the ASPP
+    branches and the convs after ASPP of roi_parsing_head_gce_convXl) run in
+    int8 with activation ranges observed on a few calibration images. Each
+    run of consecutive conv / linear / ReLU / pooling modules of an
+    nn.Sequential becomes one int8 block, with its Conv-ReLU pairs fused. Ops
+    outside such blocks (the RoI transform, the SpaceNonLocal attention
+    matmuls and softmax, functional ReLUs) stay in float.
+
+Only the heads named in cfg.TEST.QUANTIZE.HEADS are quantized. The quantized
+kernels only exist for the CPU. Use tools/check_quantization.py to measure the
+accuracy lost on a dataset.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+
+import cv2
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+from parsingrcnn.core.config import cfg
+from parsingrcnn.core.test import im_detect_all
+from parsingrcnn.datasets.json_dataset import JsonDataset
+import parsingrcnn.nn as mynn
+from parsingrcnn.utils.timer import Timer
+
+logger = logging.getLogger(__name__)
+
+# Modules that may be part of a statically quantized block. Pooling, nearest
+# upsampling and ReLU work on quantized tensors as they are
+_QUANTIZABLE_LAYERS = (nn.Conv2d, nn.Linear)
+_QUANTIZABLE_PASSTHROUGH = (nn.ReLU, nn.AvgPool2d, nn.MaxPool2d, nn.Upsample)
+
+
+class QuantizedBlock(nn.Module):
+    """Run a float module in int8: quantize its input, run the module (to be
+    converted by torch.quantization) and dequantize its output.
+    """
+
+    def __init__(self, module):
+        super(QuantizedBlock, self).__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.module = module
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.module(self.quant(x)))
+
+
+def quantize_model_from_cfg(model):
+    """Quantize the RoI heads of a model according to cfg.TEST.QUANTIZE (no-op
+    when it is disabled). `model` is the DataParallel-wrapped Generalized_RCNN
+    returned by test_engine.initialize_model_from_cfg, with its weights loaded.
+    """
+    mode = cfg.TEST.QUANTIZE.MODE
+    if not mode:
+        return model
+    assert mode in ('dynamic', 'static'), \
+        'Unknown quantization mode: {}'.format(mode)
+    assert cfg.DEVICE == 'cpu', 'Quantized inference is only supported on the CPU'
+    torch.backends.quantized.engine = cfg.TEST.QUANTIZE.BACKEND
+
+    net = model.module if isinstance(model, mynn.DataParallel) else model
+    heads = get_quantized_heads(net)
+    if mode == 'dynamic':
+        for name, head in heads:
+            num_layers = len([m for m in head.modules() if isinstance(m, nn.Linear)])
+            if num_layers == 0:
+                logger.warning(
+                    '{} has no nn.Linear layers for dynamic quantization; use '
+                    'TEST.QUANTIZE.MODE static for conv heads'.format(name))
+                continue
+            torch.quantization.quantize_dynamic(
+                head, {nn.Linear}, dtype=torch.qint8, inplace=True)
+            logger.info('Dynamically quantized {:d} layers of {}'.format(num_layers, name))
+    else:
+        qconfig = torch.quantization.get_default_qconfig(cfg.TEST.QUANTIZE.BACKEND)
+        for name, head in heads:
+            num_blocks = _add_quantized_blocks(head, qconfig)
+            torch.quantization.prepare(head, inplace=True)
+            logger.info('Prepared {:d} int8 blocks in {}'.format(num_blocks, name))
+        calibrate(model, get_calibration_images())
+        for _, head in heads:
+            torch.quantization.convert(head, inplace=True)
+    return model
+
+
+def is_quantized(model):
+    """Whether any module of the model has been quantized."""
+    return any(
+        isinstance(m, QuantizedBlock) or '.quantized' in type(m).__module__
+        for m in model.modules()
+    )
+
+
+def get_quantized_heads(net):
+    """Return the (name, module) pairs of the heads of cfg.TEST.QUANTIZE.HEADS
+    that the model has.
+    """
+    heads = []
+    for name in cfg.TEST.QUANTIZE.HEADS:
+        head = getattr(net, name, None)
+        if head is None:
+            logger.warning('The model has no {} to quantize'.format(name))
+            continue
+        heads.append((name, head))
+    return heads
+
+
+def get_calibration_images():
+    """Return cfg.TEST.QUANTIZE.CALIBRATION_IMAGES images spread evenly over
+    the calibration dataset (cfg.TEST.QUANTIZE.CALIBRATION_DATASET, by default
+    the first train dataset).
+    """
+    dataset_name = cfg.TEST.QUANTIZE.CALIBRATION_DATASET
+    if not dataset_name:
+        assert len(cfg.TRAIN.DATASETS) > 0, \
+            'Static quantization calibrates on cfg.TRAIN.DATASETS[0] unless ' \
+            'cfg.TEST.QUANTIZE.CALIBRATION_DATASET is given; none is given'
+        dataset_name = cfg.TRAIN.DATASETS[0]
+    assert dataset_name not in cfg.TEST.DATASETS, \
+        'Calibrating static quantization on the test dataset {} would bias ' \
+        'its metrics'.format(dataset_name)
+    roidb = JsonDataset(dataset_name).get_roidb()
+    num_images = min(cfg.TEST.QUANTIZE.CALIBRATION_IMAGES, len(roidb))
+    inds = np.linspace(0, len(roidb) - 1, num_images).astype(np.int64)
+    return [cv2.imread(roidb[i]['image']) for i in np.unique(inds)]
+
+
+def calibrate(model, ims):
+    """Record the activation ranges of the prepared heads by running the
+    images through the normal inference path.
+    """
+    timer = Timer()
+    timer.tic()
+    for im in ims:
+        im_detect_all(model, im)
+    timer.toc()
+    logger.info('Calibrated quantization on {:d} images in {:.3f}s'.format(
+        len(ims), timer.total_time))
+
+
+def _add_quantized_blocks(module, qconfig):
+    """Wrap the quantizable parts of `module` in QuantizedBlocks (in place) and
+    return how many were added. Only the blocks get a qconfig, so everything
+    else stays in float.
+    """
+    num_blocks = 0
+    for name, child in list(module.named_children()):
+        if isinstance(child, QuantizedBlock):
+            continue
+        if isinstance(child, nn.Sequential):
+            new_child, num_new = _quantize_sequential(child, qconfig)
+            setattr(module, name, new_child)
+            num_blocks += num_new
+        elif isinstance(child, _QUANTIZABLE_LAYERS):
+            block = QuantizedBlock(child)
+            block.qconfig = qconfig
+            setattr(module, name, block)
+            num_blocks += 1
+        else:
+            num_blocks += _add_quantized_blocks(child, qconfig)
+    return num_blocks
+
+
+def _quantize_sequential(seq, qconfig):
+    """Return a copy of an nn.Sequential in which each run of quantizable
+    modules holding at least one conv / linear layer is one QuantizedBlock,
+    and the number of blocks.
+    """
+    modules = []
+    run = []
+    num_blocks = 0
+
+    def flush():
+        if any(isinstance(m, _QUANTIZABLE_LAYERS) for m in run):
+            modules.append(_make_fused_block(run, qconfig))
+            num_new = 1
+        else:
+            modules.extend(run)
+            num_new = 0
+        del run[:]
+        return num_new
+
+    for child in seq:
+        if isinstance(child, _QUANTIZABLE_LAYERS + _QUANTIZABLE_PASSTHROUGH):
+            if isinstance(child, nn.Upsample) and child.mode != 'nearest':
+                num_blocks += flush()
+                modules.append(child)
+            else:
+                run.append(child)
+        else:
+            num_blocks += flush()
+            num_blocks += _add_quantized_blocks(child, qconfig)
+            modules.append(child)
+    num_blocks += flush()
+    return nn.Sequential(*modules), num_blocks
+
+
+def _make_fused_block(run, qconfig):
+    """QuantizedBlock of a run of modules, with each conv / linear layer fused
+    with the ReLU following it.
+    """
+    seq = nn.Sequential(*run)
+    fuse = [
+        [str(i), str(i + 1)] for i in range(len(run) - 1)
+        if isinstance(run[i], _QUANTIZABLE_LAYERS) and isinstance(run[i + 1], nn.ReLU)
+    ]
+    if fuse:
+        seq = torch.quantization.fuse_modules(seq, fuse)
+    block = QuantizedBlock(seq)
+    block.qconfig = qconfig
+    return block
@@ -30,26 +30,31 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from collections import Counter
 from collections import defaultdict
 import cv2
 import numpy as np
+import os
 import pycocotools.mask as mask_util
+from scipy.io import loadmat
 
 from torch.autograd import Variable
 import torch
+import torch.nn.functional as F
 
 from parsingrcnn.core.config import cfg
 from parsingrcnn.utils.timer import Timer
 import parsingrcnn.utils.boxes as box_utils
 import parsingrcnn.utils.blob as blob_utils
 import parsingrcnn.utils.fpn as fpn_utils
-import parsingrcnn.utils.image as image_util
+import parsingrcnn.utils.image as image_utils
 import parsingrcnn.utils.keypoints as keypoint_utils
 import parsingrcnn.utils.parsing as parsing_utils
+import parsingrcnn.utils.segms as segm_utils
 import parsingrcnn.core.test_retinanet as test_retinanet
 
 
-def im_detect_all(model, im, box_proposals=None, timers=None):
+def im_detect_all(model, im, box_proposals=None, timers=None, im_blob=None):
     """Process the outputs of model for testing
     Args:
       model: the network module
@@ -59,6 +64,8 @@ def im_detect_all(model, im, box_proposals=None, timers=None):
       num_boxes: Pytorch variable. Input batch to the model.
       args: arguments from command line.
       timer: record the cost of time for different steps
+      im_blob: optional (blob, im_scale, im_info) of the image at the test
+        scale, as returned by blob_utils.get_image_blob (e.g. prefetched)
     The rest of inputs are of type pytorch Variables and either input to or output from the model.
     """
     if timers is None:
@@ -68,13 +75,17 @@ def im_detect_all(model, im, box_proposals=None, timers=None):
         cls_boxes = test_retinanet.im_detect_bbox(model, im, timers)
         return cls_boxes, None, None, None
     
+    # Conv body features of the transformed images, shared by the bbox and
+    # the head test-time augmentations
+    conv_cache = ConvBodyCache(model, im, get_heads_aug_transforms())
+
     timers['im_detect_bbox'].tic()
     if cfg.TEST.BBOX_AUG.ENABLED:
         scores, boxes, im_scale, blob_conv = im_detect_bbox_aug(
-            model, im, box_proposals)
+            model, im, box_proposals, conv_cache)
     else:
         scores, boxes, im_scale, blob_conv = im_detect_bbox(
-            model, im, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, box_proposals)
+            model, im, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, box_proposals, im_blob)
     timers['im_detect_bbox'].toc()
 
     # score and boxes are from the whole image after score thresholding and nms
@@ -85,73 +96,217 @@ def im_detect_all(model, im, box_proposals=None, timers=None):
     scores, boxes, cls_boxes = box_results_with_nms_and_limit(scores, boxes)
     timers['misc_bbox'].toc()
 
-    if cfg.MODEL.MASK_ON and boxes.shape[0] > 0:
-        timers['im_detect_mask'].tic()
-        if cfg.TEST.MASK_AUG.ENABLED:
-            masks = im_detect_mask_aug(model, im, boxes, im_scale, blob_conv)
-        else:
-            masks = im_detect_mask(model, im_scale, boxes, blob_conv)
-        timers['im_detect_mask'].toc()
+    cls_segms, cls_keyps, cls_parsings, cls_uvs = im_detect_heads(
+        model, im, im_scale, scores, boxes, cls_boxes, blob_conv, timers, conv_cache)
 
-        timers['misc_mask'].tic()
-        cls_segms = segm_results(cls_boxes, masks, boxes, im.shape[0], im.shape[1])
-        timers['misc_mask'].toc()
-    else:
-        cls_segms = None
+    return cls_boxes, cls_segms, cls_keyps, cls_parsings, cls_uvs
+
+
+def im_detect_heads(model, im, im_scale, scores, boxes, cls_boxes, blob_conv, timers,
+                    conv_cache=None):
+    """Run the RoI heads (mask, keypoint, parsing, uv) on the detections of
+    an image and return (cls_segms, cls_keyps, cls_parsings, cls_uvs).
 
-    if cfg.MODEL.KEYPOINTS_ON and boxes.shape[0] > 0:
-        timers['im_detect_keypoints'].tic()
-        if cfg.TEST.KPS_AUG.ENABLED:
-            heatmaps = im_detect_keypoints_aug(model, im, boxes, im_scale, blob_conv)
+    scores, boxes are the detections of all classes stacked in the order of
+    cls_boxes, in image coordinates (as returned by
+    box_results_with_nms_and_limit), and blob_conv the conv body features of
+    the image at im_scale. The head test-time augmentations share the conv
+    body passes of conv_cache (see ConvBodyCache).
+    """
+    if conv_cache is None:
+        conv_cache = ConvBodyCache(model, im, get_heads_aug_transforms())
+    # The heads share the RoI features of their (identical) rois. Only those of
+    # blob_conv are kept: the augmented transforms' features are freed after
+    # their last use (see ConvBodyCache)
+    with model.module.roi_feature_cache(blob_conv):
+        if cfg.MODEL.MASK_ON and boxes.shape[0] > 0:
+            timers['im_detect_mask'].tic()
+            if cfg.TEST.MASK_AUG.ENABLED:
+                masks = im_detect_mask_aug(
+                    model, im, boxes, im_scale, blob_conv, conv_cache)
+            else:
+                masks = im_detect_mask(model, im_scale, boxes, blob_conv)
+            timers['im_detect_mask'].toc()
+
+            timers['misc_mask'].tic()
+            cls_segms = segm_results(cls_boxes, masks, boxes, im.shape[0], im.shape[1])
+            timers['misc_mask'].toc()
         else:
-            heatmaps = im_detect_keypoints(model, im_scale, boxes, blob_conv)
-        timers['im_detect_keypoints'].toc()
+            cls_segms = None
 
-        timers['misc_keypoints'].tic()
-        cls_keyps = keypoint_results(cls_boxes, heatmaps, boxes)
-        timers['misc_keypoints'].toc()
-    else:
-        cls_keyps = None
+        if cfg.MODEL.KEYPOINTS_ON and boxes.shape[0] > 0:
+            timers['im_detect_keypoints'].tic()
+            if cfg.TEST.KPS_AUG.ENABLED:
+                heatmaps = im_detect_keypoints_aug(
+                    model, im, boxes, im_scale, blob_conv, conv_cache)
+            else:
+                heatmaps = im_detect_keypoints(model, im_scale, boxes, blob_conv)
+            timers['im_detect_keypoints'].toc()
 
-    if cfg.MODEL.PARSING_ON and boxes.shape[0] > 0:
-        timers['im_detect_parsing'].tic()
-        if cfg.TEST.PARSING_AUG.ENABLED:
-            parsing = im_detect_parsing_aug(model, im, boxes)
+            timers['misc_keypoints'].tic()
+            cls_keyps = keypoint_results(cls_boxes, heatmaps, boxes)
+            timers['misc_keypoints'].toc()
         else:
-            parsing = im_detect_parsing(model, im_scale, boxes, blob_conv)
-        timers['im_detect_parsing'].toc()
+            cls_keyps = None
+
+        if cfg.MODEL.PARSING_ON and boxes.shape[0] > 0:
+            timers['im_detect_parsing'].tic()
+            # Only the detections the parsing head is gated on go through it
+            parsing_inds = select_head_inds(
+                scores, cfg.PRCNN.HEAD_MIN_SCORE, cfg.PRCNN.HEAD_MAX_INSTANCES)
+            if len(parsing_inds) == 0:
+                parsing = np.zeros((0, cfg.PRCNN.NUM_PARSING, 1, 1), np.float32)
+            elif cfg.TEST.PARSING_AUG.ENABLED:
+                parsing = im_detect_parsing_aug(
+                    model, im, boxes[parsing_inds], im_scale, blob_conv, conv_cache)
+            else:
+                parsing = im_detect_parsing(model, im_scale, boxes[parsing_inds], blob_conv)
+            timers['im_detect_parsing'].toc()
 
-        timers['misc_parsing'].tic()
-        cls_parsings = parsing_results(parsing, cls_boxes, im.shape[0], im.shape[1])
-        timers['misc_parsing'].toc()
-    else:
-        cls_parsings = None
+            timers['misc_parsing'].tic()
+            cls_parsings = parsing_results(
+                parsing, cls_boxes, im.shape[0], im.shape[1], parsing_inds)
+            timers['misc_parsing'].toc()
+        else:
+            cls_parsings = None
+
+        if cfg.MODEL.UV_ON and boxes.shape[0] > 0:
+            timers['im_detect_uv'].tic()
+            uv_inds = select_head_inds(
+                scores, cfg.UVRCNN.HEAD_MIN_SCORE, cfg.UVRCNN.HEAD_MAX_INSTANCES)
+            if len(uv_inds) == 0:
+                bodys = None
+            elif cfg.TEST.UV_AUG.ENABLED:
+                bodys = im_detect_uv_aug(
+                    model, im, boxes[uv_inds], im_scale, blob_conv, conv_cache)
+            else:
+                bodys = im_detect_uv(model, im_scale, boxes[uv_inds], blob_conv)
+            timers['im_detect_uv'].toc()
 
-    if cfg.MODEL.UV_ON and boxes.shape[0] > 0:
-        timers['im_detect_uv'].tic()
-        if cfg.TEST.UV_AUG.ENABLED:
-            bodys = im_detect_uv_aug(model, im, boxes)
+            timers['misc_uv'].tic()
+            cls_uvs = uv_results(model, bodys, boxes, uv_inds)
+            timers['misc_uv'].toc()
         else:
-            bodys = im_detect_uv(model, im_scale, boxes, blob_conv)
-        timers['im_detect_uv'].toc()
+            cls_uvs = None
 
-        timers['misc_uv'].tic()
-        cls_uvs = uv_results(model, bodys, boxes)
-        timers['misc_uv'].toc()
-               
-    else:
-        cls_uvs = None
+    return cls_segms, cls_keyps, cls_parsings, cls_uvs
 
-    return cls_boxes, cls_segms, cls_keyps, cls_parsings, cls_uvs
 
+def im_detect_all_batch(model, ims, timers=None, ims_blob=None):
+    """Process the outputs of model for a minibatch of images. The backbone,
+    RPN and each RoI head run once for the whole minibatch.
 
-def im_conv_body_only(model, im, target_scale, target_max_size):
-    inputs, im_scale = _get_blobs(im, None, target_scale, target_max_size)
+    Arguments:
+        model: the network module
+        ims (list): color images in BGR order
+        timers: record the cost of time for different steps
+        ims_blob: optional (blob, im_scales, im_info) of the minibatch, as
+            returned by blob_utils.get_image_list_blob (e.g. prefetched)
 
+    Returns:
+        list of (cls_boxes, cls_segms, cls_keyps, cls_parsings, cls_uvs), one
+        per image, in the format returned by im_detect_all
+    """
+    if timers is None:
+        timers = defaultdict(Timer)
+    num_ims = len(ims)
+
+    timers['im_detect_bbox'].tic()
+    scores_b, boxes_b, im_scales, blob_conv = im_detect_bbox_batch(
+        model, ims, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, ims_blob)
+    timers['im_detect_bbox'].toc()
+
+    timers['misc_bbox'].tic()
+    cls_boxes_b = []
+    for i in range(num_ims):
+        scores_b[i], boxes_b[i], cls_boxes_i = box_results_with_nms_and_limit(
+            scores_b[i], boxes_b[i])
+        cls_boxes_b.append(cls_boxes_i)
+    timers['misc_bbox'].toc()
+
+    # The detections of all images go through each RoI head together, the
+    # first column of the RoI blobs holds the image index in the minibatch
+    nums = np.array([boxes_i.shape[0] for boxes_i in boxes_b])
+    boxes = np.vstack(boxes_b)
+    batch_inds = np.repeat(np.arange(num_ims), nums)
+    roi_scales = np.repeat(im_scales, nums)[:, np.newaxis]
+    split_inds = np.cumsum(nums)[:-1]
+
+    with model.module.roi_feature_cache():
+        cls_segms_b = [None] * num_ims
+        if cfg.MODEL.MASK_ON and boxes.shape[0] > 0:
+            timers['im_detect_mask'].tic()
+            masks = im_detect_mask(model, roi_scales, boxes, blob_conv, batch_inds)
+            timers['im_detect_mask'].toc()
+
+            timers['misc_mask'].tic()
+            for i, masks_i in enumerate(np.split(masks, split_inds)):
+                if nums[i] > 0:
+                    cls_segms_b[i] = segm_results(
+                        cls_boxes_b[i], masks_i, boxes_b[i], ims[i].shape[0], ims[i].shape[1])
+            timers['misc_mask'].toc()
+
+        cls_keyps_b = [None] * num_ims
+        if cfg.MODEL.KEYPOINTS_ON and boxes.shape[0] > 0:
+            timers['im_detect_keypoints'].tic()
+            heatmaps = im_detect_keypoints(model, roi_scales, boxes, blob_conv, batch_inds)
+            timers['im_detect_keypoints'].toc()
+
+            timers['misc_keypoints'].tic()
+            for i, heatmaps_i in enumerate(np.split(heatmaps, split_inds)):
+                if nums[i] > 0:
+                    cls_keyps_b[i] = keypoint_results(cls_boxes_b[i], heatmaps_i, boxes_b[i])
+            timers['misc_keypoints'].toc()
+
+        cls_parsings_b = [None] * num_ims
+        if cfg.MODEL.PARSING_ON and boxes.shape[0] > 0:
+            timers['im_detect_parsing'].tic()
+            parsing_inds_b, parsing_inds, parsing_split = _select_head_inds_batch(
+                scores_b, cfg.PRCNN.HEAD_MIN_SCORE, cfg.PRCNN.HEAD_MAX_INSTANCES)
+            parsing = im_detect_parsing(
+                model, roi_scales[parsing_inds], boxes[parsing_inds], blob_conv,
+                batch_inds[parsing_inds])
+            timers['im_detect_parsing'].toc()
+
+            timers['misc_parsing'].tic()
+            for i, parsing_i in enumerate(np.split(parsing, parsing_split)):
+                if nums[i] > 0:
+                    cls_parsings_b[i] = parsing_results(
+                        parsing_i, cls_boxes_b[i], ims[i].shape[0], ims[i].shape[1],
+                        parsing_inds_b[i])
+            timers['misc_parsing'].toc()
+
+        cls_uvs_b = [None] * num_ims
+        if cfg.MODEL.UV_ON and boxes.shape[0] > 0:
+            timers['im_detect_uv'].tic()
+            uv_inds_b, uv_inds, uv_split = _select_head_inds_batch(
+                scores_b, cfg.UVRCNN.HEAD_MIN_SCORE, cfg.UVRCNN.HEAD_MAX_INSTANCES)
+            if len(uv_inds) > 0:
+                bodys = im_detect_uv(
+                    model, roi_scales[uv_inds], boxes[uv_inds], blob_conv, batch_inds[uv_inds])
+                bodys_b = [np.split(body, uv_split) for body in bodys]
+            timers['im_detect_uv'].toc()
+
+            timers['misc_uv'].tic()
+            for i in range(num_ims):
+                if nums[i] > 0:
+                    bodys_i = None
+                    if len(uv_inds_b[i]) > 0:
+                        bodys_i = [body_b[i] for body_b in bodys_b]
+                    cls_uvs_b[i] = uv_results(model, bodys_i, boxes_b[i], uv_inds_b[i])
+            timers['misc_uv'].toc()
+
+    return list(zip(cls_boxes_b, cls_segms_b, cls_keyps_b, cls_parsings_b, cls_uvs_b))
+
+
+def im_conv_body_only(model, im, target_scale, target_max_size, im_blob=None):
+    inputs, im_scale = _get_blobs(im, None, target_scale, target_max_size, im_blob)
+
+    device = torch.device(cfg.DEVICE)
     if cfg.PYTORCH_VERSION_LESS_THAN_040:
-        inputs['data'] = Variable(torch.from_numpy(inputs['data']), volatile=True).cuda()
+        inputs['data'] = Variable(torch.from_numpy(inputs['data']), volatile=True).to(device)
     else:
-        inputs['data'] = torch.from_numpy(inputs['data']).cuda()
+        inputs['data'] = torch.from_numpy(inputs['data']).to(device)
     inputs.pop('im_info')
 
     blob_conv = model.module.convbody_net(**inputs)
@@ -159,10 +314,252 @@ def im_conv_body_only(model, im, target_scale, target_max_size):
     return blob_conv, im_scale
 
 
-def im_detect_bbox(model, im, target_scale, target_max_size, boxes=None):
+def get_aug_transforms(aug_cfg):
+    """The (scale, max_size, hflip, aspect_ratio) transforms of a test-time
+    augmentation config (e.g. cfg.TEST.MASK_AUG), identity transform first.
+    """
+    transforms = [(cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, False, 1.0)]
+    if aug_cfg.H_FLIP:
+        transforms.append((cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, True, 1.0))
+    for scale in aug_cfg.SCALES:
+        transforms.append((scale, aug_cfg.MAX_SIZE, False, 1.0))
+        if aug_cfg.SCALE_H_FLIP:
+            transforms.append((scale, aug_cfg.MAX_SIZE, True, 1.0))
+    for aspect_ratio in aug_cfg.ASPECT_RATIOS:
+        transforms.append((cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, False, aspect_ratio))
+        if aug_cfg.ASPECT_RATIO_H_FLIP:
+            transforms.append((cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, True, aspect_ratio))
+    return transforms
+
+
+def get_heads_aug_transforms():
+    """The transforms the enabled head augmentations need, as a Counter of the
+    number of heads that need each of them.
+    """
+    heads_aug = [
+        (cfg.MODEL.MASK_ON, cfg.TEST.MASK_AUG),
+        (cfg.MODEL.KEYPOINTS_ON, cfg.TEST.KPS_AUG),
+        (cfg.MODEL.PARSING_ON, cfg.TEST.PARSING_AUG),
+        (cfg.MODEL.UV_ON, cfg.TEST.UV_AUG),
+    ]
+    uses = Counter()
+    for head_on, aug_cfg in heads_aug:
+        if head_on and aug_cfg.ENABLED:
+            uses.update(set(get_aug_transforms(aug_cfg)))
+    return uses
+
+
+class ConvBodyCache(object):
+    """Conv body features of an image under the test-time augmentation
+    transforms (see get_aug_transforms), so that each backbone pass runs once
+    per image whichever of the bbox and head augmentations needs it.
+
+    uses counts the consumers (heads) still to come for each transform, each
+    consumer calling release once done with it. Features are only kept while
+    another consumer needs them: put by the bbox augmentation (which runs the
+    conv body itself) for a later head, or computed for more than one head.
+    An image and its horizontal flip that are both needed run through the
+    conv body as one minibatch of 2.
+    """
+
+    def __init__(self, model, im, uses=None):
+        self.model = model
+        self.im = im
+        self.uses = Counter(uses)
+        self._images = {}
+        self._blobs = {}
+
+    def image(self, hflip=False, aspect_ratio=1.0):
+        """The image under a flip and width-relative aspect ratio."""
+        im_t = self._images.get((hflip, aspect_ratio))
+        if im_t is None:
+            if hflip:
+                im_t = self.image(False, aspect_ratio)[:, ::-1, :]
+            elif aspect_ratio != 1.0:
+                im_t = image_utils.aspect_ratio_rel(self.im, aspect_ratio)
+            else:
+                im_t = self.im
+            self._images[(hflip, aspect_ratio)] = im_t
+        return im_t
+
+    def get(self, transform):
+        """(blob_conv, im_scale, batch_ind) of the image under a transform,
+        batch_ind being the index of the image in the minibatch of blob_conv.
+        """
+        if transform in self._blobs:
+            return self._blobs[transform]
+        target_scale, target_max_size, hflip, aspect_ratio = transform
+        flip_t = (target_scale, target_max_size, not hflip, aspect_ratio)
+        if self.uses[transform] > 0 and self.uses[flip_t] > 0 \
+                and flip_t not in self._blobs:
+            # The image and its flip have the same size, no padding between
+            ims = [self.image(False, aspect_ratio), self.image(True, aspect_ratio)]
+            ims_blob = blob_utils.get_image_list_blob(ims, target_scale, target_max_size)
+            blob_conv, im_scales = im_conv_body_only(
+                self.model, None, target_scale, target_max_size, ims_blob
+            )
+            # The flip is kept for its consumer to come
+            for batch_ind, t in enumerate(sorted((transform, flip_t), key=lambda t: t[2])):
+                self._blobs[t] = (blob_conv, im_scales[batch_ind], batch_ind)
+            entry = self._blobs[transform]
+        else:
+            blob_conv, im_scale = im_conv_body_only(
+                self.model, self.image(hflip, aspect_ratio), target_scale, target_max_size
+            )
+            entry = (blob_conv, im_scale, 0)
+        if self.uses[transform] <= 1:
+            self._blobs.pop(transform, None)
+        elif transform not in self._blobs:
+            self._blobs[transform] = entry
+        return entry
+
+    def cached(self, transform):
+        """(blob_conv, im_scale, batch_ind) of a transform if kept, else None."""
+        return self._blobs.get(transform)
+
+    def put(self, transform, blob_conv, im_scale, batch_ind=0):
+        """Keep the features of a transform computed elsewhere, if needed."""
+        if self.uses[transform] > 0:
+            self._blobs[transform] = (blob_conv, im_scale, batch_ind)
+
+    def release(self, transform):
+        """A consumer is done with a transform; drop its features after the
+        last one.
+        """
+        self.uses[transform] -= 1
+        if self.uses[transform] <= 0:
+            self._blobs.pop(transform, None)
+
+    def transform_boxes(self, boxes, transform):
+        """Map boxes of the image to the image under a transform."""
+        _, _, hflip, aspect_ratio = transform
+        if aspect_ratio != 1.0:
+            boxes = box_utils.aspect_ratio(boxes, aspect_ratio)
+        if hflip:
+            boxes = box_utils.flip_boxes(boxes, self.image(False, aspect_ratio).shape[1])
+        return boxes
+
+    def invert_boxes(self, boxes, transform):
+        """Map boxes of the image under a transform back to the image."""
+        _, _, hflip, aspect_ratio = transform
+        if hflip:
+            boxes = box_utils.flip_boxes(boxes, self.image(False, aspect_ratio).shape[1])
+        if aspect_ratio != 1.0:
+            boxes = box_utils.aspect_ratio(boxes, 1.0 / aspect_ratio)
+        return boxes
+
+
+def im_detect_head_aug(model, im, boxes, im_scale, blob_conv, aug_cfg,
+                       im_detect_f, flip_f, conv_cache=None):
+    """Runs a head under the transforms of a test-time augmentation config.
+
+    Arguments:
+        im_scale, blob_conv: the identity transform features of the image
+        im_detect_f: the head, e.g. im_detect_mask
+        flip_f: inverts the predictions of a horizontally flipped image
+        conv_cache (ConvBodyCache): features shared with the other
+            augmentations of the image
+
+    Yields:
+        the (transform, predictions) pairs, identity first, one at a time so
+        that they can be combined as they come (see AugReducer)
+    """
+    transforms = get_aug_transforms(aug_cfg)
+    if conv_cache is None:
+        conv_cache = ConvBodyCache(model, im, Counter(transforms))
+    conv_cache.put(transforms[0], blob_conv, im_scale)
+
+    num_boxes = boxes.shape[0]
+    done = set()
+    for transform in transforms:
+        if transform in done:
+            continue
+        blob_conv_t, im_scale_t, batch_ind = conv_cache.get(transform)
+        # A transform and its flip computed as one minibatch also go through
+        # the head together, with the RoIs of each image stacked
+        group = [transform]
+        flip_t = transform[:2] + (not transform[2],) + transform[3:]
+        if flip_t in transforms and flip_t not in done \
+                and conv_cache.cached(flip_t) is not None:
+            blob_conv_f, _, batch_ind_f = conv_cache.cached(flip_t)
+            if blob_conv_f is blob_conv_t:
+                group.append(flip_t)
+        batch_inds = np.repeat(
+            [batch_ind if t is transform else batch_ind_f for t in group], num_boxes)
+        boxes_g = np.vstack([conv_cache.transform_boxes(boxes, t) for t in group])
+        preds_g = im_detect_f(
+            model, im_scale_t, boxes_g, blob_conv_t,
+            batch_inds if batch_inds.any() else None
+        )
+
+        for i, t in enumerate(group):
+            if isinstance(preds_g, list):
+                preds_t = [p[i * num_boxes:(i + 1) * num_boxes] for p in preds_g]
+            else:
+                preds_t = preds_g[i * num_boxes:(i + 1) * num_boxes]
+            if t[2]:
+                preds_t = flip_f(preds_t)
+            done.add(t)
+            yield t, preds_t
+            conv_cache.release(t)
+
+
+class AugReducer(object):
+    """Running combination of the predictions of a head under test-time
+    augmentations. Each prediction is folded in as soon as it is computed, so
+    that memory does not grow with the number of transforms.
+
+    mode is 'AVG', 'MAX' or 'LOGIT_AVG' (the average of soft predictions in
+    logit space).
+    """
+
+    def __init__(self, mode):
+        assert mode in ('AVG', 'MAX', 'LOGIT_AVG'), mode
+        self.mode = mode
+        self._acc = None
+        self._count = None
+
+    def add(self, preds, inds=None):
+        """Fold in the R x ... predictions of a transform, or only their rows
+        selected by the boolean mask inds.
+        """
+        if self.mode == 'LOGIT_AVG':
+            preds = -1.0 * np.log((1.0 - preds) / np.maximum(preds, 1e-20))
+        if self._acc is None:
+            if self.mode == 'MAX':
+                self._acc = np.full(preds.shape, -np.inf, dtype=preds.dtype)
+            else:
+                self._acc = np.zeros(preds.shape, dtype=preds.dtype)
+            self._count = np.zeros(preds.shape[0], dtype=np.int64)
+
+        if inds is None:
+            if self.mode == 'MAX':
+                np.maximum(self._acc, preds, out=self._acc)
+            else:
+                self._acc += preds
+            self._count += 1
+        else:
+            if self.mode == 'MAX':
+                self._acc[inds] = np.maximum(self._acc[inds], preds[inds])
+            else:
+                self._acc[inds] += preds[inds]
+            self._count[inds] += 1
+
+    def result(self):
+        """The combined predictions."""
+        if self.mode == 'MAX':
+            return self._acc
+        count = self._count.reshape((-1,) + (1,) * (self._acc.ndim - 1))
+        preds_c = np.divide(self._acc, count, out=self._acc, casting='unsafe')
+        if self.mode == 'LOGIT_AVG':
+            preds_c = 1.0 / (1.0 + np.exp(-preds_c))
+        return preds_c
+
+
+def im_detect_bbox(model, im, target_scale, target_max_size, boxes=None, im_blob=None):
     """Prepare the bbox for testing"""
 
-    inputs, im_scale = _get_blobs(im, boxes, target_scale, target_max_size)
+    inputs, im_scale = _get_blobs(im, boxes, target_scale, target_max_size, im_blob)
 
     if cfg.DEDUP_BOXES > 0 and not cfg.MODEL.FASTER_RCNN:
         v = np.array([1, 1e3, 1e6, 1e9, 1e12])
@@ -197,10 +594,73 @@ def im_detect_bbox(model, im, target_scale, target_max_size, boxes=None):
     scores = scores.reshape([-1, scores.shape[-1]])
 
     if cfg.TEST.BBOX_REG:
-        # Apply bounding-box regression deltas
         box_deltas = return_dict['bbox_pred'].data.cpu().numpy().squeeze()
         # In case there is 1 proposal
         box_deltas = box_deltas.reshape([-1, box_deltas.shape[-1]])
+    else:
+        box_deltas = None
+    pred_boxes = _get_pred_boxes(boxes, box_deltas, scores.shape[1], im.shape)
+
+    if cfg.DEDUP_BOXES > 0 and not cfg.MODEL.FASTER_RCNN:
+        # Map scores and predictions back to the original set of boxes
+        scores = scores[inv_index, :]
+        pred_boxes = pred_boxes[inv_index, :]
+
+    return scores, pred_boxes, im_scale, return_dict['blob_conv']
+
+
+def im_detect_bbox_batch(model, ims, target_scale, target_max_size, ims_blob=None):
+    """Bbox detection for a minibatch of images with a single forward pass.
+    Only in-network (Faster R-CNN) proposals are supported.
+
+    Returns:
+        scores (list): per image scores, as returned by im_detect_bbox
+        pred_boxes (list): per image boxes, as returned by im_detect_bbox
+        im_scales (ndarray): per image scale factors
+        blob_conv (list): base features of the whole minibatch
+    """
+    if ims_blob is None:
+        ims_blob = blob_utils.get_image_list_blob(ims, target_scale, target_max_size)
+    inputs = {}
+    inputs['data'], im_scales, inputs['im_info'] = ims_blob
+
+    if cfg.PYTORCH_VERSION_LESS_THAN_040:
+        inputs['data'] = [Variable(torch.from_numpy(inputs['data']), volatile=True)]
+        inputs['im_info'] = [Variable(torch.from_numpy(inputs['im_info']), volatile=True)]
+    else:
+        inputs['data'] = [torch.from_numpy(inputs['data'])]
+        inputs['im_info'] = [torch.from_numpy(inputs['im_info'])]
+
+    return_dict = model(**inputs)
+
+    rois = return_dict['rois'].data.cpu().numpy()
+    cls_scores = return_dict['cls_score'].data.cpu().numpy()
+    cls_scores = cls_scores.reshape([-1, cls_scores.shape[-1]])
+    if cfg.TEST.BBOX_REG:
+        bbox_preds = return_dict['bbox_pred'].data.cpu().numpy()
+        bbox_preds = bbox_preds.reshape([-1, bbox_preds.shape[-1]])
+
+    # Split the predictions by the image index stored in the first rois column
+    scores_b = []
+    pred_boxes_b = []
+    for i, im in enumerate(ims):
+        inds = np.where(rois[:, 0] == i)[0]
+        # unscale back to raw image space
+        boxes = rois[inds, 1:5] / im_scales[i]
+        scores = cls_scores[inds]
+        box_deltas = bbox_preds[inds] if cfg.TEST.BBOX_REG else None
+        scores_b.append(scores)
+        pred_boxes_b.append(
+            _get_pred_boxes(boxes, box_deltas, scores.shape[1], im.shape)
+        )
+
+    return scores_b, pred_boxes_b, im_scales, return_dict['blob_conv']
+
+
+def _get_pred_boxes(boxes, box_deltas, num_classes, im_shape):
+    """Apply bounding-box regression deltas (if any) to the RoIs, giving
+    R x (4 * num_classes) predicted boxes clipped to the image."""
+    if box_deltas is not None:
         if cfg.MODEL.CLS_AGNOSTIC_BBOX_REG:
             # Remove predictions for bg class (compat with MSRA code)
             box_deltas = box_deltas[:, -4:]
@@ -209,24 +669,20 @@ def im_detect_bbox(model, im, target_scale, target_max_size, boxes=None):
             box_deltas = box_deltas.view(-1, 4) * cfg.TRAIN.BBOX_NORMALIZE_STDS \
                          + cfg.TRAIN.BBOX_NORMALIZE_MEANS
         pred_boxes = box_utils.bbox_transform(boxes, box_deltas, cfg.MODEL.BBOX_REG_WEIGHTS)
-        pred_boxes = box_utils.clip_tiled_boxes(pred_boxes, im.shape)
+        pred_boxes = box_utils.clip_tiled_boxes(pred_boxes, im_shape)
         if cfg.MODEL.CLS_AGNOSTIC_BBOX_REG:
-            pred_boxes = np.tile(pred_boxes, (1, scores.shape[1]))
+            pred_boxes = np.tile(pred_boxes, (1, num_classes))
     else:
         # Simply repeat the boxes, once for each class
-        pred_boxes = np.tile(boxes, (1, scores.shape[1]))
-
-    if cfg.DEDUP_BOXES > 0 and not cfg.MODEL.FASTER_RCNN:
-        # Map scores and predictions back to the original set of boxes
-        scores = scores[inv_index, :]
-        pred_boxes = pred_boxes[inv_index, :]
-
-    return scores, pred_boxes, im_scale, return_dict['blob_conv']
+        pred_boxes = np.tile(boxes, (1, num_classes))
+    return pred_boxes
 
 
-def im_detect_bbox_aug(model, im, box_proposals=None):
+def im_detect_bbox_aug(model, im, box_proposals=None, conv_cache=None):
     """Performs bbox detection with test-time augmentations.
-    Function signature is the same as for im_detect_bbox.
+    Function signature is the same as for im_detect_bbox; the conv body
+    features of the transforms the heads augment with too are kept in
+    conv_cache (see ConvBodyCache).
     """
     assert not cfg.TEST.BBOX_AUG.SCALE_SIZE_DEP, \
         'Size dependent scaling not implemented'
@@ -240,59 +696,38 @@ def im_detect_bbox_aug(model, im, box_proposals=None):
         cfg.TEST.BBOX_AUG.SCORE_HEUR == 'UNION', \
         'Union heuristic must be used to combine Faster RCNN predictions'
 
+    if conv_cache is None:
+        conv_cache = ConvBodyCache(model, im)
+
     # Collect detections computed under different transformations
     scores_ts = []
     boxes_ts = []
 
-    def add_preds_t(scores_t, boxes_t):
-        scores_ts.append(scores_t)
-        boxes_ts.append(boxes_t)
+    # Compute detections for the original image (identity transform) last,
+    # as in the order the predictions were always combined in
+    transforms = get_aug_transforms(cfg.TEST.BBOX_AUG)
+    for transform in transforms[1:] + transforms[:1]:
+        target_scale, target_max_size, hflip, aspect_ratio = transform
+        if not cfg.MODEL.FASTER_RCNN:
+            box_proposals_t = conv_cache.transform_boxes(box_proposals, transform)
+        else:
+            box_proposals_t = None
 
-    # Perform detection on the horizontally flipped image
-    if cfg.TEST.BBOX_AUG.H_FLIP:
-        scores_hf, boxes_hf, _ = im_detect_bbox_hflip(
+        scores_t, boxes_t, im_scale_t, blob_conv_t = im_detect_bbox(
             model,
-            im,
-            cfg.TEST.SCALE,
-            cfg.TEST.MAX_SIZE,
-            box_proposals=box_proposals
-        )
-        add_preds_t(scores_hf, boxes_hf)
-
-    # Compute detections at different scales
-    for scale in cfg.TEST.BBOX_AUG.SCALES:
-        max_size = cfg.TEST.BBOX_AUG.MAX_SIZE
-        scores_scl, boxes_scl = im_detect_bbox_scale(
-            model, im, scale, max_size, box_proposals
-        )
-        add_preds_t(scores_scl, boxes_scl)
-
-        if cfg.TEST.BBOX_AUG.SCALE_H_FLIP:
-            scores_scl_hf, boxes_scl_hf = im_detect_bbox_scale(
-                model, im, scale, max_size, box_proposals, hflip=True
-            )
-            add_preds_t(scores_scl_hf, boxes_scl_hf)
-
-    # Perform detection at different aspect ratios
-    for aspect_ratio in cfg.TEST.BBOX_AUG.ASPECT_RATIOS:
-        scores_ar, boxes_ar = im_detect_bbox_aspect_ratio(
-            model, im, aspect_ratio, box_proposals
+            conv_cache.image(hflip, aspect_ratio),
+            target_scale,
+            target_max_size,
+            boxes=box_proposals_t
         )
-        add_preds_t(scores_ar, boxes_ar)
+        conv_cache.put(transform, blob_conv_t, im_scale_t)
 
-        if cfg.TEST.BBOX_AUG.ASPECT_RATIO_H_FLIP:
-            scores_ar_hf, boxes_ar_hf = im_detect_bbox_aspect_ratio(
-                model, im, aspect_ratio, box_proposals, hflip=True
-            )
-            add_preds_t(scores_ar_hf, boxes_ar_hf)
+        # Invert the detected boxes
+        scores_ts.append(scores_t)
+        boxes_ts.append(conv_cache.invert_boxes(boxes_t, transform))
 
-    # Compute detections for the original image (identity transform) last to
-    # ensure that the Caffe2 workspace is populated with blobs corresponding
-    # to the original image on return (postcondition of im_detect_bbox)
-    scores_i, boxes_i, im_scale_i, blob_conv_i = im_detect_bbox(
-        model, im, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, boxes=box_proposals
-    )
-    add_preds_t(scores_i, boxes_i)
+    scores_i, boxes_i = scores_ts[-1], boxes_ts[-1]
+    im_scale_i, blob_conv_i = im_scale_t, blob_conv_t
 
     # Combine the predicted scores
     if cfg.TEST.BBOX_AUG.SCORE_HEUR == 'ID':
@@ -321,83 +756,7 @@ def im_detect_bbox_aug(model, im, box_proposals=None):
     return scores_c, boxes_c, im_scale_i, blob_conv_i
 
 
-def im_detect_bbox_hflip(
-        model, im, target_scale, target_max_size, box_proposals=None):
-    """Performs bbox detection on the horizontally flipped image.
-    Function signature is the same as for im_detect_bbox.
-    """
-    # Compute predictions on the flipped image
-    im_hf = im[:, ::-1, :]
-    im_width = im.shape[1]
-
-    if not cfg.MODEL.FASTER_RCNN:
-        box_proposals_hf = box_utils.flip_boxes(box_proposals, im_width)
-    else:
-        box_proposals_hf = None
-
-    scores_hf, boxes_hf, im_scale, _ = im_detect_bbox(
-        model, im_hf, target_scale, target_max_size, boxes=box_proposals_hf
-    )
-
-    # Invert the detections computed on the flipped image
-    boxes_inv = box_utils.flip_boxes(boxes_hf, im_width)
-
-    return scores_hf, boxes_inv, im_scale
-
-
-def im_detect_bbox_scale(
-        model, im, target_scale, target_max_size, box_proposals=None, hflip=False):
-    """Computes bbox detections at the given scale.
-    Returns predictions in the original image space.
-    """
-    if hflip:
-        scores_scl, boxes_scl, _ = im_detect_bbox_hflip(
-            model, im, target_scale, target_max_size, box_proposals=box_proposals
-        )
-    else:
-        scores_scl, boxes_scl, _, _ = im_detect_bbox(
-            model, im, target_scale, target_max_size, boxes=box_proposals
-        )
-    return scores_scl, boxes_scl
-
-
-def im_detect_bbox_aspect_ratio(
-        model, im, aspect_ratio, box_proposals=None, hflip=False):
-    """Computes bbox detections at the given width-relative aspect ratio.
-    Returns predictions in the original image space.
-    """
-    # Compute predictions on the transformed image
-    im_ar = image_utils.aspect_ratio_rel(im, aspect_ratio)
-
-    if not cfg.MODEL.FASTER_RCNN:
-        box_proposals_ar = box_utils.aspect_ratio(box_proposals, aspect_ratio)
-    else:
-        box_proposals_ar = None
-
-    if hflip:
-        scores_ar, boxes_ar, _ = im_detect_bbox_hflip(
-            model,
-            im_ar,
-            cfg.TEST.SCALE,
-            cfg.TEST.MAX_SIZE,
-            box_proposals=box_proposals_ar
-        )
-    else:
-        scores_ar, boxes_ar, _, _ = im_detect_bbox(
-            model,
-            im_ar,
-            cfg.TEST.SCALE,
-            cfg.TEST.MAX_SIZE,
-            boxes=box_proposals_ar
-        )
-
-    # Invert the detected boxes
-    boxes_inv = box_utils.aspect_ratio(boxes_ar, 1.0 / aspect_ratio)
-
-    return scores_ar, boxes_inv
-
-
-def im_detect_mask(model, im_scale, boxes, blob_conv):
+def im_detect_mask(model, im_scale, boxes, blob_conv, batch_inds=None):
     """Infer instance segmentation masks. This function must be called after
     im_detect_bbox as it assumes that the Caffe2 workspace is already populated
     with the necessary blobs.
@@ -419,7 +778,7 @@ def im_detect_mask(model, im_scale, boxes, blob_conv):
         pred_masks = np.zeros((0, M, M), np.float32)
         return pred_masks
 
-    inputs = {'mask_rois': _get_rois_blob(boxes, im_scale)}
+    inputs = {'mask_rois': _get_rois_blob(boxes, im_scale, batch_inds)}
 
     # Add multi-level rois for FPN
     if cfg.FPN.MULTILEVEL_ROIS:
@@ -436,7 +795,7 @@ def im_detect_mask(model, im_scale, boxes, blob_conv):
     return pred_masks
 
 
-def im_detect_mask_aug(model, im, boxes, im_scale, blob_conv):
+def im_detect_mask_aug(model, im, boxes, im_scale, blob_conv, conv_cache=None):
     """Performs mask detection with test-time augmentations.
 
     Arguments:
@@ -445,6 +804,7 @@ def im_detect_mask_aug(model, im, boxes, im_scale, blob_conv):
         boxes (ndarray): R x 4 array of bounding boxes
         im_scale (list): image blob scales as returned by im_detect_bbox
         blob_conv (Tensor): base features from the backbone network.
+        conv_cache (ConvBodyCache): base features of the transformed images
 
     Returns:
         masks (ndarray): R x K x M x M array of class specific soft masks
@@ -452,115 +812,27 @@ def im_detect_mask_aug(model, im, boxes, im_scale, blob_conv):
     assert not cfg.TEST.MASK_AUG.SCALE_SIZE_DEP, \
         'Size dependent scaling not implemented'
 
-    # Collect masks computed under different transformations
-    masks_ts = []
-
-    # Compute masks for the original image (identity transform)
-    masks_i = im_detect_mask(model, im_scale, boxes, blob_conv)
-    masks_ts.append(masks_i)
-
-    # Perform mask detection on the horizontally flipped image
-    if cfg.TEST.MASK_AUG.H_FLIP:
-        masks_hf = im_detect_mask_hflip(
-            model, im, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, boxes
-        )
-        masks_ts.append(masks_hf)
-
-    # Compute detections at different scales
-    for scale in cfg.TEST.MASK_AUG.SCALES:
-        max_size = cfg.TEST.MASK_AUG.MAX_SIZE
-        masks_scl = im_detect_mask_scale(model, im, scale, max_size, boxes)
-        masks_ts.append(masks_scl)
-
-        if cfg.TEST.MASK_AUG.SCALE_H_FLIP:
-            masks_scl_hf = im_detect_mask_scale(
-                model, im, scale, max_size, boxes, hflip=True
-            )
-            masks_ts.append(masks_scl_hf)
-
-    # Compute masks at different aspect ratios
-    for aspect_ratio in cfg.TEST.MASK_AUG.ASPECT_RATIOS:
-        masks_ar = im_detect_mask_aspect_ratio(model, im, aspect_ratio, boxes)
-        masks_ts.append(masks_ar)
-
-        if cfg.TEST.MASK_AUG.ASPECT_RATIO_H_FLIP:
-            masks_ar_hf = im_detect_mask_aspect_ratio(
-                model, im, aspect_ratio, boxes, hflip=True
-            )
-            masks_ts.append(masks_ar_hf)
-
-    # Combine the predicted soft masks
-    if cfg.TEST.MASK_AUG.HEUR == 'SOFT_AVG':
-        masks_c = np.mean(masks_ts, axis=0)
-    elif cfg.TEST.MASK_AUG.HEUR == 'SOFT_MAX':
-        masks_c = np.amax(masks_ts, axis=0)
-    elif cfg.TEST.MASK_AUG.HEUR == 'LOGIT_AVG':
-
-        def logit(y):
-            return -1.0 * np.log((1.0 - y) / np.maximum(y, 1e-20))
-
-        logit_masks = [logit(y) for y in masks_ts]
-        logit_masks = np.mean(logit_masks, axis=0)
-        masks_c = 1.0 / (1.0 + np.exp(-logit_masks))
-    else:
+    # Combine the soft masks computed under different transformations
+    heurs = {'SOFT_AVG': 'AVG', 'SOFT_MAX': 'MAX', 'LOGIT_AVG': 'LOGIT_AVG'}
+    if cfg.TEST.MASK_AUG.HEUR not in heurs:
         raise NotImplementedError(
             'Heuristic {} not supported'.format(cfg.TEST.MASK_AUG.HEUR)
         )
+    masks_c = AugReducer(heurs[cfg.TEST.MASK_AUG.HEUR])
+    for _, masks_t in im_detect_head_aug(
+            model, im, boxes, im_scale, blob_conv, cfg.TEST.MASK_AUG,
+            im_detect_mask, flip_masks, conv_cache):
+        masks_c.add(masks_t)
 
-    return masks_c
-
-
-def im_detect_mask_hflip(model, im, target_scale, target_max_size, boxes):
-    """Performs mask detection on the horizontally flipped image.
-    Function signature is the same as for im_detect_mask_aug.
-    """
-    # Compute the masks for the flipped image
-    im_hf = im[:, ::-1, :]
-    boxes_hf = box_utils.flip_boxes(boxes, im.shape[1])
-
-    blob_conv, im_scale = im_conv_body_only(model, im_hf, target_scale, target_max_size)
-    masks_hf = im_detect_mask(model, im_scale, boxes_hf, blob_conv)
-
-    # Invert the predicted soft masks
-    masks_inv = masks_hf[:, :, :, ::-1]
-
-    return masks_inv
-
-
-def im_detect_mask_scale(
-        model, im, target_scale, target_max_size, boxes, hflip=False):
-    """Computes masks at the given scale."""
-    if hflip:
-        masks_scl = im_detect_mask_hflip(
-            model, im, target_scale, target_max_size, boxes
-        )
-    else:
-        blob_conv, im_scale = im_conv_body_only(model, im, target_scale, target_max_size)
-        masks_scl = im_detect_mask(model, im_scale, boxes, blob_conv)
-    return masks_scl
-
+    return masks_c.result()
 
-def im_detect_mask_aspect_ratio(model, im, aspect_ratio, boxes, hflip=False):
-    """Computes mask detections at the given width-relative aspect ratio."""
-
-    # Perform mask detection on the transformed image
-    im_ar = image_utils.aspect_ratio_rel(im, aspect_ratio)
-    boxes_ar = box_utils.aspect_ratio(boxes, aspect_ratio)
-
-    if hflip:
-        masks_ar = im_detect_mask_hflip(
-            model, im_ar, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, boxes_ar
-        )
-    else:
-        blob_conv, im_scale = im_conv_body_only(
-            model, im_ar, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE
-        )
-        masks_ar = im_detect_mask(model, im_scale, boxes_ar, blob_conv)
 
-    return masks_ar
+def flip_masks(masks):
+    """Inverts the soft masks predicted on the horizontally flipped image."""
+    return masks[:, :, :, ::-1]
 
 
-def im_detect_keypoints(model, im_scale, boxes, blob_conv):
+def im_detect_keypoints(model, im_scale, boxes, blob_conv, batch_inds=None):
     """Infer instance keypoint poses. This function must be called after
     im_detect_bbox as it assumes that the Caffe2 workspace is already populated
     with the necessary blobs.
@@ -582,7 +854,7 @@ def im_detect_keypoints(model, im_scale, boxes, blob_conv):
         pred_heatmaps = np.zeros((0, cfg.KRCNN.NUM_KEYPOINTS, M, M), np.float32)
         return pred_heatmaps
 
-    inputs = {'keypoint_rois': _get_rois_blob(boxes, im_scale)}
+    inputs = {'keypoint_rois': _get_rois_blob(boxes, im_scale, batch_inds)}
 
     # Add multi-level rois for FPN
     if cfg.FPN.MULTILEVEL_ROIS:
@@ -598,7 +870,7 @@ def im_detect_keypoints(model, im_scale, boxes, blob_conv):
     return pred_heatmaps
 
 
-def im_detect_keypoints_aug(model, im, boxes, im_scale, blob_conv):
+def im_detect_keypoints_aug(model, im, boxes, im_scale, blob_conv, conv_cache=None):
     """Computes keypoint predictions with test-time augmentations.
 
     Arguments:
@@ -607,136 +879,43 @@ def im_detect_keypoints_aug(model, im, boxes, im_scale, blob_conv):
         boxes (ndarray): R x 4 array of bounding boxes
         im_scale (list): image blob scales as returned by im_detect_bbox
         blob_conv (Tensor): base features from the backbone network.
+        conv_cache (ConvBodyCache): base features of the transformed images
 
     Returns:
         heatmaps (ndarray): R x J x M x M array of keypoint location logits
     """
-    # Collect heatmaps predicted under different transformations
-    heatmaps_ts = []
-    # Tag predictions computed under downscaling and upscaling transformations
-    ds_ts = []
-    us_ts = []
-
-    def add_heatmaps_t(heatmaps_t, ds_t=False, us_t=False):
-        heatmaps_ts.append(heatmaps_t)
-        ds_ts.append(ds_t)
-        us_ts.append(us_t)
-
-    # Compute the heatmaps for the original image (identity transform)
-    heatmaps_i = im_detect_keypoints(model, im_scale, boxes, blob_conv)
-    add_heatmaps_t(heatmaps_i)
-
-    # Perform keypoints detection on the horizontally flipped image
-    if cfg.TEST.KPS_AUG.H_FLIP:
-        heatmaps_hf = im_detect_keypoints_hflip(
-            model, im, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, boxes
-        )
-        add_heatmaps_t(heatmaps_hf)
-
-    # Compute detections at different scales
-    for scale in cfg.TEST.KPS_AUG.SCALES:
-        ds_scl = scale < cfg.TEST.SCALE
-        us_scl = scale > cfg.TEST.SCALE
-        heatmaps_scl = im_detect_keypoints_scale(
-            model, im, scale, cfg.TEST.KPS_AUG.MAX_SIZE, boxes
-        )
-        add_heatmaps_t(heatmaps_scl, ds_scl, us_scl)
-
-        if cfg.TEST.KPS_AUG.SCALE_H_FLIP:
-            heatmaps_scl_hf = im_detect_keypoints_scale(
-                model, im, scale, cfg.TEST.KPS_AUG.MAX_SIZE, boxes, hflip=True
-            )
-            add_heatmaps_t(heatmaps_scl_hf, ds_scl, us_scl)
-
-    # Compute keypoints at different aspect ratios
-    for aspect_ratio in cfg.TEST.KPS_AUG.ASPECT_RATIOS:
-        heatmaps_ar = im_detect_keypoints_aspect_ratio(
-            model, im, aspect_ratio, boxes
-        )
-        add_heatmaps_t(heatmaps_ar)
-
-        if cfg.TEST.KPS_AUG.ASPECT_RATIO_H_FLIP:
-            heatmaps_ar_hf = im_detect_keypoints_aspect_ratio(
-                model, im, aspect_ratio, boxes, hflip=True
-            )
-            add_heatmaps_t(heatmaps_ar_hf)
-
-    # Select the heuristic function for combining the heatmaps
-    if cfg.TEST.KPS_AUG.HEUR == 'HM_AVG':
-        np_f = np.mean
-    elif cfg.TEST.KPS_AUG.HEUR == 'HM_MAX':
-        np_f = np.amax
-    else:
+    # Select the heuristic for combining the heatmaps
+    heurs = {'HM_AVG': 'AVG', 'HM_MAX': 'MAX'}
+    if cfg.TEST.KPS_AUG.HEUR not in heurs:
         raise NotImplementedError(
             'Heuristic {} not supported'.format(cfg.TEST.KPS_AUG.HEUR)
         )
+    heatmaps_c = AugReducer(heurs[cfg.TEST.KPS_AUG.HEUR])
 
-    def heur_f(hms_ts):
-        return np_f(hms_ts, axis=0)
-
-    # Combine the heatmaps
     if cfg.TEST.KPS_AUG.SCALE_SIZE_DEP:
-        heatmaps_c = combine_heatmaps_size_dep(
-            heatmaps_ts, ds_ts, us_ts, boxes, heur_f
-        )
-    else:
-        heatmaps_c = heur_f(heatmaps_ts)
-
-    return heatmaps_c
-
-
-def im_detect_keypoints_hflip(model, im, target_scale, target_max_size, boxes):
-    """Computes keypoint predictions on the horizontally flipped image.
-    Function signature is the same as for im_detect_keypoints_aug.
-    """
-    # Compute keypoints for the flipped image
-    im_hf = im[:, ::-1, :]
-    boxes_hf = box_utils.flip_boxes(boxes, im.shape[1])
-
-    blob_conv, im_scale = im_conv_body_only(model, im_hf, target_scale, target_max_size)
-    heatmaps_hf = im_detect_keypoints(model, im_scale, boxes_hf, blob_conv)
-
-    # Invert the predicted keypoints
-    heatmaps_inv = keypoint_utils.flip_heatmaps(heatmaps_hf)
-
-    return heatmaps_inv
-
-
-def im_detect_keypoints_scale(
-    model, im, target_scale, target_max_size, boxes, hflip=False):
-    """Computes keypoint predictions at the given scale."""
-    if hflip:
-        heatmaps_scl = im_detect_keypoints_hflip(
-            model, im, target_scale, target_max_size, boxes
-        )
-    else:
-        blob_conv, im_scale = im_conv_body_only(model, im, target_scale, target_max_size)
-        heatmaps_scl = im_detect_keypoints(model, im_scale, boxes, blob_conv)
-    return heatmaps_scl
-
-
-def im_detect_keypoints_aspect_ratio(
-    model, im, aspect_ratio, boxes, hflip=False):
-    """Detects keypoints at the given width-relative aspect ratio."""
-
-    # Perform keypoint detectionon the transformed image
-    im_ar = image_utils.aspect_ratio_rel(im, aspect_ratio)
-    boxes_ar = box_utils.aspect_ratio(boxes, aspect_ratio)
-
-    if hflip:
-        heatmaps_ar = im_detect_keypoints_hflip(
-            model, im_ar, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, boxes_ar
-        )
-    else:
-        blob_conv, im_scale = im_conv_body_only(
-            model, im_ar, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE
-        )
-        heatmaps_ar = im_detect_keypoints(model, im_scale, boxes_ar, blob_conv)
-
-    return heatmaps_ar
-
-
-def im_detect_parsing(model, im_scale, boxes, blob_conv):
+        # Classify objects into small+medium and large based on their box
+        # areas: downscaling predictions are discarded for the small and
+        # medium objects, upscaling predictions for the large objects
+        areas, _ = box_utils.boxes_area(boxes)
+        l_objs = areas >= cfg.TEST.KPS_AUG.AREA_TH
+        sm_objs = ~l_objs
+
+    # Combine the heatmaps computed under different transformations
+    for transform, heatmaps_t in im_detect_head_aug(
+            model, im, boxes, im_scale, blob_conv, cfg.TEST.KPS_AUG,
+            im_detect_keypoints, keypoint_utils.flip_heatmaps, conv_cache):
+        inds = None
+        if cfg.TEST.KPS_AUG.SCALE_SIZE_DEP:
+            if transform[0] < cfg.TEST.SCALE:
+                inds = l_objs
+            elif transform[0] > cfg.TEST.SCALE:
+                inds = sm_objs
+        heatmaps_c.add(heatmaps_t, inds)
+
+    return heatmaps_c.result()
+
+
+def im_detect_parsing(model, im_scale, boxes, blob_conv, batch_inds=None):
     """Infer instance segmentation masks. This function must be called after
     im_detect_bbox as it assumes that the Caffe2 workspace is already populated
     with the necessary blobs.
@@ -757,7 +936,7 @@ def im_detect_parsing(model, im_scale, boxes, blob_conv):
         pred_parsing = np.zeros((0, M, M), np.float32)
         return pred_parsing
 
-    inputs = {'parsing_rois': _get_rois_blob(boxes, im_scale)}
+    inputs = {'parsing_rois': _get_rois_blob(boxes, im_scale, batch_inds)}
     # Add multi-level rois for FPN
     if cfg.FPN.MULTILEVEL_ROIS:
         _add_multilevel_rois_for_test(inputs, 'parsing_rois')
@@ -772,13 +951,16 @@ def im_detect_parsing(model, im_scale, boxes, blob_conv):
     return pred_parsing
 
 
-def im_detect_parsing_aug(model, im, boxes):
+def im_detect_parsing_aug(model, im, boxes, im_scale, blob_conv, conv_cache=None):
     """Performs parsing detection with test-time augmentations.
 
     Arguments:
         model (DetectionModelHelper): the detection model to use
         im (ndarray): BGR image to test
         boxes (ndarray): R x 4 array of bounding boxes
+        im_scale (list): image blob scales as returned by im_detect_bbox
+        blob_conv (Tensor): base features from the backbone network.
+        conv_cache (ConvBodyCache): base features of the transformed images
 
     Returns:
         parsings (ndarray): R x M x M x k array of class specific soft parsings
@@ -786,131 +968,35 @@ def im_detect_parsing_aug(model, im, boxes):
     assert not cfg.TEST.PARSING_AUG.SCALE_SIZE_DEP, \
         'Size dependent scaling not implemented'
 
-    # Collect parsings computed under different transformations
-    parsings_ts = []
-
-    # Compute parsings for the original image (identity transform)
-    blob_conv, im_scale_i = im_conv_body_only(
-        model, im, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE
-    )
-    parsings_i = im_detect_parsing(model, im_scale_i, boxes, blob_conv)
-    parsings_ts.append(parsings_i)
-
-    # Perform parsing detection on the horizontally flipped image
-    if cfg.TEST.PARSING_AUG.H_FLIP:
-        parsings_hf = im_detect_parsing_hflip(
-            model, im, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, boxes
-        )
-        parsings_ts.append(parsings_hf)
-
-    # Compute detections at different scales
-    for scale in cfg.TEST.PARSING_AUG.SCALES:
-        max_size = cfg.TEST.PARSING_AUG.MAX_SIZE
-        parsings_scl = im_detect_parsing_scale(model, im, scale, max_size, boxes)
-        parsings_ts.append(parsings_scl)
-
-        if cfg.TEST.PARSING_AUG.SCALE_H_FLIP:
-            parsings_scl_hf = im_detect_parsing_scale(
-                model, im, scale, max_size, boxes, hflip=True
-            )
-            parsings_ts.append(parsings_scl_hf)
-
-    # Compute parsings at different aspect ratios
-    for aspect_ratio in cfg.TEST.PARSING_AUG.ASPECT_RATIOS:
-        parsings_ar = im_detect_parsing_aspect_ratio(model, im, aspect_ratio, boxes)
-        parsings_ts.append(parsings_ar)
-
-        if cfg.TEST.PARSING_AUG.ASPECT_RATIO_H_FLIP:
-            parsings_ar_hf = im_detect_parsing_aspect_ratio(
-                model, im, aspect_ratio, boxes, hflip=True
-            )
-            parsings_ts.append(parsings_ar_hf)
-
-    # Combine the predicted soft parsings
-    if cfg.TEST.PARSING_AUG.HEUR == 'SOFT_AVG':
-        parsings_c = np.mean(parsings_ts, axis=0)
-    elif cfg.TEST.PARSING_AUG.HEUR == 'SOFT_MAX':
-        parsings_c = np.amax(parsings_ts, axis=0)
-    elif cfg.TEST.PARSING_AUG.HEUR == 'LOGIT_AVG':
-
-        def logit(y):
-            return -1.0 * np.log((1.0 - y) / np.maximum(y, 1e-20))
-
-        logit_parsings = [logit(y) for y in parsings_ts]
-        logit_parsings = np.mean(logit_parsings, axis=0)
-        parsings_c = 1.0 / (1.0 + np.exp(-logit_parsings))
-    else:
+    # Combine the soft parsings computed under different transformations
+    heurs = {'SOFT_AVG': 'AVG', 'SOFT_MAX': 'MAX', 'LOGIT_AVG': 'LOGIT_AVG'}
+    if cfg.TEST.PARSING_AUG.HEUR not in heurs:
         raise NotImplementedError(
             'Heuristic {} not supported'.format(cfg.TEST.PARSING_AUG.HEUR)
         )
+    parsings_c = AugReducer(heurs[cfg.TEST.PARSING_AUG.HEUR])
+    for _, parsings_t in im_detect_head_aug(
+            model, im, boxes, im_scale, blob_conv, cfg.TEST.PARSING_AUG,
+            im_detect_parsing, flip_parsings, conv_cache):
+        parsings_c.add(parsings_t)
 
-    return parsings_c
-
-
-def im_detect_parsing_hflip(model, im, target_scale, target_max_size, boxes):
-    """Performs parsing detection on the horizontally flipped image.
-    Function signature is the same as for im_detect_parsing_aug.
-    """
-    # Compute the parsings for the flipped image
-    im_hf = im[:, ::-1, :]
-    boxes_hf = box_utils.flip_boxes(boxes, im.shape[1])
-
-    blob_conv, im_scale = im_conv_body_only(
-        model, im_hf, target_scale, target_max_size
-    )
-    parsings_hf = im_detect_parsing(model, im_scale, boxes_hf, blob_conv)
-
-    # Invert the predicted soft parsings
-    parsings_inv = parsings_hf[:, :, ::-1, :]
-    parsings_inv = parsing_utils.flip_left2right_featuremap(parsings_inv)
-
-    return parsings_inv
-
-
-def im_detect_parsing_scale(
-    model, im, target_scale, target_max_size, boxes, hflip=False
-):
-    """Computes parsings at the given scale."""
-    if hflip:
-        parsings_scl = im_detect_parsing_hflip(
-            model, im, target_scale, target_max_size, boxes
-        )
-    else:
-        blob_conv, im_scale = im_conv_body_only(
-            model, im, target_scale, target_max_size
-        )
-        parsings_scl = im_detect_parsing(model, im_scale, boxes, blob_conv)
-    return parsings_scl
-
-
-def im_detect_parsing_aspect_ratio(model, im, aspect_ratio, boxes, hflip=False):
-    """Computes parsing detections at the given width-relative aspect ratio."""
-
-    # Perform parsing detection on the transformed image
-    im_ar = image_utils.aspect_ratio_rel(im, aspect_ratio)
-    boxes_ar = box_utils.aspect_ratio(boxes, aspect_ratio)
+    return parsings_c.result()
 
-    if hflip:
-        parsings_ar = im_detect_parsing_hflip(
-            model, im_ar, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, boxes_ar
-        )
-    else:
-        blob_conv, im_scale = im_conv_body_only(
-            model, im_ar, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE
-        )
-        parsings_ar = im_detect_parsing(model, im_scale, boxes_ar, blob_conv)
 
-    return parsings_ar
+def flip_parsings(parsings):
+    """Inverts the soft parsings predicted on the horizontally flipped image."""
+    parsings_inv = parsings[:, :, ::-1, :]
+    return parsing_utils.flip_left2right_featuremap(parsings_inv)
 
 
-def im_detect_uv(model, im_scale, boxes, blob_conv):
+def im_detect_uv(model, im_scale, boxes, blob_conv, batch_inds=None):
     """Compute uv predictions."""
     M = cfg.PRCNN.RESOLUTION
     if boxes.shape[0] == 0:
         pred_uvs = np.zeros((0, M, M), np.float32)
         return pred_uvs
 
-    inputs = {'uv_rois': _get_rois_blob(boxes, im_scale)}
+    inputs = {'uv_rois': _get_rois_blob(boxes, im_scale, batch_inds)}
     # Add multi-level rois for FPN
     if cfg.FPN.MULTILEVEL_ROIS:
         _add_multilevel_rois_for_test(inputs, 'uv_rois')
@@ -936,164 +1022,86 @@ def im_detect_uv(model, im_scale, boxes, blob_conv):
     return bodys
 
 
-def bodys_append(bodys_ts, bodys_i):
-    for i in xrange(len(bodys_ts)):
-        bodys_ts[i].append(bodys_i[i])
-
-    return bodys_ts
-
-
-def im_detect_uv_aug(model, im, boxes):
-    """Performs parsing detection with test-time augmentations.
+def im_detect_uv_aug(model, im, boxes, im_scale, blob_conv, conv_cache=None):
+    """Performs uv detection with test-time augmentations.
 
     Arguments:
         model (DetectionModelHelper): the detection model to use
         im (ndarray): BGR image to test
         boxes (ndarray): R x 4 array of bounding boxes
+        im_scale (list): image blob scales as returned by im_detect_bbox
+        blob_conv (Tensor): base features from the backbone network.
+        conv_cache (ConvBodyCache): base features of the transformed images
 
     Returns:
-        bodys (list): 
+        bodys (list): the [AnnIndex, Index_UV, U_uv, V_uv] predictions
     """
     assert not cfg.TEST.UV_AUG.SCALE_SIZE_DEP, \
         'Size dependent scaling not implemented'
 
-    # Collect parsings computed under different transformations
-    bodys_ts = [[] for i in xrange(4)]
-
-    # Compute parsings for the original image (identity transform)
-    blob_conv, im_scale_i = im_conv_body_only(
-        model, im, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE
-    )
-    bodys_i = im_detect_uv(model, im_scale_i, boxes, blob_conv)
-    bodys_ts = bodys_append(bodys_ts, bodys_i)
-
-    # Perform parsing detection on the horizontally flipped image
-    if cfg.TEST.UV_AUG.H_FLIP:
-        bodys_hf = im_detect_uv_hflip(
-            model, im, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, boxes
-        )
-        bodys_ts = bodys_append(bodys_ts, bodys_hf)
-
-    # Compute detections at different scales
-    for scale in cfg.TEST.UV_AUG.SCALES:
-        max_size = cfg.TEST.UV_AUG.MAX_SIZE
-        bodys_scl = im_detect_uv_scale(model, im, scale, max_size, boxes)
-        bodys_ts = bodys_append(bodys_ts, bodys_scl)
-
-        if cfg.TEST.UV_AUG.SCALE_H_FLIP:
-            bodys_scl_hf = im_detect_uv_scale(
-                model, im, scale, max_size, boxes, hflip=True
-            )
-            bodys_ts = bodys_append(bodys_ts, bodys_scl_hf)
-
-    # Compute bodys at different aspect ratios
-    for aspect_ratio in cfg.TEST.UV_AUG.ASPECT_RATIOS:
-        bodys_ar = im_detect_uv_aspect_ratio(model, im, aspect_ratio, boxes)
-        bodys_ts = bodys_append(bodys_ts, bodys_ar)
-
-        if cfg.TEST.UV_AUG.ASPECT_RATIO_H_FLIP:
-            bodys_ar_hf = im_detect_uv_aspect_ratio(
-                model, im, aspect_ratio, boxes, hflip=True
-            )
-            bodys_ts = bodys_append(bodys_ts, bodys_ar_hf)
-
-    # Combine the predicted soft bodys
-    bodys_c = []
-    if cfg.TEST.UV_AUG.HEUR == 'SOFT_AVG':
-        for i in xrange(len(bodys_ts)):
-            bodys_c.append(np.mean(bodys_ts[i], axis=0))
-    elif cfg.TEST.UV_AUG.HEUR == 'SOFT_MAX':
-        for i in xrange(len(bodys_ts)):
-            bodys_c.append(np.amax(bodys_ts[i], axis=0))
-    else:
+    # Combine the soft bodys computed under different transformations
+    heurs = {'SOFT_AVG': 'AVG', 'SOFT_MAX': 'MAX'}
+    if cfg.TEST.UV_AUG.HEUR not in heurs:
         raise NotImplementedError(
             'Heuristic {} not supported'.format(cfg.TEST.UV_AUG.HEUR)
         )
-
-    return bodys_c
-
-
-def im_detect_uv_hflip(model, im, target_scale, target_max_size, boxes):
-    """Performs parsing detection on the horizontally flipped image.
-    Function signature is the same as for im_detect_parsing_aug.
-    """
-    # Compute the parsings for the flipped image
-    im_hf = im[:, ::-1, :]
-    boxes_hf = box_utils.flip_boxes(boxes, im.shape[1])
-
-    blob_conv, im_scale = im_conv_body_only(
-        model, im_hf, target_scale, target_max_size
-    )
-    bodys_hf = im_detect_uv(model, im_scale, boxes_hf, blob_conv)
-
-    # Invert the predicted soft uv
-    bodys_inv = []
-    _index = [0,1,2,4,3,6,5,8,7,10,9,12,11,14,13,16,15,18,17,20,19,22,21,24,23]
-    label_index = [0,1,3,2,5,4,7,6,9,8,11,10,13,12,14,15,16,17,18,19,20,21,22,23,24]
-    UV_symmetry_filename = os.path.join(
-        os.path.dirname(__file__), 
-        '../../data/DensePoseData/UV_data/UV_symmetry_transforms.mat'
-    )
-    UV_sym = loadmat(UV_symmetry_filename)
-    
-    for i in xrange(len(bodys_hf)):
-        bodys_hf[i] = bodys_hf[i][:, :, :, ::-1]
-    
-    bodys_inv.append(bodys_hf[0][:, label_index, :, :])
-    bodys_inv.append(bodys_hf[1][:, _index, :, :])
-
-    U_uv, V_uv = bodys_hf[2:]
-    U_sym = np.zeros(U_uv.shape)
-    V_sym = np.zeros(V_uv.shape)
-    U_uv = np.where(U_uv > 1, 1, U_uv)
-    V_uv = np.where(V_uv > 1, 1, V_uv)
+    bodys_c = [AugReducer(heurs[cfg.TEST.UV_AUG.HEUR]) for _ in range(4)]
+    for _, bodys_t in im_detect_head_aug(
+            model, im, boxes, im_scale, blob_conv, cfg.TEST.UV_AUG,
+            im_detect_uv, flip_bodys, conv_cache):
+        for body_c, body_t in zip(bodys_c, bodys_t):
+            body_c.add(body_t)
+
+    return [body_c.result() for body_c in bodys_c]
+
+
+def flip_bodys(bodys_hf):
+    """Inverts the uv predicted on the horizontally flipped image."""
+    bodys_hf = [body[:, :, :, ::-1] for body in bodys_hf]
+    # Swap the left and right labels and parts
+    bodys_inv = [bodys_hf[0][:, _UV_LABEL_FLIP_INDEX], bodys_hf[1][:, _UV_PART_FLIP_INDEX]]
+
+    # Map the (U, V) coordinates of each part to the symmetric part, all parts
+    # and RoIs at once
+    U_transforms, V_transforms = _get_uv_symmetry_transforms()
+    U_uv = np.minimum(bodys_hf[2][:, 1:], 1)
+    V_uv = np.minimum(bodys_hf[3][:, 1:], 1)
     U_loc = (U_uv * 255).astype(np.int64)
     V_loc = (V_uv * 255).astype(np.int64)
-    for i in xrange(1, 25):
-        for j in xrange(len(V_sym)):
-            V_sym[j, i] = UV_sym['V_transforms'][0, i - 1][V_loc[j, i],U_loc[j, i]]
-            U_sym[j, i] = UV_sym['U_transforms'][0, i - 1][V_loc[j, i],U_loc[j, i]]
+    parts = np.arange(U_transforms.shape[0]).reshape(1, -1, 1, 1)
+    U_sym = np.zeros(bodys_hf[2].shape)
+    V_sym = np.zeros(bodys_hf[3].shape)
+    U_sym[:, 1:] = U_transforms[parts, V_loc, U_loc]
+    V_sym[:, 1:] = V_transforms[parts, V_loc, U_loc]
 
-    bodys_inv.append(U_sym[:, _index, :, :])
-    bodys_inv.append(V_sym[:, _index, :, :])
+    bodys_inv.append(U_sym[:, _UV_PART_FLIP_INDEX])
+    bodys_inv.append(V_sym[:, _UV_PART_FLIP_INDEX])
 
     return bodys_inv
 
 
-def im_detect_uv_scale(
-    model, im, target_scale, target_max_size, boxes, hflip=False
-):
-    """Computes parsings at the given scale."""
-    if hflip:
-        bodys_scl = im_detect_uv_hflip(
-            model, im, target_scale, target_max_size, boxes
-        )
-    else:
-        blob_conv, im_scale = im_conv_body_only(
-            model, im, target_scale, target_max_size
-        )
-        bodys_scl = im_detect_uv(model, im_scale, boxes, blob_conv)
-    return bodys_scl
-
-
-def im_detect_uv_aspect_ratio(model, im, aspect_ratio, boxes, hflip=False):
-    """Computes parsing detections at the given width-relative aspect ratio."""
+# Left / right swaps of the uv label and part channels
+_UV_PART_FLIP_INDEX = [0,1,2,4,3,6,5,8,7,10,9,12,11,14,13,16,15,18,17,20,19,22,21,24,23]
+_UV_LABEL_FLIP_INDEX = [0,1,3,2,5,4,7,6,9,8,11,10,13,12,14,15,16,17,18,19,20,21,22,23,24]
+_uv_symmetry_transforms = None
 
-    # Perform parsing detection on the transformed image
-    im_ar = image_utils.aspect_ratio_rel(im, aspect_ratio)
-    boxes_ar = box_utils.aspect_ratio(boxes, aspect_ratio)
 
-    if hflip:
-        bodys_ar = im_detect_uv_hflip(
-            model, im_ar, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, boxes_ar
+def _get_uv_symmetry_transforms():
+    """The 24 x 256 x 256 (U, V) lookup tables mapping the uv coordinates of
+    each part to the ones of its symmetric part, loaded once.
+    """
+    global _uv_symmetry_transforms
+    if _uv_symmetry_transforms is None:
+        UV_symmetry_filename = os.path.join(
+            os.path.dirname(__file__),
+            '../../data/DensePoseData/UV_data/UV_symmetry_transforms.mat'
         )
-    else:
-        blob_conv, im_scale = im_conv_body_only(
-            model, im_ar, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE
+        UV_sym = loadmat(UV_symmetry_filename)
+        _uv_symmetry_transforms = tuple(
+            np.stack([UV_sym[k][0, i] for i in range(UV_sym[k].shape[1])])
+            for k in ('U_transforms', 'V_transforms')
         )
-        bodys_ar = im_detect_uv(model, im_scale, boxes_ar, blob_conv)
-
-    return bodys_ar
+    return _uv_symmetry_transforms
 
 
 def im_detect_fseg(model, im):
@@ -1118,34 +1126,6 @@ def im_detect_fseg(model, im):
     return pred_fseg
 
 
-def combine_heatmaps_size_dep(hms_ts, ds_ts, us_ts, boxes, heur_f):
-    """Combines heatmaps while taking object sizes into account."""
-    assert len(hms_ts) == len(ds_ts) and len(ds_ts) == len(us_ts), \
-        'All sets of hms must be tagged with downscaling and upscaling flags'
-
-    # Classify objects into small+medium and large based on their box areas
-    areas = box_utils.boxes_area(boxes)
-    sm_objs = areas < cfg.TEST.KPS_AUG.AREA_TH
-    l_objs = areas >= cfg.TEST.KPS_AUG.AREA_TH
-
-    # Combine heatmaps computed under different transformations for each object
-    hms_c = np.zeros_like(hms_ts[0])
-
-    for i in range(hms_c.shape[0]):
-        hms_to_combine = []
-        for hms_t, ds_t, us_t in zip(hms_ts, ds_ts, us_ts):
-            # Discard downscaling predictions for small and medium objects
-            if sm_objs[i] and ds_t:
-                continue
-            # Discard upscaling predictions for large objects
-            if l_objs[i] and us_t:
-                continue
-            hms_to_combine.append(hms_t[i])
-        hms_c[i] = heur_f(hms_to_combine)
-
-    return hms_c
-
-
 def box_results_with_nms_and_limit(scores, boxes):  # NOTE: support single-batch
     """Returns bounding-box detection results by thresholding on scores and
     applying non-maximum suppression (NMS).
@@ -1161,10 +1141,51 @@ def box_results_with_nms_and_limit(scores, boxes):  # NOTE: support single-batch
     box at `boxes[i, j * 4:(j + 1) * 4]`.
     """
     num_classes = cfg.MODEL.NUM_CLASSES
-    cls_boxes = [[] for _ in range(num_classes)]
-    # Apply threshold on detection probabilities and apply NMS
+    if cfg.TEST.SOFT_NMS.ENABLED or cfg.TEST.BBOX_VOTE.ENABLED:
+        # Soft NMS and box voting rescore the detections one class at a time
+        dets, classes = _box_results_per_class(scores, boxes)
+    else:
+        dets, classes = _box_results_batched(scores, boxes)
+
+    # Limit to max_per_image detections **over all classes**
+    if 0 < cfg.TEST.DETECTIONS_PER_IM < len(dets):
+        image_thresh = np.sort(dets[:, -1])[-cfg.TEST.DETECTIONS_PER_IM]
+        keep = np.where(dets[:, -1] >= image_thresh)[0]
+        dets = dets[keep, :]
+        classes = classes[keep]
+
+    # The detections are grouped by class
+    starts = np.searchsorted(classes, np.arange(1, num_classes + 1))
+    cls_boxes = [[]] + [dets[starts[j - 1]:starts[j], :] for j in range(1, num_classes)]
+    boxes = dets[:, :-1]
+    scores = dets[:, -1]
+    return scores, boxes, cls_boxes
+
+
+def _box_results_batched(scores, boxes):
+    """Threshold the detections of all classes and apply NMS to all of them at
+    once. Return the kept detections (N, 5), grouped by class (in the order of
+    the per class NMS), and their classes.
+    """
+    # Apply threshold on detection probabilities
     # Skip j = 0, because it's the background class
-    for j in range(1, num_classes):
+    inds, classes = np.where(scores[:, 1:] > cfg.TEST.SCORE_THRESH)
+    classes += 1
+    boxes = boxes.reshape(boxes.shape[0], -1, 4)[inds, classes]
+    dets = np.hstack(
+        (boxes, scores[inds, classes][:, np.newaxis])).astype(np.float32, copy=False)
+    keep = box_utils.batched_nms(dets, classes, cfg.TEST.NMS)
+    keep = keep[np.argsort(classes[keep], kind='mergesort')]
+    return dets[keep, :], classes[keep]
+
+
+def _box_results_per_class(scores, boxes):
+    """_box_results_batched with soft NMS and / or box voting, one class at
+    a time.
+    """
+    cls_dets = []
+    classes = []
+    for j in range(1, cfg.MODEL.NUM_CLASSES):
         inds = np.where(scores[:, j] > cfg.TEST.SCORE_THRESH)[0]
         scores_j = scores[inds, j]
         boxes_j = boxes[inds, j * 4:(j + 1) * 4]
@@ -1188,79 +1209,68 @@ def box_results_with_nms_and_limit(scores, boxes):  # NOTE: support single-batch
                 cfg.TEST.BBOX_VOTE.VOTE_TH,
                 scoring_method=cfg.TEST.BBOX_VOTE.SCORING_METHOD
             )
-        cls_boxes[j] = nms_dets
+        cls_dets.append(nms_dets.astype(np.float32, copy=False))
+        classes.append(np.full(len(nms_dets), j, dtype=np.int64))
+    return np.vstack(cls_dets), np.hstack(classes)
 
-    # Limit to max_per_image detections **over all classes**
-    if cfg.TEST.DETECTIONS_PER_IM > 0:
-        image_scores = np.hstack(
-            [cls_boxes[j][:, -1] for j in range(1, num_classes)]
-        )
-        if len(image_scores) > cfg.TEST.DETECTIONS_PER_IM:
-            image_thresh = np.sort(image_scores)[-cfg.TEST.DETECTIONS_PER_IM]
-            for j in range(1, num_classes):
-                keep = np.where(cls_boxes[j][:, -1] >= image_thresh)[0]
-                cls_boxes[j] = cls_boxes[j][keep, :]
-
-    im_results = np.vstack([cls_boxes[j] for j in range(1, num_classes)])
-    boxes = im_results[:, :-1]
-    scores = im_results[:, -1]
-    return scores, boxes, cls_boxes
+
+def select_head_inds(scores, min_score=0., max_instances=0):
+    """Return the (sorted) indices of the detections a RoI head runs on: those
+    scoring at least min_score and, with max_instances > 0, at most the
+    max_instances highest scoring of them.
+    """
+    inds = np.where(scores >= min_score)[0]
+    if 0 < max_instances < len(inds):
+        order = np.argsort(-scores[inds], kind='mergesort')
+        inds = np.sort(inds[order[:max_instances]])
+    return inds
+
+
+def _select_head_inds_batch(scores_b, min_score, max_instances):
+    """select_head_inds for each image of a minibatch. Return the indices
+    within each image, the indices into the detections of all images stacked
+    and the split points of the head outputs between images.
+    """
+    inds_b = [select_head_inds(scores_i, min_score, max_instances) for scores_i in scores_b]
+    offsets = np.cumsum([0] + [len(scores_i) for scores_i in scores_b])
+    inds = np.hstack([inds_i + offset for inds_i, offset in zip(inds_b, offsets)] +
+                     [np.zeros(0, np.int64)]).astype(np.int64)
+    split = np.cumsum([len(inds_i) for inds_i in inds_b])[:-1]
+    return inds_b, inds, split
 
 
 def segm_results(cls_boxes, masks, ref_boxes, im_h, im_w):
     num_classes = cfg.MODEL.NUM_CLASSES
     cls_segms = [[] for _ in range(num_classes)]
-    mask_ind = 0
-    # To work around an issue with cv2.resize (it seems to automatically pad
-    # with repeated border values), we manually zero-pad the masks by 1 pixel
-    # prior to resizing back to the original image resolution. This prevents
-    # "top hat" artifacts. We therefore need to expand the reference boxes by an
-    # appropriate factor.
+    # The reference implementation zero-pads the masks by 1 pixel prior to
+    # resizing them back to the original image resolution (cv2.resize pads
+    # with repeated border values), to prevent "top hat" artifacts. We
+    # therefore need to expand the reference boxes by an appropriate factor.
     M = cfg.MRCNN.RESOLUTION
     scale = (M + 2.0) / M
     ref_boxes = box_utils.expand_boxes(ref_boxes, scale)
     ref_boxes = ref_boxes.astype(np.int32)
-    padded_mask = np.zeros((M + 2, M + 2), dtype=np.float32)
 
     # skip j = 0, because it's the background class
-    for j in range(1, num_classes):
-        segms = []
-        for _ in range(cls_boxes[j].shape[0]):
-            if cfg.MRCNN.CLS_SPECIFIC_MASK:
-                padded_mask[1:-1, 1:-1] = masks[mask_ind, j, :, :]
-            else:
-                padded_mask[1:-1, 1:-1] = masks[mask_ind, 0, :, :]
-
-            ref_box = ref_boxes[mask_ind, :]
-            w = (ref_box[2] - ref_box[0] + 1)
-            h = (ref_box[3] - ref_box[1] + 1)
-            w = np.maximum(w, 1)
-            h = np.maximum(h, 1)
-
-            mask = cv2.resize(padded_mask, (w, h))
-            mask = np.array(mask > cfg.MRCNN.THRESH_BINARIZE, dtype=np.uint8)
-            im_mask = np.zeros((im_h, im_w), dtype=np.uint8)
-
-            x_0 = max(ref_box[0], 0)
-            x_1 = min(ref_box[2] + 1, im_w)
-            y_0 = max(ref_box[1], 0)
-            y_1 = min(ref_box[3] + 1, im_h)
-
-            im_mask[y_0:y_1, x_0:x_1] = mask[
-                (y_0 - ref_box[1]):(y_1 - ref_box[1]), (x_0 - ref_box[0]):(x_1 - ref_box[0])]
-
-            # Get RLE encoding used by the COCO evaluation API
-            rle = mask_util.encode(np.array(im_mask[:, :, np.newaxis], order='F'))[0]
-            # For dumping to json, need to decode the byte string.
-            # https://github.com/cocodataset/cocoapi/issues/70
-            rle['counts'] = rle['counts'].decode('ascii')
-            segms.append(rle)
-
-            mask_ind += 1
+    nums = [cls_boxes[j].shape[0] for j in range(1, num_classes)]
+    classes = np.repeat(np.arange(1, num_classes), nums)
+    assert classes.shape[0] == masks.shape[0]
+    if cfg.MRCNN.CLS_SPECIFIC_MASK:
+        masks = masks[np.arange(masks.shape[0]), classes]
+    else:
+        masks = masks[:, 0]
 
-        cls_segms[j] = segms
+    # Get RLE encoding used by the COCO evaluation API
+    rles = segm_utils.box_masks_to_rles(
+        paste_masks_in_boxes(masks, ref_boxes, im_h, im_w), im_h, im_w)
+    for rle in rles:
+        # For dumping to json, need to decode the byte string.
+        # https://github.com/cocodataset/cocoapi/issues/70
+        rle['counts'] = rle['counts'].decode('ascii')
 
-    assert mask_ind == masks.shape[0]
+    starts = np.cumsum([0] + nums)
+    for j in range(1, num_classes):
+        cls_segms[j] = rles[starts[j - 1]:starts[j]]
     return cls_segms
 
 
@@ -1289,52 +1299,164 @@ def keypoint_results(cls_boxes, pred_heatmaps, ref_boxes):
     return cls_keyps
 
 
-def parsing_results(parsings, cls_boxes, im_h, im_w):
-    parsings = parsings.transpose((0, 2, 3, 1))
+def parsing_results(parsings, cls_boxes, im_h, im_w, inds=None):
+    """Paste the parsings of the detections into the image. With inds, the
+    parsings are those of the detections cls_boxes[1][inds] only (see
+    select_head_inds); the other detections get an empty parsing, so that
+    cls_parsings[1] stays aligned with cls_boxes[1].
+    """
     num_classes = cfg.MODEL.NUM_CLASSES
     cls_parsings = [[] for _ in range(num_classes)]
     boxes = cls_boxes[1][:, 0:4]
+    if inds is None:
+        inds = np.arange(boxes.shape[0])
     M = cfg.PRCNN.RESOLUTION
-    N = cfg.PRCNN.NUM_PARSING
     scale = (M + 2.0) / M
-    boxes = box_utils.expand_boxes(boxes, scale)
+    boxes = box_utils.expand_boxes(boxes[inds], scale)
     boxes = boxes.astype(np.int32)
-    padded_parsing = np.zeros((M + 2, M + 2, N), dtype=np.float32)
 
-    for i in range(boxes.shape[0]):
-        padded_parsing[1:-1, 1:-1] = parsings[i]
+    # Instances are kept box-local (see parsing_utils.encode_parsing)
+    cls_parsings[1] = [
+        parsing_utils.encode_parsing(np.zeros((0, 0), np.uint8), 0, 0, im_h, im_w)
+        for _ in range(len(cls_boxes[1]))
+    ]
+    pasted = paste_parsings_in_boxes(parsings, boxes, im_h, im_w)
+    for i, (parsing, x_0, y_0) in zip(inds, pasted):
+        cls_parsings[1][i] = parsing_utils.encode_parsing(parsing, x_0, y_0, im_h, im_w)
 
-        box = boxes[i, :]
-        w = box[2] - box[0] + 1
-        h = box[3] - box[1] + 1
-        w = np.maximum(w, 1)
-        h = np.maximum(h, 1)
+    return cls_parsings
 
-        parsing = cv2.resize(padded_parsing, (w, h), interpolation=cv2.INTER_LINEAR)
-        parsing = np.argmax(parsing, axis=2)
-        im_parsing = np.zeros((im_h, im_w), dtype=np.uint8)
 
-        x_0 = max(box[0], 0)
-        x_1 = min(box[2] + 1, im_w)
-        y_0 = max(box[1], 0)
-        y_1 = min(box[3] + 1, im_h)
+# Upper bound on the number of values resampled at once by
+# _resample_in_boxes (R x N x canvas height x canvas width)
+_PASTE_CHUNK_SIZE = 1 << 24
 
-        im_parsing[y_0:y_1, x_0:x_1] = parsing[
-            (y_0 - box[1]):(y_1 - box[1]),
-            (x_0 - box[0]):(x_1 - box[0])
-        ]
 
-        cls_parsings[1].append(im_parsing)
+def paste_parsings_in_boxes(parsings, boxes, im_h, im_w):
+    """Resample the parsing logits of all instances into their boxes and take
+    the per pixel argmax over the parsing classes, only inside each box.
 
-    return cls_parsings
+    This gives the same result as zero padding each M x M map by one pixel,
+    cv2.resize (INTER_LINEAR) to the box size and np.argmax, but resamples many
+    instances at once with torch grid_sample.
 
+    Arguments:
+        parsings (ndarray): R x NUM_PARSING x M x M parsing logits
+        boxes (ndarray): R x 4 integer boxes, already expanded by (M + 2) / M
+        im_h, im_w (int): image size
 
-def uv_results(model, bodys, boxes):
-    AnnIndex, Index_UV, U_uv, V_uv = bodys
-    K = cfg.UVRCNN.NUM_PATCHES + 1
-    outputs = []
+    Returns:
+        list of (label_map, x_0, y_0) with the uint8 label map of the part of
+        each box inside the image and its top left corner in the image
+    """
+    return [
+        (np.argmax(parsing, axis=0).astype(np.uint8), x_0, y_0)
+        for parsing, x_0, y_0 in _resample_in_boxes(parsings, boxes, im_h, im_w)
+    ]
+
+
+def paste_masks_in_boxes(masks, boxes, im_h, im_w):
+    """Resample the soft masks of all instances into their boxes and binarize
+    them (cfg.MRCNN.THRESH_BINARIZE), only inside each box, the same way as
+    paste_parsings_in_boxes.
+
+    Arguments:
+        masks (ndarray): R x M x M soft masks
+        boxes (ndarray): R x 4 integer boxes, already expanded by (M + 2) / M
+        im_h, im_w (int): image size
+
+    Returns:
+        list of (mask, x_0, y_0) with the uint8 mask of the part of each box
+        inside the image and its top left corner in the image
+    """
+    return [
+        ((mask[0] > cfg.MRCNN.THRESH_BINARIZE).astype(np.uint8), x_0, y_0)
+        for mask, x_0, y_0 in _resample_in_boxes(masks[:, np.newaxis], boxes, im_h, im_w)
+    ]
+
+
+def _resample_in_boxes(maps, boxes, im_h, im_w):
+    """Yield the (N x crop_h x crop_w resampled maps, x_0, y_0) of the part of
+    each box inside the image, for R x N x M x M maps zero padded by one pixel
+    and bilinearly resized to their boxes (see paste_parsings_in_boxes).
+    """
+    R, N, M = maps.shape[:3]
+    if R == 0:
+        return
+    # Same one pixel zero border as in the reference (padded) implementation
+    padded = F.pad(torch.from_numpy(np.ascontiguousarray(maps, dtype=np.float32)),
+                   (1, 1, 1, 1))
+    S = M + 2
+
+    w = np.maximum(boxes[:, 2] - boxes[:, 0] + 1, 1)
+    h = np.maximum(boxes[:, 3] - boxes[:, 1] + 1, 1)
+    x_0 = np.maximum(boxes[:, 0], 0)
+    y_0 = np.maximum(boxes[:, 1], 0)
+    crop_w = np.maximum(np.minimum(boxes[:, 2] + 1, im_w) - x_0, 0)
+    crop_h = np.maximum(np.minimum(boxes[:, 3] + 1, im_h) - y_0, 0)
+
+    start = 0
+    while start < R:
+        # Instances of a chunk share a canvas as large as their largest crop
+        end = start + 1
+        canvas_h, canvas_w = max(int(crop_h[start]), 1), max(int(crop_w[start]), 1)
+        while end < R:
+            next_h = max(canvas_h, int(crop_h[end]))
+            next_w = max(canvas_w, int(crop_w[end]))
+            if (end + 1 - start) * N * next_h * next_w > _PASTE_CHUNK_SIZE:
+                break
+            canvas_h, canvas_w = next_h, next_w
+            end += 1
+
+        inds = slice(start, end)
+        # Source pixel of each canvas pixel, with the cv2.resize convention
+        # src = (dst + 0.5) * src_size / dst_size - 0.5, in grid_sample
+        # coordinates (-1 and 1 are the centers of the corner pixels)
+        ys = torch.arange(0, canvas_h).float().view(1, -1) + \
+            torch.from_numpy((y_0[inds] - boxes[inds, 1]).astype(np.float32)).view(-1, 1)
+        xs = torch.arange(0, canvas_w).float().view(1, -1) + \
+            torch.from_numpy((x_0[inds] - boxes[inds, 0]).astype(np.float32)).view(-1, 1)
+        ys = (ys + 0.5) * torch.from_numpy((S / h[inds]).astype(np.float32)).view(-1, 1) - 0.5
+        xs = (xs + 0.5) * torch.from_numpy((S / w[inds]).astype(np.float32)).view(-1, 1) - 0.5
+        ys = ys * (2.0 / (S - 1)) - 1
+        xs = xs * (2.0 / (S - 1)) - 1
+        grid = torch.stack((
+            xs.view(-1, 1, canvas_w).expand(-1, canvas_h, canvas_w),
+            ys.view(-1, canvas_h, 1).expand(-1, canvas_h, canvas_w)
+        ), dim=3)
+        sampled = _grid_sample_border(padded[inds], grid).numpy()
+
+        for k in range(end - start):
+            i = start + k
+            yield sampled[k, :, :crop_h[i], :crop_w[i]], x_0[i], y_0[i]
+        start = end
+
+
+def _grid_sample_border(input, grid):
+    """Bilinear grid_sample with border padding, where -1 and 1 are the centers
+    of the corner pixels (the only behavior of grid_sample before PyTorch 1.3).
+    """
+    try:
+        return F.grid_sample(input, grid, mode='bilinear', padding_mode='border',
+                             align_corners=True)
+    except TypeError:
+        return F.grid_sample(input, grid, mode='bilinear', padding_mode='border')
 
-    for ind, entry in enumerate(boxes):
+
+def uv_results(model, bodys, boxes, inds=None):
+    """UV maps of the detections. With inds, bodys only holds the predictions
+    of boxes[inds] (see select_head_inds); the other detections get an all
+    background UV map.
+    """
+    K = cfg.UVRCNN.NUM_PATCHES + 1
+    outputs = [None] * len(boxes)
+    if inds is None:
+        inds = np.arange(len(boxes))
+    if len(inds) > 0:
+        AnnIndex, Index_UV, U_uv, V_uv = bodys
+
+    for ind, box_ind in enumerate(inds):
+        entry = boxes[box_ind]
         # Compute ref box width and height
         bx = max(entry[2] - entry[0], 1)
         by = max(entry[3] - entry[1], 1)
@@ -1370,7 +1492,13 @@ def uv_results(model, bodys, boxes):
             CurrentV = CurV_uv[part_id]
             output[1, CurIndex_UV==part_id] = CurrentU[CurIndex_UV==part_id]
             output[2, CurIndex_UV==part_id] = CurrentV[CurIndex_UV==part_id]
-        outputs.append(output)
+        outputs[box_ind] = output
+
+    for box_ind, entry in enumerate(boxes):
+        if outputs[box_ind] is None:
+            bx = max(entry[2] - entry[0], 1)
+            by = max(entry[3] - entry[1], 1)
+            outputs[box_ind] = np.zeros([3, int(by), int(bx)], dtype=np.float32)
 
     num_classes = cfg.MODEL.NUM_CLASSES
     cls_uvs = [[] for _ in range(num_classes)]
@@ -1380,18 +1508,23 @@ def uv_results(model, bodys, boxes):
     return cls_uvs
 
         
-def _get_rois_blob(im_rois, im_scale):
+def _get_rois_blob(im_rois, im_scale, batch_inds=None):
     """Converts RoIs into network inputs.
 
     Arguments:
         im_rois (ndarray): R x 4 matrix of RoIs in original image coordinates
         im_scale_factors (list): scale factors as returned by _get_image_blob
+            (or an R x 1 array of per RoI scales for a multi-image minibatch)
+        batch_inds (ndarray): optional index of the image of each RoI within
+            a multi-image minibatch
 
     Returns:
         blob (ndarray): R x 5 matrix of RoIs in the image pyramid with columns
             [level, x1, y1, x2, y2]
     """
     rois, levels = _project_im_rois(im_rois, im_scale)
+    if batch_inds is not None:
+        levels = batch_inds.reshape(-1, 1)
     rois_blob = np.hstack((levels, rois))
     return rois_blob.astype(np.float32, copy=False)
 
@@ -1433,11 +1566,15 @@ def _add_multilevel_rois_for_test(blobs, name):
     )
 
 
-def _get_blobs(im, rois, target_scale, target_max_size):
-    """Convert an image and RoIs within that image into network inputs."""
+def _get_blobs(im, rois, target_scale, target_max_size, im_blob=None):
+    """Convert an image and RoIs within that image into network inputs. A
+    precomputed image blob (as returned by blob_utils.get_image_blob) can be
+    given with im_blob.
+    """
+    if im_blob is None:
+        im_blob = blob_utils.get_image_blob(im, target_scale, target_max_size)
     blobs = {}
-    blobs['data'], im_scale, blobs['im_info'] = \
-        blob_utils.get_image_blob(im, target_scale, target_max_size)
+    blobs['data'], im_scale, blobs['im_info'] = im_blob
     if rois is not None:
         blobs['rois'] = _get_rois_blob(rois, im_scale)
     return blobs, im_scale
@@ -26,25 +26,36 @@ import datetime
 import logging
 import numpy as np
 import os
+import shutil
+import time
 import yaml
 
 import torch
 
 from parsingrcnn.core.config import cfg
+from parsingrcnn.core.quantize import quantize_model_from_cfg
 # from core.rpn_generator import generate_rpn_on_dataset  #TODO: for rpn only case
 # from core.rpn_generator import generate_rpn_on_range
 from parsingrcnn.core.test import im_detect_all
+from parsingrcnn.core.test import im_detect_all_batch
+from parsingrcnn.core.test_tiled import im_detect_all_tiled
 from parsingrcnn.datasets import task_evaluation
 from parsingrcnn.datasets.json_dataset import JsonDataset
 from parsingrcnn.modeling import model_builder
 import parsingrcnn.nn as mynn
 from parsingrcnn.utils.detectron_weight_helper import load_detectron_weight
-import parsingrcnn.utils.env as envu
+import parsingrcnn.utils.blob as blob_utils
 import parsingrcnn.utils.net as net_utils
 import parsingrcnn.utils.parsing as parsing_utils
 import parsingrcnn.utils.subprocess as subprocess_utils
 import parsingrcnn.utils.vis as vis_utils
 from parsingrcnn.utils.io import save_object
+from parsingrcnn.utils.latency import LatencyRecorder
+from parsingrcnn.utils.latency import SampledProfiler
+import parsingrcnn.utils.latency as latency_utils
+from parsingrcnn.utils.prefetch import Prefetcher
+from parsingrcnn.utils.result_store import ResultReader
+from parsingrcnn.utils.result_store import ResultWriter
 from parsingrcnn.utils.timer import Timer
 
 logger = logging.getLogger(__name__)
@@ -87,7 +98,7 @@ def get_inference_dataset(index, is_parent=True):
 def run_inference(
         args, ind_range=None,
         multi_gpu_testing=False, gpu_id=0,
-        check_expected_results=False):
+        check_expected_results=False, shard=None):
     parent_func, child_func = get_eval_functions()
     is_parent = ind_range is None
 
@@ -96,7 +107,9 @@ def run_inference(
             # Parent case:
             # In this case we're either running inference on the entire dataset in a
             # single process or (if multi_gpu_testing is True) using this process to
-            # launch subprocesses that each run inference on a range of the dataset
+            # launch a pool of workers that pull chunks of the dataset. With a shard
+            # (i, N) only the i-th of N parts of each dataset is run and written
+            # to a shard result store, to be evaluated with evaluate_shards
             all_results = {}
             for i in range(len(cfg.TEST.DATASETS)):
                 dataset_name, proposal_file = get_inference_dataset(i)
@@ -106,15 +119,16 @@ def run_inference(
                     dataset_name,
                     proposal_file,
                     output_dir,
-                    multi_gpu=multi_gpu_testing
+                    multi_gpu=multi_gpu_testing,
+                    shard=shard
                 )
                 all_results.update(results)
 
             return all_results
         else:
-            # Subprocess child case:
-            # In this case test_net was called via subprocess.Popen to execute on a
-            # range of inputs on a single dataset
+            # Range case:
+            # In this case test_net executes on a range of inputs on a single
+            # dataset
             dataset_name, proposal_file = get_inference_dataset(0, is_parent=False)
             output_dir = args.output_dir
             return child_func(
@@ -127,7 +141,7 @@ def run_inference(
             )
 
     all_results = result_getter()
-    if check_expected_results and is_parent:
+    if check_expected_results and is_parent and shard is None:
         task_evaluation.check_expected_results(
             all_results,
             atol=cfg.EXPECTED_RESULTS_ATOL,
@@ -144,23 +158,31 @@ def test_net_on_dataset(
         proposal_file,
         output_dir,
         multi_gpu=False,
-        gpu_id=0):
-    """Run inference on a dataset."""
+        gpu_id=0,
+        shard=None):
+    """Run inference on a dataset (or on a shard of it, without evaluating)."""
     dataset = JsonDataset(dataset_name)
     test_timer = Timer()
     test_timer.tic()
     if multi_gpu:
-        num_images = len(dataset.get_roidb())
         all_boxes, all_segms, all_keyps, all_parss, all_uvs = \
             multi_gpu_test_net_on_dataset(
-                args, dataset_name, proposal_file, num_images, output_dir
+                args, dataset_name, proposal_file, dataset.get_roidb(), output_dir,
+                shard=shard
             )
     else:
         all_boxes, all_segms, all_keyps, all_parss, all_uvs = test_net(
-            args, dataset_name, proposal_file, output_dir, gpu_id=gpu_id
+            args, dataset_name, proposal_file, output_dir, gpu_id=gpu_id,
+            shard=shard
         )
     test_timer.toc()
     logger.info('Total inference time: {:.3f}s'.format(test_timer.average_time))
+    if shard is not None:
+        logger.info(
+            'Shard {}/{} of {} done; evaluate all shards with '
+            'tools/merge_shards.py'.format(shard[0], shard[1], dataset_name)
+        )
+        return {}
     results = task_evaluation.evaluate_all(
         dataset, all_boxes, all_segms, all_keyps, 
         all_parss, all_uvs, output_dir
@@ -169,67 +191,153 @@ def test_net_on_dataset(
 
 
 def multi_gpu_test_net_on_dataset(
-        args, dataset_name, proposal_file, num_images, output_dir):
-    """Multi-gpu inference on a dataset."""
-    binary_dir = envu.get_runtime_dir()
-    binary_ext = envu.get_py_bin_ext()
-    binary = os.path.join(binary_dir, args.test_net_file + binary_ext)
-    assert os.path.exists(binary), 'Binary \'{}\' not found'.format(binary)
-
-    # Pass the target dataset and proposal file (if any) via the command line
-    opts = ['TEST.DATASETS', '("{}",)'.format(dataset_name)]
-    if proposal_file:
-        opts += ['TEST.PROPOSAL_FILES', '("{}",)'.format(proposal_file)]
-
-    # Run inference in parallel in subprocesses
-    # Outputs will be a list of outputs from each subprocess, where the output
-    # of each subprocess is the dictionary saved by test_net().
-    outputs = subprocess_utils.process_in_parallel(
-        'detection', num_images, binary, output_dir,
-        args.load_ckpt, args.load_detectron, opts
+        args, dataset_name, proposal_file, roidb, output_dir, shard=None):
+    """Multi-gpu inference on a dataset (or on a shard of it). A pool of workers
+    (one per GPU, or TEST.NUM_WORKERS processes on the CPU) pulls chunks of
+    TEST.WORKER_CHUNK_SIZE images from a shared queue and sends back the
+    results, which are written to a single result store.
+    """
+    total_num_images = len(roidb)
+    if shard is not None:
+        start_ind, end_ind = get_shard_range(shard, total_num_images)
+    else:
+        start_ind, end_ind = 0, total_num_images
+    num_images = end_ind - start_ind
+    det_name = get_det_name(shard=shard)
+    store_dir = os.path.join(output_dir, det_name)
+    meta = get_store_meta(dataset_name, start_ind, end_ind, total_num_images, shard)
+    writer, done_inds = open_result_store(
+        store_dir, meta, getattr(args, 'resume', False)
     )
+    done_inds = [im_idx - start_ind for im_idx in done_inds]
+
+    ims_per_batch = get_test_ims_per_batch()
+    minibatches = [
+        start_ind + inds for inds in get_test_minibatches(
+            roidb[start_ind:end_ind], ims_per_batch, skip_inds=done_inds)
+    ]
+    batches_per_task = max(cfg.TEST.WORKER_CHUNK_SIZE // ims_per_batch, 1)
+    tasks = [
+        minibatches[i:i + batches_per_task]
+        for i in range(0, len(minibatches), batches_per_task)
+    ]
+    devices = subprocess_utils.get_worker_devices(cfg.TEST.NUM_WORKERS)
+
+    # Outputs arrive as the workers finish minibatches, in no particular order
+    outputs = subprocess_utils.process_in_pool(
+        'detection', tasks, _test_net_worker,
+        (args, dataset_name, proposal_file, output_dir), devices
+    )
+    # The workers record the inference stages; the parent the result I/O
+    timers = get_test_timers()
+    num_done = len(done_inds)
+    start_time = time.time()
+    for batch_i, batch_res in enumerate(outputs):
+        with latency_utils.activate(timers), latency_utils.stage('result_io'):
+            for im_idx, im_res in batch_res:
+                writer.add(im_idx, im_res)
+        num_done += len(batch_res)
+        if batch_i % 10 == 0:  # Reduce log file size
+            elapsed = time.time() - start_time
+            new_done = num_done - len(done_inds)
+            eta_seconds = elapsed * (num_images - num_done) / max(new_done, 1)
+            eta = str(datetime.timedelta(seconds=int(eta_seconds)))
+            logger.info(
+                'im_detect: range [{:d}, {:d}] of {:d}: '
+                '{:d}/{:d} {:.3f}s/im (eta: {})'.format(
+                    start_ind + 1, end_ind, total_num_images, num_done,
+                    num_images, elapsed / max(new_done, 1), eta
+                )
+            )
 
-    # Collate the results from each subprocess
-    all_boxes = [[] for _ in range(cfg.MODEL.NUM_CLASSES)]
-    all_segms = [[] for _ in range(cfg.MODEL.NUM_CLASSES)]
-    all_keyps = [[] for _ in range(cfg.MODEL.NUM_CLASSES)]
-    all_parss = [[] for _ in range(cfg.MODEL.NUM_CLASSES)]
-    all_uvs = [[] for _ in range(cfg.MODEL.NUM_CLASSES)]
-    txt_all = []
-    for det_data in outputs:
-        all_boxes_batch = det_data['all_boxes']
-        all_segms_batch = det_data['all_segms']
-        all_keyps_batch = det_data['all_keyps']
-        all_parss_batch = det_data['all_parss']
-        all_uvs_batch = det_data['all_uvs']
-        all_parss_txt = det_data['txt_all']
-        txt_all.extend(all_parss_txt)
-        for cls_idx in range(1, cfg.MODEL.NUM_CLASSES):
-            all_boxes[cls_idx] += all_boxes_batch[cls_idx]
-            all_segms[cls_idx] += all_segms_batch[cls_idx]
-            all_keyps[cls_idx] += all_keyps_batch[cls_idx]
-            all_parss[cls_idx] += all_parss_batch[cls_idx]
-            all_uvs[cls_idx] += all_uvs_batch[cls_idx]
-    det_file = os.path.join(output_dir, 'detections.pkl')
-    cfg_yaml = yaml.dump(cfg)
+    close_result_store(writer, output_dir, det_name)
+    write_latency(timers, output_dir, 'latency_' + det_name)
+    reader = ResultReader(store_dir)
+    if cfg.MODEL.PARSING_ON and shard is None:
+        write_parsing_txt(reader, os.path.join(output_dir, 'results.txt'))
+
+    return reader.get_all_results(
+        cfg.MODEL.NUM_CLASSES, num_images, start_ind)
+
+
+def evaluate_shards(store_dirs, output_dir):
+    """Evaluate the result stores written by the `--shard i/N` runs of a
+    dataset (possibly on different machines) together. The stores are read
+    lazily, one chunk at a time, instead of being merged in memory.
+    """
+    reader = ResultReader(store_dirs)
+    metas = reader.metas
+    for store_dir, meta, complete in zip(store_dirs, metas, reader.complete):
+        assert 'shard' in meta, \
+            '\'{}\' is not the result store of a shard'.format(store_dir)
+        assert complete, \
+            'Shard result store \'{}\' is incomplete (rerun its shard with ' \
+            '--resume)'.format(store_dir)
+        for key in ('dataset', 'num_images'):
+            assert meta[key] == metas[0][key], \
+                'Shards of different runs: {} != {} ({})'.format(
+                    meta[key], metas[0][key], key)
+    num_shards = metas[0]['shard'][1]
+    shard_ids = sorted(meta['shard'][0] for meta in metas)
+    assert shard_ids == list(range(num_shards)) and \
+        all(meta['shard'][1] == num_shards for meta in metas), \
+        'Need each of the {} shards exactly once, got {}'.format(
+            num_shards, [meta['shard'] for meta in metas])
+
+    dataset = JsonDataset(metas[0]['dataset'])
+    num_images = metas[0]['num_images']
+    logger.info('Evaluating {:d} shards of {}: {:d}/{:d} images with results'.format(
+        num_shards, dataset.name, len(reader), num_images))
     if cfg.MODEL.PARSING_ON:
-        txt_file = os.path.join(output_dir, 'results.txt')
-        with open(txt_file ,'w') as f:
-            f.writelines(txt_all)
-            f.close()
-    save_object(
-        dict(
-            all_boxes=all_boxes,
-            all_segms=all_segms,
-            all_keyps=all_keyps,
-            all_parss=all_parss,
-            all_uvs=all_uvs,
-            cfg=cfg_yaml
-        ), det_file
+        write_parsing_txt(reader, os.path.join(output_dir, 'results.txt'))
+        # The parsing evaluation reads the predicted PNGs of all images from
+        # output_dir, while each shard run wrote its own on its own host
+        write_parsing_pngs(reader, dataset.get_roidb(), output_dir)
+    all_boxes, all_segms, all_keyps, all_parss, all_uvs = \
+        reader.get_all_results(cfg.MODEL.NUM_CLASSES, num_images)
+    return task_evaluation.evaluate_all(
+        dataset, all_boxes, all_segms, all_keyps,
+        all_parss, all_uvs, output_dir
     )
-    logger.info('Wrote detections to: {}'.format(os.path.abspath(det_file)))
 
-    return all_boxes, all_segms, all_keyps, all_parss, all_uvs
+
+def _test_net_worker(tasks, args, dataset_name, proposal_file, output_dir):
+    """Inference worker of multi_gpu_test_net_on_dataset: yield the results of
+    the minibatches of every task pulled from the queue.
+    """
+    roidb, dataset, _, _, _ = get_roidb_and_dataset(
+        dataset_name, proposal_file, None
+    )
+    model = initialize_model_from_cfg(args)
+    minibatches = (inds for task in tasks for inds in task)
+    timers = get_test_timers()
+    for _, batch_res in detect_minibatches(
+            model, roidb, dataset, minibatches, get_test_ims_per_batch(),
+            output_dir, timers):
+        yield batch_res
+    write_latency(timers, output_dir, 'latency_worker%d' % os.getpid())
+
+
+def write_parsing_txt(reader, txt_file):
+    """Write the parsing2png summary lines of all images, in image order."""
+    txt_all = {}
+    for im_idx, im_res in reader.iter_results():
+        if im_res['txt'] is not None:
+            txt_all[im_idx] = im_res['txt']
+    with open(txt_file, 'w') as f:
+        f.writelines([txt_all[im_idx] for im_idx in sorted(txt_all)])
+
+
+def write_parsing_pngs(reader, roidb, output_dir):
+    """Rewrite the parsing2png label maps of all images in output_dir from
+    the (box-local) parsings of a result store.
+    """
+    for im_idx, im_res in reader.iter_results():
+        entry = roidb[im_idx]
+        parsing_utils.parsing2png(
+            im_res['boxes'], im_res['parss'], output_dir, entry['image'],
+            (entry['height'], entry['width'])
+        )
 
 
 def test_net(
@@ -238,63 +346,43 @@ def test_net(
         proposal_file,
         output_dir,
         ind_range=None,
-        gpu_id=0):
-    """Run inference on all images in a dataset or over an index range of images
-    in a dataset using a single GPU.
+        gpu_id=0,
+        shard=None):
+    """Run inference on all images in a dataset or over an index range (or
+    shard) of images in a dataset using a single GPU.
     """
     assert not cfg.MODEL.RPN_ONLY, \
         'Use rpn_generate to generate proposals from RPN-only models'
 
     roidb, dataset, start_ind, end_ind, total_num_images = get_roidb_and_dataset(
-        dataset_name, proposal_file, ind_range
+        dataset_name, proposal_file, ind_range, shard=shard
     )
     model = initialize_model_from_cfg(args, gpu_id=gpu_id)
     num_images = len(roidb)
     num_classes = cfg.MODEL.NUM_CLASSES
-    all_boxes, all_segms, all_keyps, all_parss, all_uvs = \
-        empty_results(num_classes, num_images)
-    timers = defaultdict(Timer)
-    txt_all = []
-    for i, entry in enumerate(roidb):
-        if cfg.TEST.PRECOMPUTED_PROPOSALS:
-            # The roidb may contain ground-truth rois (for example, if the roidb
-            # comes from the training or val split). We only want to evaluate
-            # detection on the *non*-ground-truth rois. We select only the rois
-            # that have the gt_classes field set to 0, which means there's no
-            # ground truth.
-            box_proposals = entry['boxes'][entry['gt_classes'] == 0]
-            if len(box_proposals) == 0:
-                continue
-        else:
-            # Faster R-CNN type models generate proposals on-the-fly with an
-            # in-network RPN; 1-stage models don't require proposals.
-            box_proposals = None
-
-        im = cv2.imread(entry['image'])
-        cls_boxes_i, cls_segms_i, cls_keyps_i, cls_parss_i, cls_uvs_i = \
-            im_detect_all(
-                model, im, box_proposals, timers
-            )
-
-        if cfg.MODEL.PARSING_ON:
-            parsings, txt_result = parsing_utils.parsing2png(
-                cls_boxes_i, cls_parss_i, output_dir, entry['image'], im.shape[:2]
-            )
-            txt_all.append(txt_result)
-
-        extend_results(i, all_boxes, cls_boxes_i)
-        if cls_segms_i is not None:
-            extend_results(i, all_segms, cls_segms_i)
-        if cls_keyps_i is not None:
-            extend_results(i, all_keyps, cls_keyps_i)
-        if cls_parss_i is not None:
-            extend_results(i, all_parss, cls_parss_i)
-        if cls_uvs_i is not None:
-            extend_results(i, all_uvs, cls_uvs_i)
-
-        if i % 10 == 0:  # Reduce log file size
+    det_name = get_det_name(ind_range, shard)
+    # Results are written to disk as images complete (see utils.result_store)
+    store_dir = os.path.join(output_dir, det_name)
+    meta = get_store_meta(dataset_name, start_ind, end_ind, total_num_images, shard)
+    writer, done_inds = open_result_store(
+        store_dir, meta, getattr(args, 'resume', False)
+    )
+    done_inds = [im_idx - start_ind for im_idx in done_inds]
+    timers = get_test_timers()
+    ims_per_batch = get_test_ims_per_batch()
+    num_done = len(done_inds)
+    minibatches = get_test_minibatches(roidb, ims_per_batch, skip_inds=done_inds)
+    for batch_i, (inds, batch_res) in enumerate(detect_minibatches(
+            model, roidb, dataset, minibatches, ims_per_batch, output_dir, timers)):
+        with latency_utils.activate(timers), latency_utils.stage('result_io'):
+            for i, im_res in batch_res:
+                writer.add(start_ind + i, im_res)
+        num_done += len(inds)
+
+        if batch_i % 10 == 0:  # Reduce log file size
+            # Timers are ticked once per minibatch
             ave_total_time = np.sum([t.average_time for t in timers.values()])
-            eta_seconds = ave_total_time * (num_images - i - 1)
+            eta_seconds = ave_total_time * (num_images - num_done) / len(inds)
             eta = str(datetime.timedelta(seconds=int(eta_seconds)))
             det_time = (
                 timers['im_detect_bbox'].average_time +
@@ -315,62 +403,254 @@ def test_net(
                     'im_detect: range [{:d}, {:d}] of {:d}: '
                     '{:d}/{:d} {:.3f}s + {:.3f}s (eta: {})'
                 ).format(
-                    start_ind + 1, end_ind, total_num_images, start_ind + i + 1,
+                    start_ind + 1, end_ind, total_num_images, start_ind + num_done,
                     start_ind + num_images, det_time, misc_time, eta
                 )
             )
 
-        if cfg.VIS.ENABLED:
-            if not os.path.exists(os.path.join(output_dir, 'vis')):
-                os.makedirs(os.path.join(output_dir, 'vis'))
-            im_name = os.path.splitext(os.path.basename(entry['image']))[0]
-            vis_im = vis_utils.vis_one_image_opencv(
-                im,
-                cls_boxes_i,
-                segms=cls_segms_i,
-                keypoints=cls_keyps_i,
-                parsing=cls_parss_i,
-                uv=cls_uvs_i,
-                dataset=dataset
-            )
-            cv2.imwrite(os.path.join(output_dir, 'vis', '{}'.format(os.path.basename(im_name) + '.jpg')), vis_im)
-            # vis_utils.vis_one_image(
-            #     im[:, :, ::-1],
-            #     '{:d}_{:s}'.format(i, im_name),
-            #     os.path.join(output_dir, 'vis'),
-            #     cls_boxes_i,
-            #     segms=cls_segms_i,
-            #     keypoints=cls_keyps_i,
-            #     thresh=cfg.VIS_TH,
-            #     box_alpha=0.8,
-            #     dataset=dataset,
-            #     show_class=True
-            # )
+    close_result_store(writer, output_dir, det_name)
+    write_latency(timers, output_dir, 'latency_' + det_name)
+    return ResultReader(store_dir).get_all_results(num_classes, num_images, start_ind)
+
+
+def detect_minibatches(
+        model, roidb, dataset, minibatches, ims_per_batch, output_dir, timers):
+    """Run inference on the given minibatches of roidb indices, decoding and
+    preprocessing the next minibatches while the current one runs. Yield the
+    indices of each minibatch with the list of (roidb index, results) of its
+    images, the results being in the result store format
+    (see utils.result_store). With a LatencyRecorder as timers, the stages
+    are recorded while it runs.
+    """
+    with latency_utils.activate(timers):
+        for batch in _detect_minibatches(
+                model, roidb, dataset, minibatches, ims_per_batch, output_dir, timers):
+            yield batch
+
+
+def _detect_minibatches(
+        model, roidb, dataset, minibatches, ims_per_batch, output_dir, timers):
+    prefetcher = Prefetcher(
+        minibatches,
+        lambda inds: _load_test_minibatch(roidb, inds, ims_per_batch),
+        depth=cfg.TEST.PREFETCH_DEPTH,
+        num_workers=cfg.TEST.PREFETCH_WORKERS
+    )
+    profiler = SampledProfiler(
+        os.path.join(output_dir, 'profile'),
+        every=cfg.TEST.LATENCY.PROFILE_EVERY if cfg.TEST.LATENCY.ENABLED else 0,
+        limit=cfg.TEST.LATENCY.PROFILE_LIMIT
+    )
+    for inds, ims, ims_blob in prefetcher:
+        if ims_per_batch == 1:
+            entry = roidb[inds[0]]
+            if cfg.TEST.PRECOMPUTED_PROPOSALS:
+                # The roidb may contain ground-truth rois (for example, if the roidb
+                # comes from the training or val split). We only want to evaluate
+                # detection on the *non*-ground-truth rois. We select only the rois
+                # that have the gt_classes field set to 0, which means there's no
+                # ground truth.
+                box_proposals = entry['boxes'][entry['gt_classes'] == 0]
+                if len(box_proposals) == 0:
+                    continue
+            else:
+                # Faster R-CNN type models generate proposals on-the-fly with an
+                # in-network RPN; 1-stage models don't require proposals.
+                box_proposals = None
+
+            with profiler.profile('im_{:d}'.format(int(inds[0]))):
+                if cfg.TEST.TILING.ENABLED:
+                    ims_res = [im_detect_all_tiled(model, ims[0], timers, ims_blob)]
+                else:
+                    ims_res = [im_detect_all(model, ims[0], box_proposals, timers, ims_blob)]
+        else:
+            with profiler.profile('im_{:d}'.format(int(inds[0]))):
+                ims_res = im_detect_all_batch(model, ims, timers, ims_blob)
+
+        batch_res = []
+        for i, im, im_res in zip(inds, ims, ims_res):
+            entry = roidb[i]
+            cls_boxes_i, cls_segms_i, cls_keyps_i, cls_parss_i, cls_uvs_i = im_res
+
+            txt_result = None
+            if cfg.MODEL.PARSING_ON:
+                with latency_utils.stage('parsing2png'):
+                    parsings, txt_result = parsing_utils.parsing2png(
+                        cls_boxes_i, cls_parss_i, output_dir, entry['image'], im.shape[:2]
+                    )
+
+            batch_res.append((int(i), dict(
+                boxes=cls_boxes_i, segms=cls_segms_i, keyps=cls_keyps_i,
+                parss=cls_parss_i, uvs=cls_uvs_i, txt=txt_result
+            )))
+
+            if cfg.VIS.ENABLED:
+                if not os.path.exists(os.path.join(output_dir, 'vis')):
+                    os.makedirs(os.path.join(output_dir, 'vis'))
+                im_name = os.path.splitext(os.path.basename(entry['image']))[0]
+                with latency_utils.stage('vis'):
+                    vis_im = vis_utils.vis_one_image_opencv(
+                        im,
+                        cls_boxes_i,
+                        segms=cls_segms_i,
+                        keypoints=cls_keyps_i,
+                        parsing=cls_parss_i,
+                        uv=cls_uvs_i,
+                        dataset=dataset
+                    )
+                    cv2.imwrite(os.path.join(output_dir, 'vis', '{}'.format(os.path.basename(im_name) + '.jpg')), vis_im)
+                # vis_utils.vis_one_image(
+                #     im[:, :, ::-1],
+                #     '{:d}_{:s}'.format(i, im_name),
+                #     os.path.join(output_dir, 'vis'),
+                #     cls_boxes_i,
+                #     segms=cls_segms_i,
+                #     keypoints=cls_keyps_i,
+                #     thresh=cfg.VIS_TH,
+                #     box_alpha=0.8,
+                #     dataset=dataset,
+                #     show_class=True
+                # )
+
+        yield inds, batch_res
+
+    prefetch_stats = prefetcher.stats()
+    logger.info(
+        'Prefetch: {:d} minibatches, mean queue depth {:.2f} (max {:d}), '
+        'stalled {:d} times for {:.3f}s'.format(
+            prefetch_stats['num_fetched'], prefetch_stats['mean_depth'],
+            prefetch_stats['max_depth'], prefetch_stats['num_stalls'],
+            prefetch_stats['stall_time']
+        )
+    )
+
+
+def open_result_store(store_dir, meta, resume=False):
+    """Open the result store of a test run for writing. Without resume any
+    previous store is cleared; with resume it is appended to. Return the
+    writer and the (absolute) indices of the images already done.
+    """
+    if os.path.exists(store_dir) and not resume:
+        shutil.rmtree(store_dir)
+    writer = ResultWriter(
+        store_dir, chunk_size=cfg.TEST.RESULTS_CHUNK_SIZE, meta=meta
+    )
+    done_inds = []
+    if resume:
+        assert writer.meta == meta, \
+            'Result store \'{}\' was written for {}, not {}'.format(
+                store_dir, writer.meta, meta)
+        done_inds = sorted(writer.completed_images())
+        logger.info(
+            'Resuming: {:d}/{:d} images already done'.format(
+                len(done_inds), meta['end'] - meta['start'])
+        )
+    return writer, done_inds
+
 
+def close_result_store(writer, output_dir, det_name):
+    """Flush a result store, mark it complete and write the pickle pointing
+    to it.
+    """
+    writer.close()
+    writer.mark_complete()
     cfg_yaml = yaml.dump(cfg)
-    if ind_range is not None:
-        det_name = 'detection_range_%s_%s.pkl' % tuple(ind_range)
-    else:
-        det_name = 'detections.pkl'
-    det_file = os.path.join(output_dir, det_name)
+    det_file = os.path.join(output_dir, det_name + '.pkl')
     save_object(
         dict(
-            all_boxes=all_boxes,
-            all_segms=all_segms,
-            all_keyps=all_keyps,
-            all_parss=all_parss,
-            all_uvs=all_uvs,
-            txt_all=txt_all,
+            store_dir=os.path.abspath(writer.store_dir),
             cfg=cfg_yaml
         ), det_file
     )
-    logger.info('Wrote detections to: {}'.format(os.path.abspath(det_file)))
-    return all_boxes, all_segms, all_keyps, all_parss, all_uvs
+    logger.info('Wrote detections to: {}'.format(os.path.abspath(writer.store_dir)))
+
+
+def get_test_ims_per_batch():
+    """Number of images per test minibatch. Configurations that the batched
+    path does not support fall back to one image at a time.
+    """
+    ims_per_batch = max(cfg.TEST.IMS_PER_BATCH, 1)
+    if ims_per_batch > 1 and not batched_inference_supported():
+        logger.warning(
+            'TEST.IMS_PER_BATCH > 1 needs in-network proposals, no '
+            'test-time augmentation and no tiling; testing one image at a time')
+        ims_per_batch = 1
+    return ims_per_batch
+
+
+def batched_inference_supported():
+    """Whether im_detect_all_batch supports the configuration."""
+    aug_enabled = (
+        cfg.TEST.BBOX_AUG.ENABLED or cfg.TEST.MASK_AUG.ENABLED or
+        cfg.TEST.KPS_AUG.ENABLED or cfg.TEST.PARSING_AUG.ENABLED or
+        cfg.TEST.UV_AUG.ENABLED
+    )
+    return not (
+        cfg.TEST.PRECOMPUTED_PROPOSALS or cfg.RETINANET.RETINANET_ON or aug_enabled or
+        cfg.TEST.TILING.ENABLED
+    )
+
+
+def get_test_minibatches(roidb, ims_per_batch, skip_inds=()):
+    """Split the roidb into lists of indices of at most ims_per_batch images,
+    leaving out skip_inds. With TEST.ASPECT_GROUPING images of similar aspect
+    ratio go together, which reduces the padding of the minibatch blob.
+    """
+    inds = np.arange(len(roidb))
+    if ims_per_batch > 1 and cfg.TEST.ASPECT_GROUPING:
+        ratios = np.array(
+            [float(entry['width']) / entry['height'] for entry in roidb]
+        )
+        inds = inds[np.argsort(ratios, kind='mergesort')]
+    if len(skip_inds) > 0:
+        inds = inds[~np.in1d(inds, skip_inds)]
+    return [inds[i:i + ims_per_batch] for i in range(0, len(inds), ims_per_batch)]
 
 
-def initialize_model_from_cfg(args, gpu_id=0):
+def _load_test_minibatch(roidb, inds, ims_per_batch):
+    """Decode the images of a test minibatch and build their input blob (runs
+    in the prefetch threads).
+    """
+    with latency_utils.stage('decode'):
+        ims = [cv2.imread(roidb[i]['image']) for i in inds]
+    with latency_utils.stage('preprocess'):
+        if ims_per_batch > 1:
+            ims_blob = blob_utils.get_image_list_blob(
+                ims, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE)
+        elif cfg.TEST.BBOX_AUG.ENABLED or cfg.RETINANET.RETINANET_ON:
+            # Input blobs are built by the augmentation / RetinaNet code
+            ims_blob = None
+        else:
+            ims_blob = blob_utils.get_image_blob(
+                ims[0], cfg.TEST.SCALE, cfg.TEST.MAX_SIZE)
+    return inds, ims, ims_blob
+
+
+def get_test_timers():
+    """Timers of a test run: a LatencyRecorder with TEST.LATENCY.ENABLED, plain
+    Timers otherwise.
+    """
+    if cfg.TEST.LATENCY.ENABLED:
+        return LatencyRecorder(
+            cuda_sync=cfg.TEST.LATENCY.CUDA_SYNC and cfg.DEVICE == 'cuda')
+    return defaultdict(Timer)
+
+
+def write_latency(timers, output_dir, name):
+    """Log the per-stage latencies of a test run and write them to
+    {name}.json / .csv in output_dir (with TEST.LATENCY.ENABLED).
+    """
+    if not isinstance(timers, LatencyRecorder) or not timers.samples:
+        return
+    logger.info('Stage latencies (ms):\n' + timers.format_summary())
+    json_file, csv_file = timers.write(output_dir, name)
+    logger.info('Wrote stage latencies to: {} and {}'.format(json_file, csv_file))
+
+
+def initialize_model_from_cfg(args, gpu_id=0, quantize=True):
     """Initialize a model from the global cfg. Loads test-time weights and
-    set to evaluation mode.
+    set to evaluation mode. With quantize, the RoI heads are quantized
+    according to cfg.TEST.QUANTIZE.
     """
     if cfg.RETINANET.RETINANET_ON:
         model = model_builder.RetinaNet()
@@ -391,14 +671,49 @@ def initialize_model_from_cfg(args, gpu_id=0):
         logger.info("loading detectron weights %s", args.load_detectron)
         load_detectron_weight(model, args.load_detectron)
 
-    model = mynn.DataParallel(model, cpu_keywords=['im_info', 'roidb'], minibatch=True)
+    # An empty device list keeps the model on the CPU (cfg.DEVICE == 'cpu')
+    model = mynn.DataParallel(
+        model, device_ids=None if args.cuda else [],
+        cpu_keywords=['im_info', 'roidb'], minibatch=True
+    )
+    if quantize:
+        model = quantize_model_from_cfg(model)
 
     return model
 
 
-def get_roidb_and_dataset(dataset_name, proposal_file, ind_range):
+def get_det_name(ind_range=None, shard=None):
+    """Name of the result store (and pickle) of a test run."""
+    if shard is not None:
+        return 'detection_shard_%s_of_%s' % tuple(shard)
+    if ind_range is not None:
+        return 'detection_range_%s_%s' % tuple(ind_range)
+    return 'detections'
+
+
+def get_store_meta(dataset_name, start, end, num_images, shard=None):
+    """Metadata identifying the images of a result store."""
+    meta = dict(dataset=dataset_name, start=start, end=end,
+                num_images=num_images)
+    if shard is not None:
+        meta['shard'] = list(shard)
+    return meta
+
+
+def get_shard_range(shard, num_images):
+    """Return the index range [start, end) of shard (i, N) of a dataset of
+    num_images images: the i-th of N contiguous parts of (almost) equal size.
+    It only depends on i, N and num_images, so every machine agrees on it.
+    """
+    i, num_shards = shard
+    assert 0 <= i < num_shards, 'Invalid shard {}/{}'.format(i, num_shards)
+    return num_images * i // num_shards, num_images * (i + 1) // num_shards
+
+
+def get_roidb_and_dataset(dataset_name, proposal_file, ind_range, shard=None):
     """Get the roidb for the dataset specified in the global cfg. Optionally
-    restrict it to a range of indices if ind_range is a pair of integers.
+    restrict it to a range of indices if ind_range is a pair of integers, or to
+    a shard if shard is a pair (i, N).
     """
     dataset = JsonDataset(dataset_name)
     if cfg.TEST.PRECOMPUTED_PROPOSALS:
@@ -410,6 +725,8 @@ def get_roidb_and_dataset(dataset_name, proposal_file, ind_range):
     else:
         roidb = dataset.get_roidb()
 
+    if shard is not None:
+        ind_range = get_shard_range(shard, len(roidb))
     if ind_range is not None:
         total_num_images = len(roidb)
         start, end = ind_range
@@ -170,10 +170,10 @@ def im_detect_bbox(model, im, timers=None):
     # Combine predictions across all levels and retain the top scoring by class
     timers['misc_bbox'].tic()
     detections = []
-    for cls, boxes in boxes_all.items():
-        cls_dets = np.vstack(boxes).astype(dtype=np.float32)
-        # do class specific nms here
-        if cfg.TEST.SOFT_NMS.ENABLED:
+    if cfg.TEST.SOFT_NMS.ENABLED:
+        for cls, boxes in boxes_all.items():
+            cls_dets = np.vstack(boxes).astype(dtype=np.float32)
+            # do class specific nms here
             cls_dets, keep = box_utils.soft_nms(
                 cls_dets,
                 sigma=cfg.TEST.SOFT_NMS.SIGMA,
@@ -181,12 +181,18 @@ def im_detect_bbox(model, im, timers=None):
                 score_thresh=0.0001,
                 method=cfg.TEST.SOFT_NMS.METHOD
             )
-        else:
-            keep = box_utils.nms(cls_dets, cfg.TEST.NMS)
-            cls_dets = cls_dets[keep, :]
+            out = np.zeros((len(keep), 6))
+            out[:, 0:5] = cls_dets
+            out[:, 5].fill(cls)
+            detections.append(out)
+    elif len(boxes_all):
+        # class specific nms of all the classes at once
+        classes = np.hstack([np.full(len(boxes), cls) for cls, boxes in boxes_all.items()])
+        dets = np.vstack([np.vstack(boxes) for boxes in boxes_all.values()]).astype(np.float32)
+        keep = box_utils.batched_nms(dets, classes, cfg.TEST.NMS)
         out = np.zeros((len(keep), 6))
-        out[:, 0:5] = cls_dets
-        out[:, 5].fill(cls)
+        out[:, 0:5] = dets[keep, :]
+        out[:, 5] = classes[keep]
         detections.append(out)
 
     # detections (N, 6) format:
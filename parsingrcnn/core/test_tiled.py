@@ -0,0 +1,210 @@
+"""Tiled inference for large images.
+
+Instead of downscaling the whole image to TEST.SCALE / TEST.MAX_SIZE, the
+image is cut into overlapping TEST.TILING.TILE_SIZE tiles that run through
+im_detect_all one at a time at their native resolution, so the peak memory
+only depends on the tile size. With TEST.TILING.FULL_IMAGE the downscaled
+image runs too, for the instances larger than a tile.
+
+The detections of all passes are moved to image coordinates and merged by
+per class NMS (TEST.TILING.NMS). Detections cut by a tile seam (touching a tile
+border that is not an image border) rank after the others, so that the copy of
+an instance seen whole in a neighboring tile (or in the full image) is kept.
+Box-local parsings (see parsing_utils.encode_parsing) only need their offset
+moved; masks are pasted into the image and re-encoded, keypoints shifted.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+import numpy as np
+import pycocotools.mask as mask_util
+
+from parsingrcnn.core.config import cfg
+from parsingrcnn.core.test import im_detect_all
+import parsingrcnn.utils.blob as blob_utils
+import parsingrcnn.utils.boxes as box_utils
+import parsingrcnn.utils.latency as latency_utils
+import parsingrcnn.utils.parsing as parsing_utils
+from parsingrcnn.utils.timer import Timer
+
+
+def get_tiles(im_h, im_w, tile_size, overlap):
+    """Return the (x_0, y_0, x_1, y_1) windows (x_1, y_1 exclusive) of the
+    overlapping tiles covering an image. Neighboring tiles overlap by at least
+    `overlap` pixels; the last tile of each row / column ends at the image
+    border.
+    """
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        stride = max(tile_size - overlap, 1)
+        s = list(range(0, length - tile_size, stride))
+        return s + [length - tile_size]
+
+    return [
+        (x_0, y_0, min(x_0 + tile_size, im_w), min(y_0 + tile_size, im_h))
+        for y_0 in starts(im_h) for x_0 in starts(im_w)
+    ]
+
+
+def im_detect_all_tiled(model, im, timers=None, im_blob=None):
+    """Tiled version of im_detect_all, returning results in the same format.
+
+    Arguments:
+        model: the network module
+        im (ndarray): color image in BGR order
+        timers: record the cost of time for different steps
+        im_blob: optional (blob, im_scale, im_info) of the full image at the
+            test scale, for the full image pass (e.g. prefetched)
+    """
+    if timers is None:
+        timers = defaultdict(Timer)
+    assert not cfg.TEST.PRECOMPUTED_PROPOSALS, \
+        'Tiled inference needs in-network proposals'
+    im_h, im_w = im.shape[:2]
+    tile_size = cfg.TEST.TILING.TILE_SIZE
+    tiles = get_tiles(im_h, im_w, tile_size, cfg.TEST.TILING.OVERLAP)
+    if len(tiles) == 1:
+        return im_detect_all(model, im, None, timers, im_blob)
+
+    passes = []
+    if cfg.TEST.TILING.FULL_IMAGE:
+        with latency_utils.stage('full_image'):
+            res = im_detect_all(model, im, None, timers, im_blob)
+        passes.append(((0, 0, im_w, im_h), res))
+    for x_0, y_0, x_1, y_1 in tiles:
+        tile = im[y_0:y_1, x_0:x_1]
+        # Native resolution: the shorter side is the target scale
+        tile_h, tile_w = tile.shape[:2]
+        with latency_utils.stage('tile'):
+            tile_blob = blob_utils.get_image_blob(
+                tile, min(tile_h, tile_w), max(tile_h, tile_w))
+            res = im_detect_all(model, tile, None, timers, tile_blob)
+        passes.append(((x_0, y_0, x_1, y_1), res))
+
+    timers['misc_tiling'].tic()
+    results = merge_tile_results(passes, im_h, im_w)
+    timers['misc_tiling'].toc()
+    return results
+
+
+def merge_tile_results(passes, im_h, im_w):
+    """Merge the im_detect_all results of the windows (x_0, y_0, x_1, y_1) of
+    an image into results for the whole image.
+    """
+    num_classes = cfg.MODEL.NUM_CLASSES
+    merged = [[[] for _ in range(num_classes)] for _ in range(5)]
+    cls_boxes = merged[0]
+    has_result = [False] * 5
+
+    for j in range(1, num_classes):
+        dets = []
+        # Rank of each detection: cut by a seam or not
+        cut = []
+        others = [[] for _ in range(4)]
+        for window, res in passes:
+            boxes_j = res[0][j]
+            if len(boxes_j) == 0:
+                continue
+            x_0, y_0 = window[:2]
+            boxes_j = boxes_j.copy()
+            boxes_j[:, 0:4] += np.array([x_0, y_0, x_0, y_0], dtype=boxes_j.dtype)
+            dets.append(boxes_j)
+            cut.append(_cut_by_seam(boxes_j, window, im_h, im_w))
+            for k, cls_res in enumerate(res[1:]):
+                if cls_res is None:
+                    continue
+                has_result[k + 1] = True
+                others[k].extend(
+                    _to_image(k, cls_res[j], window, im_h, im_w) if len(cls_res[j]) else [])
+
+        if len(dets) == 0:
+            cls_boxes[j] = np.zeros((0, 5), dtype=np.float32)
+            continue
+        dets = np.vstack(dets).astype(np.float32, copy=False)
+        cut = np.hstack(cut)
+        # Detections cut by a seam lose to whole ones in the NMS
+        ranked = dets.copy()
+        ranked[:, 4] -= cut.astype(np.float32) * 2.
+        keep = box_utils.nms(ranked, cfg.TEST.TILING.NMS)
+        keep = np.array(keep, dtype=np.int64)
+        keep = keep[np.argsort(-dets[keep, 4], kind='mergesort')]
+        cls_boxes[j] = dets[keep]
+        for k in range(4):
+            if len(others[k]) == len(dets):
+                merged[k + 1][j] = [others[k][i] for i in keep]
+
+    # Limit to max_per_image detections **over all classes**
+    if cfg.TEST.DETECTIONS_PER_IM > 0:
+        image_scores = np.hstack([cls_boxes[j][:, -1] for j in range(1, num_classes)])
+        if len(image_scores) > cfg.TEST.DETECTIONS_PER_IM:
+            image_thresh = np.sort(image_scores)[-cfg.TEST.DETECTIONS_PER_IM]
+            for j in range(1, num_classes):
+                keep = np.where(cls_boxes[j][:, -1] >= image_thresh)[0]
+                cls_boxes[j] = cls_boxes[j][keep, :]
+                for k in range(1, 5):
+                    if len(merged[k][j]):
+                        merged[k][j] = [merged[k][j][i] for i in keep]
+
+    return tuple(
+        merged[k] if k == 0 or has_result[k] else None for k in range(5)
+    )
+
+
+def _cut_by_seam(boxes, window, im_h, im_w, margin=2):
+    """Whether each box (in image coordinates) touches a border of its window
+    that is not a border of the image.
+    """
+    x_0, y_0, x_1, y_1 = window
+    cut = np.zeros(len(boxes), dtype=bool)
+    if x_0 > 0:
+        cut |= boxes[:, 0] <= x_0 + margin
+    if y_0 > 0:
+        cut |= boxes[:, 1] <= y_0 + margin
+    if x_1 < im_w:
+        cut |= boxes[:, 2] >= x_1 - 1 - margin
+    if y_1 < im_h:
+        cut |= boxes[:, 3] >= y_1 - 1 - margin
+    return cut
+
+
+def _to_image(kind, cls_res, window, im_h, im_w):
+    """Move the per instance results of a window to image coordinates. kind
+    is 0 for masks, 1 for keypoints, 2 for parsings and 3 for uvs.
+    """
+    x_0, y_0, x_1, y_1 = window
+    if kind == 0:
+        segms = []
+        for rle in cls_res:
+            if x_0 == 0 and y_0 == 0 and (x_1, y_1) == (im_w, im_h):
+                segms.append(rle)
+                continue
+            rle = dict(rle, counts=rle['counts'].encode('ascii'))
+            im_mask = np.zeros((im_h, im_w), dtype=np.uint8)
+            im_mask[y_0:y_1, x_0:x_1] = mask_util.decode(rle)
+            rle = mask_util.encode(np.array(im_mask[:, :, np.newaxis], order='F'))[0]
+            rle['counts'] = rle['counts'].decode('ascii')
+            segms.append(rle)
+        return segms
+    if kind == 1:
+        keyps = []
+        for kps in cls_res:
+            kps = kps.copy()
+            kps[0] += x_0
+            kps[1] += y_0
+            keyps.append(kps)
+        return keyps
+    if kind == 2:
+        parsings = []
+        for parsing in cls_res:
+            crop, p_x_0, p_y_0 = parsing_utils.parsing_crop(parsing)
+            parsings.append(parsing_utils.encode_parsing(
+                crop, p_x_0 + x_0, p_y_0 + y_0, im_h, im_w))
+        return parsings
+    # UV maps are relative to their box
+    return list(cls_res)
@@ -0,0 +1,175 @@
+"""Inference on video streams.
+
+Consecutive frames of a video mostly show the same instances at about the same
+place, so the full detection (RPN, box head and NMS) only runs on keyframes,
+every TEST.VIDEO.KEYFRAME_INTERVAL frames. The frames in between run the conv
+body (the heads need the features of the frame itself) and the RoI heads
+(mask, keypoint, parsing, uv) on the boxes of the last keyframe, moved with the
+per frame velocity of the boxes matched between the last two keyframes.
+
+With TEST.VIDEO.ADAPTIVE, the keyframe interval follows the detection change
+between consecutive keyframes: it is halved when many detections appear or
+disappear, and grows back by one frame at a time while the scene is stable.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+import numpy as np
+
+from parsingrcnn.core.config import cfg
+from parsingrcnn.core.test import im_conv_body_only, im_detect_all, im_detect_heads
+import parsingrcnn.utils.boxes as box_utils
+import parsingrcnn.utils.latency as latency_utils
+from parsingrcnn.utils.timer import Timer
+
+
+def detect_video(model, frames, timers=None):
+    """Yield the (results, is_keyframe) of each frame of an iterable of BGR
+    frames, results in the format returned by im_detect_all.
+    """
+    detector = VideoDetector(model, timers)
+    for im in frames:
+        yield detector.detect(im)
+
+
+class VideoDetector(object):
+    """Detect the frames of a video stream one at a time, in order."""
+
+    def __init__(self, model, timers=None):
+        assert not cfg.RETINANET.RETINANET_ON, \
+            'Video inference needs the RoI heads of a two stage model'
+        assert not cfg.TEST.PRECOMPUTED_PROPOSALS, \
+            'Video inference needs in-network proposals'
+        self.model = model
+        self.timers = defaultdict(Timer) if timers is None else timers
+        self.max_interval = max(cfg.TEST.VIDEO.KEYFRAME_INTERVAL, 1)
+        self.min_interval = min(
+            max(cfg.TEST.VIDEO.MIN_KEYFRAME_INTERVAL, 1), self.max_interval)
+        self.reset()
+
+    def reset(self):
+        """Forget the past frames, e.g. at a scene cut or a new stream."""
+        self.interval = self.max_interval
+        self.frame_idx = 0
+        self.num_keyframes = 0
+        # Detection change between the last two keyframes
+        self.change = 0.
+        self._key_idx = None
+        self._key_boxes = None
+        self._velocities = None
+
+    def detect(self, im, im_blob=None):
+        """Return the results of the next frame of the stream (in the format
+        returned by im_detect_all) and whether it was a keyframe.
+
+        Arguments:
+            im (ndarray): color frame in BGR order
+            im_blob: optional (blob, im_scale, im_info) of the frame at the
+                test scale (e.g. prefetched)
+        """
+        is_keyframe = (
+            self._key_boxes is None or
+            self.frame_idx - self._key_idx >= self.interval
+        )
+        if is_keyframe:
+            with latency_utils.stage('keyframe'):
+                results = im_detect_all(self.model, im, None, self.timers, im_blob)
+            self.timers['misc_video'].tic()
+            self._update_keyframe(results[0])
+            self.timers['misc_video'].toc()
+        else:
+            with latency_utils.stage('propagated'):
+                results = self._detect_propagated(im, im_blob)
+        self.frame_idx += 1
+        return results, is_keyframe
+
+    def _detect_propagated(self, im, im_blob):
+        """Run the RoI heads of a frame on the boxes of the last keyframe."""
+        self.timers['im_detect_conv_body'].tic()
+        blob_conv, im_scale = im_conv_body_only(
+            self.model, im, cfg.TEST.SCALE, cfg.TEST.MAX_SIZE, im_blob)
+        self.timers['im_detect_conv_body'].toc()
+
+        self.timers['misc_video'].tic()
+        cls_boxes = self._propagate_boxes(im.shape[0], im.shape[1])
+        dets = np.vstack(cls_boxes[1:])
+        scores, boxes = dets[:, -1], dets[:, :4]
+        self.timers['misc_video'].toc()
+
+        cls_segms, cls_keyps, cls_parsings, cls_uvs = im_detect_heads(
+            self.model, im, im_scale, scores, boxes, cls_boxes, blob_conv, self.timers)
+        return cls_boxes, cls_segms, cls_keyps, cls_parsings, cls_uvs
+
+    def _propagate_boxes(self, im_h, im_w):
+        """Boxes (per class) of the last keyframe, moved to the current frame."""
+        num_frames = self.frame_idx - self._key_idx
+        cls_boxes = [[]]
+        for j in range(1, len(self._key_boxes)):
+            dets = self._key_boxes[j].copy()
+            if cfg.TEST.VIDEO.PROPAGATE_MOTION and len(dets):
+                dets[:, :4] += self._velocities[j] * num_frames
+                box_utils.clip_boxes_to_image(dets[:, :4], im_h, im_w)
+            cls_boxes.append(dets)
+        return cls_boxes
+
+    def _update_keyframe(self, cls_boxes):
+        """Match the detections of a new keyframe to the ones of the previous
+        keyframe, to get their velocity and the detection change.
+        """
+        num_frames = self.frame_idx - self._key_idx if self._key_boxes is not None else 0
+        velocities = [None]
+        num_unmatched = 0
+        num_dets = 0
+        for j in range(1, len(cls_boxes)):
+            dets = np.asarray(cls_boxes[j], dtype=np.float32).reshape(-1, 5)
+            velocity = np.zeros((len(dets), 4), dtype=np.float32)
+            if num_frames > 0:
+                prev_dets = self._key_boxes[j]
+                matches = match_boxes(dets, prev_dets, cfg.TEST.VIDEO.MATCH_IOU)
+                matched = matches >= 0
+                velocity[matched] = (
+                    dets[matched, :4] - prev_dets[matches[matched], :4]
+                ) / num_frames
+                num_unmatched += len(dets) + len(prev_dets) - 2 * int(matched.sum())
+                num_dets += len(dets) + len(prev_dets)
+            velocities.append(velocity)
+
+        if num_frames > 0:
+            self.change = num_unmatched / num_dets if num_dets > 0 else 0.
+            if cfg.TEST.VIDEO.ADAPTIVE:
+                if self.change > cfg.TEST.VIDEO.CHANGE_THRESH:
+                    self.interval = max(self.interval // 2, self.min_interval)
+                else:
+                    self.interval = min(self.interval + 1, self.max_interval)
+        self._key_idx = self.frame_idx
+        self._key_boxes = [[]] + [
+            np.asarray(cls_boxes[j], dtype=np.float32).reshape(-1, 5)
+            for j in range(1, len(cls_boxes))
+        ]
+        self._velocities = velocities
+        self.num_keyframes += 1
+
+
+def match_boxes(dets, prev_dets, min_iou):
+    """Greedily match the detections (N, 5) to the previous ones (M, 5) by IoU,
+    highest scores first. Return the index of the matched previous detection of
+    each detection, or -1.
+    """
+    matches = -np.ones(len(dets), dtype=np.int64)
+    if len(dets) == 0 or len(prev_dets) == 0:
+        return matches
+    overlaps = box_utils.bbox_overlaps(
+        np.ascontiguousarray(dets[:, :4], dtype=np.float32),
+        np.ascontiguousarray(prev_dets[:, :4], dtype=np.float32))
+    for i in np.argsort(-dets[:, 4], kind='mergesort'):
+        k = overlaps[i].argmax()
+        if overlaps[i, k] >= min_iou:
+            matches[i] = k
+            # Each previous detection matches once
+            overlaps[:, k] = -1
+    return matches
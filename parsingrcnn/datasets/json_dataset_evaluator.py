@@ -72,14 +72,12 @@ def _write_coco_segms_results_file(
     #   "segmentation": [...],
     #   "score": 0.236}, ...]
     results = []
-    for cls_ind, cls in enumerate(json_dataset.classes):
-        if cls == '__background__':
-            continue
-        if cls_ind >= len(all_boxes):
-            break
-        cat_id = json_dataset.category_to_id_map[cls]
-        results.extend(_coco_segms_results_one_category(
-            json_dataset, all_boxes[cls_ind], all_segms[cls_ind], cat_id))
+    image_ids, categories = _image_ids_and_categories(
+        json_dataset, len(all_boxes), all_boxes, all_segms)
+    for i, image_id in enumerate(image_ids):
+        for cls_ind, cat_id in categories:
+            results.extend(_coco_segms_results_one_image(
+                image_id, all_boxes[cls_ind][i], all_segms[cls_ind][i], cat_id))
     logger.info(
         'Writing segmentation results json to: {}'.format(
             os.path.abspath(res_file)))
@@ -87,30 +85,18 @@ def _write_coco_segms_results_file(
         json.dump(results, fid)
 
 
-def _coco_segms_results_one_category(json_dataset, boxes, segms, cat_id):
-    results = []
-    image_ids = json_dataset.COCO.getImgIds()
-    image_ids.sort()
-    assert len(boxes) == len(image_ids)
-    assert len(segms) == len(image_ids)
-    for i, image_id in enumerate(image_ids):
-        dets = boxes[i]
-        rles = segms[i]
-
-        if isinstance(dets, list) and len(dets) == 0:
-            continue
+def _coco_segms_results_one_image(image_id, dets, rles, cat_id):
+    if isinstance(dets, list) and len(dets) == 0:
+        return []
 
-        dets = dets.astype(np.float)
-        scores = dets[:, -1]
+    dets = dets.astype(np.float)
+    scores = dets[:, -1]
 
-        results.extend(
-            [{'image_id': image_id,
-              'category_id': cat_id,
-              'segmentation': rles[k],
-              'score': scores[k]}
-              for k in range(dets.shape[0])])
-
-    return results
+    return [{'image_id': image_id,
+             'category_id': cat_id,
+             'segmentation': rles[k],
+             'score': scores[k]}
+            for k in range(dets.shape[0])]
 
 
 def _do_segmentation_eval(json_dataset, res_file, output_dir):
@@ -152,42 +138,53 @@ def _write_coco_bbox_results_file(json_dataset, all_boxes, res_file):
     #   "bbox": [258.15,41.29,348.26,243.78],
     #   "score": 0.236}, ...]
     results = []
-    for cls_ind, cls in enumerate(json_dataset.classes):
-        if cls == '__background__':
-            continue
-        if cls_ind >= len(all_boxes):
-            break
-        cat_id = json_dataset.category_to_id_map[cls]
-        results.extend(_coco_bbox_results_one_category(
-            json_dataset, all_boxes[cls_ind], cat_id))
+    image_ids, categories = _image_ids_and_categories(
+        json_dataset, len(all_boxes), all_boxes)
+    for i, image_id in enumerate(image_ids):
+        for cls_ind, cat_id in categories:
+            results.extend(_coco_bbox_results_one_image(
+                image_id, all_boxes[cls_ind][i], cat_id))
     logger.info(
         'Writing bbox results json to: {}'.format(os.path.abspath(res_file)))
     with open(res_file, 'w') as fid:
         json.dump(results, fid)
 
 
-def _coco_bbox_results_one_category(json_dataset, boxes, cat_id):
-    results = []
+def _coco_bbox_results_one_image(image_id, dets, cat_id):
+    if isinstance(dets, list) and len(dets) == 0:
+        return []
+    dets = dets.astype(np.float)
+    scores = dets[:, -1]
+    xywh_dets = box_utils.xyxy_to_xywh(dets[:, 0:4])
+    xs = xywh_dets[:, 0]
+    ys = xywh_dets[:, 1]
+    ws = xywh_dets[:, 2]
+    hs = xywh_dets[:, 3]
+    return [{'image_id': image_id,
+             'category_id': cat_id,
+             'bbox': [xs[k], ys[k], ws[k], hs[k]],
+             'score': scores[k]} for k in range(dets.shape[0])]
+
+
+def _image_ids_and_categories(json_dataset, num_classes, *all_results):
+    """The sorted image ids of a json dataset and the (class index, category
+    id) of its classes with results. The results files are written image-major
+    (all classes of an image, image after image), so that results streamed
+    from a result store are read one chunk at a time (see
+    utils.result_store).
+    """
     image_ids = json_dataset.COCO.getImgIds()
     image_ids.sort()
-    assert len(boxes) == len(image_ids)
-    for i, image_id in enumerate(image_ids):
-        dets = boxes[i]
-        if isinstance(dets, list) and len(dets) == 0:
+    categories = []
+    for cls_ind, cls in enumerate(json_dataset.classes):
+        if cls == '__background__':
             continue
-        dets = dets.astype(np.float)
-        scores = dets[:, -1]
-        xywh_dets = box_utils.xyxy_to_xywh(dets[:, 0:4])
-        xs = xywh_dets[:, 0]
-        ys = xywh_dets[:, 1]
-        ws = xywh_dets[:, 2]
-        hs = xywh_dets[:, 3]
-        results.extend(
-            [{'image_id': image_id,
-              'category_id': cat_id,
-              'bbox': [xs[k], ys[k], ws[k], hs[k]],
-              'score': scores[k]} for k in range(dets.shape[0])])
-    return results
+        if cls_ind >= num_classes:
+            break
+        for cls_results in all_results:
+            assert len(cls_results[cls_ind]) == len(image_ids)
+        categories.append((cls_ind, json_dataset.category_to_id_map[cls]))
+    return image_ids, categories
 
 
 def _do_detection_eval(json_dataset, res_file, output_dir):
@@ -350,17 +347,13 @@ def _write_coco_keypoint_results_file(
     json_dataset, all_boxes, all_keypoints, res_file
 ):
     results = []
-    for cls_ind, cls in enumerate(json_dataset.classes):
-        if cls == '__background__':
-            continue
-        if cls_ind >= len(all_keypoints):
-            break
-        logger.info(
-            'Collecting {} results ({:d}/{:d})'.format(
-                cls, cls_ind, len(all_keypoints) - 1))
-        cat_id = json_dataset.category_to_id_map[cls]
-        results.extend(_coco_kp_results_one_category(
-            json_dataset, all_boxes[cls_ind], all_keypoints[cls_ind], cat_id))
+    image_ids, categories = _image_ids_and_categories(
+        json_dataset, len(all_keypoints), all_boxes, all_keypoints)
+    for i, image_id in enumerate(image_ids):
+        for cls_ind, cat_id in categories:
+            results.extend(_coco_kp_results_one_image(
+                image_id, all_boxes[cls_ind][i], all_keypoints[cls_ind][i],
+                cat_id))
     logger.info(
         'Writing keypoint results json to: {}'.format(
             os.path.abspath(res_file)))
@@ -368,12 +361,8 @@ def _write_coco_keypoint_results_file(
         json.dump(results, fid)
 
 
-def _coco_kp_results_one_category(json_dataset, boxes, kps, cat_id):
+def _coco_kp_results_one_image(image_id, dets, kps_dets, cat_id):
     results = []
-    image_ids = json_dataset.COCO.getImgIds()
-    image_ids.sort()
-    assert len(kps) == len(image_ids)
-    assert len(boxes) == len(image_ids)
     use_box_score = False
     if cfg.KRCNN.KEYPOINT_CONFIDENCE == 'logit':
         # This is ugly; see utils.keypoints.heatmap_to_keypoints for the magic
@@ -386,33 +375,29 @@ def _coco_kp_results_one_category(json_dataset, boxes, kps, cat_id):
     else:
         raise ValueError(
             'KRCNN.KEYPOINT_CONFIDENCE must be "logit", "prob", or "bbox"')
-    for i, image_id in enumerate(image_ids):
-        if len(boxes[i]) == 0:
-            continue
-        kps_dets = kps[i]
-        scores = boxes[i][:, -1].astype(np.float)
-        if len(kps_dets) == 0:
-            continue
-        for j in range(len(kps_dets)):
-            xy = []
-
-            kps_score = 0
-            for k in range(kps_dets[j].shape[1]):
-                xy.append(float(kps_dets[j][0, k]))
-                xy.append(float(kps_dets[j][1, k]))
-                xy.append(1)
-                if not use_box_score:
-                    kps_score += kps_dets[j][score_index, k]
-
-            if use_box_score:
-                kps_score = scores[j]
-            else:
-                kps_score /= kps_dets[j].shape[1]
-
-            results.extend([{'image_id': image_id,
-                             'category_id': cat_id,
-                             'keypoints': xy,
-                             'score': kps_score}])
+    if len(dets) == 0 or len(kps_dets) == 0:
+        return results
+    scores = dets[:, -1].astype(np.float)
+    for j in range(len(kps_dets)):
+        xy = []
+
+        kps_score = 0
+        for k in range(kps_dets[j].shape[1]):
+            xy.append(float(kps_dets[j][0, k]))
+            xy.append(float(kps_dets[j][1, k]))
+            xy.append(1)
+            if not use_box_score:
+                kps_score += kps_dets[j][score_index, k]
+
+        if use_box_score:
+            kps_score = scores[j]
+        else:
+            kps_score /= kps_dets[j].shape[1]
+
+        results.extend([{'image_id': image_id,
+                         'category_id': cat_id,
+                         'keypoints': xy,
+                         'score': kps_score}])
     return results
 
 
@@ -467,17 +452,12 @@ def _write_coco_uv_results_file(
     json_dataset, all_boxes, all_uvs, res_file
 ):
     results = []
-    for cls_ind,cls in enumerate(json_dataset.classes):
-        if cls == '__background__':
-            continue
-        if cls_ind >= len(all_uvs):
-            break
-        logger.info(
-            'Collecting {} results ({:d}/{:d})'.format(
-                cls, cls_ind, len(all_uvs) - 1))
-        cat_id = json_dataset.category_to_id_map[cls]
-        results.extend(_coco_uv_results_one_category(
-            json_dataset, all_boxes[cls_ind], all_uvs[cls_ind], cat_id))
+    image_ids, categories = _image_ids_and_categories(
+        json_dataset, len(all_uvs), all_boxes, all_uvs)
+    for i, image_id in enumerate(image_ids):
+        for cls_ind, cat_id in categories:
+            results.extend(_coco_uv_results_one_image(
+                image_id, all_boxes[cls_ind][i], all_uvs[cls_ind][i], cat_id))
     # UV results are stored in 3xHxW ndarray format,
     # which is not json serializable
     #logger.info(
@@ -496,43 +476,33 @@ def _write_coco_uv_results_file(
     return res_file
 
 
-def _coco_uv_results_one_category(json_dataset, boxes, uvs, cat_id):
-    results = []
-    image_ids = json_dataset.COCO.getImgIds()
-    image_ids.sort()
-    assert len(uvs) == len(image_ids)
-    assert len(boxes) == len(image_ids)
+def _coco_uv_results_one_image(image_id, box_dets, uv_dets, cat_id):
+    if len(box_dets) == 0 or len(uv_dets) == 0:
+        return []
+    box_dets = box_dets.astype(np.float)
+    scores = box_dets[:, -1]
+    # Don't use xyxy_to_xywh function for consistency with the original imp
+    # Instead, cast to ints and don't add 1 when computing ws and hs
+    # xywh_box_dets = box_utils.xyxy_to_xywh(box_dets[:, 0:4])
+    # xs = xywh_box_dets[:, 0]
+    # ys = xywh_box_dets[:, 1]
+    # ws = xywh_box_dets[:, 2]
+    # hs = xywh_box_dets[:, 3]
+    
+    # Convert the uv fields to uint8.
+    for uv in uv_dets:
+        uv[1:3,:,:] = uv[1:3,:,:]*255
+    ###
+    xs = box_dets[:, 0]
+    ys = box_dets[:, 1]
+    ws = (box_dets[:, 2] - xs).astype(np.int)
+    hs = (box_dets[:, 3] - ys).astype(np.int)
     #
-    for i, image_id in enumerate(image_ids):
-        if len(boxes[i]) == 0 or len(uvs[i]) == 0:
-            continue
-        uv_dets = uvs[i]
-        box_dets = boxes[i].astype(np.float)
-        scores = box_dets[:, -1]
-        # Don't use xyxy_to_xywh function for consistency with the original imp
-        # Instead, cast to ints and don't add 1 when computing ws and hs
-        # xywh_box_dets = box_utils.xyxy_to_xywh(box_dets[:, 0:4])
-        # xs = xywh_box_dets[:, 0]
-        # ys = xywh_box_dets[:, 1]
-        # ws = xywh_box_dets[:, 2]
-        # hs = xywh_box_dets[:, 3]
-        
-        # Convert the uv fields to uint8.
-        for uv in uv_dets:
-            uv[1:3,:,:] = uv[1:3,:,:]*255
-        ###
-        xs = box_dets[:, 0]
-        ys = box_dets[:, 1]
-        ws = (box_dets[:, 2] - xs).astype(np.int)
-        hs = (box_dets[:, 3] - ys).astype(np.int)
-        #
-        results.extend(
-            [{'image_id': image_id,
-              'category_id': cat_id,
-              'uv': uv_dets[k].astype(np.uint8),
-              'bbox': [xs[k], ys[k], ws[k], hs[k]],
-              'score': scores[k]} for k in range(box_dets.shape[0])])
-    return results
+    return [{'image_id': image_id,
+             'category_id': cat_id,
+             'uv': uv_dets[k].astype(np.uint8),
+             'bbox': [xs[k], ys[k], ws[k], hs[k]],
+             'score': scores[k]} for k in range(box_dets.shape[0])]
 
 
 def _do_uv_eval(json_dataset, res_file, output_dir):
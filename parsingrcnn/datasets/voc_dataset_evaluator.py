@@ -58,6 +58,7 @@ def _write_voc_results_files(json_dataset, all_boxes, salt):
     for i, entry in enumerate(roidb):
         index = os.path.splitext(os.path.split(entry['image'])[-1])[0]
         image_index.append(index)
+    files = []
     for cls_ind, cls in enumerate(json_dataset.classes):
         if cls == '__background__':
             continue
@@ -66,8 +67,12 @@ def _write_voc_results_files(json_dataset, all_boxes, salt):
                                                   salt).format(cls)
         filenames.append(filename)
         assert len(all_boxes[cls_ind]) == len(image_index)
-        with open(filename, 'wt') as f:
-            for im_ind, index in enumerate(image_index):
+        files.append((cls_ind, open(filename, 'wt')))
+    # The files of all classes are written image after image, so that results
+    # streamed from a result store are read one chunk at a time
+    try:
+        for im_ind, index in enumerate(image_index):
+            for cls_ind, f in files:
                 dets = all_boxes[cls_ind][im_ind]
                 if type(dets) == list:
                     assert len(dets) == 0, \
@@ -79,6 +84,9 @@ def _write_voc_results_files(json_dataset, all_boxes, salt):
                             format(index, dets[k, -1],
                                    dets[k, 0] + 1, dets[k, 1] + 1,
                                    dets[k, 2] + 1, dets[k, 3] + 1))
+    finally:
+        for _, f in files:
+            f.close()
     return filenames
 
 
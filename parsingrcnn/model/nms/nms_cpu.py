@@ -0,0 +1,35 @@
+from __future__ import absolute_import
+import torch
+
+
+def nms_cpu(dets, thresh):
+	"""Greedy NMS in pure PyTorch with the same +1 box area convention and
+	return format as nms_gpu: an (num_keep, 1) int tensor of indices into dets.
+	"""
+	x1 = dets[:, 0]
+	y1 = dets[:, 1]
+	x2 = dets[:, 2]
+	y2 = dets[:, 3]
+	scores = dets[:, 4]
+
+	areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+	_, order = scores.sort(0, descending=True)
+
+	keep = []
+	while order.numel() > 0:
+		i = order[0]
+		keep.append(int(i))
+		if order.numel() == 1:
+			break
+		rest = order[1:]
+		xx1 = x1[rest].clamp(min=float(x1[i]))
+		yy1 = y1[rest].clamp(min=float(y1[i]))
+		xx2 = x2[rest].clamp(max=float(x2[i]))
+		yy2 = y2[rest].clamp(max=float(y2[i]))
+		w = (xx2 - xx1 + 1).clamp(min=0)
+		h = (yy2 - yy1 + 1).clamp(min=0)
+		inter = w * h
+		ovr = inter / (areas[i] + areas[rest] - inter)
+		order = rest[ovr <= thresh]
+
+	return torch.IntTensor(keep).view(-1, 1)
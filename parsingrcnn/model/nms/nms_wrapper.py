@@ -6,7 +6,11 @@
 # --------------------------------------------------------
 import torch
 from parsingrcnn.core.config import cfg
-from parsingrcnn.model.nms.nms_gpu import nms_gpu
+from parsingrcnn.model.nms.nms_cpu import nms_cpu
+try:
+    from parsingrcnn.model.nms.nms_gpu import nms_gpu
+except ImportError:  # extension not built, e.g. on CPU-only inference hosts
+    nms_gpu = None
 
 def nms(dets, thresh, force_cpu=False):
     """Dispatch to either CPU or GPU NMS implementations."""
@@ -15,4 +19,6 @@ def nms(dets, thresh, force_cpu=False):
     # ---numpy version---
     # original: return gpu_nms(dets, thresh, device_id=cfg.GPU_ID)
     # ---pytorch version---
+    if force_cpu or not dets.is_cuda or nms_gpu is None:
+        return nms_cpu(dets.cpu(), thresh)
     return nms_gpu(dets, thresh)
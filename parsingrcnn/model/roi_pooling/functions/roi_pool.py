@@ -1,6 +1,10 @@
 import torch
 from torch.autograd import Function
-from .._ext import roi_pooling
+try:
+    from .._ext import roi_pooling
+except ImportError:  # extension not built, e.g. on CPU-only inference hosts
+    roi_pooling = None
+from .roi_pool_cpu import roi_pooling_forward_cpu
 import pdb
 
 class RoIPoolFunction(Function):
@@ -18,9 +22,14 @@ class RoIPoolFunction(Function):
         ctx.argmax = features.new(num_rois, num_channels, ctx.pooled_height, ctx.pooled_width).zero_().int()
         ctx.rois = rois
         if not features.is_cuda:
-            _features = features.permute(0, 2, 3, 1)
-            roi_pooling.roi_pooling_forward(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
-                                            _features, rois, output)
+            if roi_pooling is not None and batch_size == 1:
+                # The C kernel reads contiguous NHWC features of one image
+                _features = features.permute(0, 2, 3, 1).contiguous()
+                roi_pooling.roi_pooling_forward(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
+                                                _features, rois, output)
+            else:
+                roi_pooling_forward_cpu(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
+                                        features, rois, output)
         else:
             roi_pooling.roi_pooling_forward_cuda(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
                                                  features, rois, output, ctx.argmax)
@@ -0,0 +1,40 @@
+"""Pure PyTorch RoIPool used for CPU features when the compiled extension is
+missing or the batch holds more than one image (which its C kernel skips).
+
+Follows the bin quantization of ../src/roi_pooling_kernel.cu (rounded RoI
+corners, floor/ceil bin edges clipped to the feature map, empty bins are 0)
+and works on NCHW features with any batch size.
+"""
+import math
+
+
+def roi_pooling_forward_cpu(pooled_height, pooled_width, spatial_scale,
+                            features, rois, output):
+    """Same signature as roi_pooling.roi_pooling_forward; fills `output`."""
+    _, _, data_height, data_width = features.size()
+    for n in range(rois.size(0)):
+        batch_ind = int(rois[n, 0])
+        roi_start_w, roi_start_h, roi_end_w, roi_end_h = \
+            [int(round(v * spatial_scale)) for v in rois[n, 1:5].tolist()]
+        roi_height = max(roi_end_h - roi_start_h + 1, 1)
+        roi_width = max(roi_end_w - roi_start_w + 1, 1)
+        bin_size_h = float(roi_height) / float(pooled_height)
+        bin_size_w = float(roi_width) / float(pooled_width)
+
+        feat = features[batch_ind]
+        for ph in range(pooled_height):
+            hstart = int(math.floor(ph * bin_size_h)) + roi_start_h
+            hend = int(math.ceil((ph + 1) * bin_size_h)) + roi_start_h
+            hstart = min(max(hstart, 0), data_height)
+            hend = min(max(hend, 0), data_height)
+            for pw in range(pooled_width):
+                wstart = int(math.floor(pw * bin_size_w)) + roi_start_w
+                wend = int(math.ceil((pw + 1) * bin_size_w)) + roi_start_w
+                wstart = min(max(wstart, 0), data_width)
+                wend = min(max(wend, 0), data_width)
+                if hend <= hstart or wend <= wstart:
+                    output[n, :, ph, pw] = 0
+                    continue
+                region = feat[:, hstart:hend, wstart:wend].contiguous()
+                output[n, :, ph, pw] = region.view(region.size(0), -1).max(1)[0]
+    return output
@@ -1,4 +1,5 @@
 #include <TH/TH.h>
+#include <float.h>
 #include <math.h>
 
 int roi_pooling_forward(int pooled_height, int pooled_width, float spatial_scale,
@@ -27,7 +28,7 @@ int roi_pooling_forward(int pooled_height, int pooled_width, float spatial_scale
     int num_channels = THFloatTensor_size(features, 3);
 
     // Set all element of the output tensor to -inf.
-    THFloatStorage_fill(THFloatTensor_storage(output), -1);
+    THFloatStorage_fill(THFloatTensor_storage(output), -FLT_MAX);
 
     // For each ROI R = [batch_index x1 y1 x2 y2]: max pool over R
     int index_roi = 0;
@@ -10,7 +10,7 @@ from parsingrcnn.core.config import cfg
 import parsingrcnn.utils.net as net_utils
 import parsingrcnn.modeling.ResNet as ResNet
 from parsingrcnn.modeling.generate_anchors import generate_anchors
-from parsingrcnn.modeling.generate_proposals import GenerateProposalsOp
+from parsingrcnn.modeling.generate_proposals import GenerateProposalsOp, generate_proposals
 from parsingrcnn.modeling.collect_and_distribute_fpn_rpn_proposals import CollectAndDistributeFpnRpnProposalsOp
 import parsingrcnn.nn as mynn
 
@@ -475,6 +475,8 @@ class fpn_rpn_outputs(nn.Module):
         return_dict = {}
         rois_blobs = []
         score_blobs = []
+        cls_probs = []
+        bbox_preds = []
         for lvl in range(k_min, k_max + 1):
             slvl = str(lvl)
             bl_in = blobs_in[k_max - lvl]  # blobs_in is in reversed order
@@ -498,13 +500,18 @@ class fpn_rpn_outputs(nn.Module):
                     fpn_rpn_cls_probs = fpn_rpn_cls_probs[:, 1].squeeze(dim=1)
                 else:  # sigmoid
                     fpn_rpn_cls_probs = F.sigmoid(fpn_rpn_cls_score)
-
-                fpn_rpn_rois, fpn_rpn_roi_probs = self.GenerateProposals_modules[lvl - k_min](
-                    fpn_rpn_cls_probs, fpn_rpn_bbox_pred, im_info)
+                cls_probs.append(fpn_rpn_cls_probs)
+                bbox_preds.append(fpn_rpn_bbox_pred)
+
+        if cls_probs:
+            # The proposals of all levels are generated at once
+            proposals = generate_proposals(
+                self.GenerateProposals_modules, cls_probs, bbox_preds, im_info)
+            for lvl, (fpn_rpn_rois, fpn_rpn_roi_probs) in zip(range(k_min, k_max + 1), proposals):
                 rois_blobs.append(fpn_rpn_rois)
                 score_blobs.append(fpn_rpn_roi_probs)
-                return_dict['rpn_rois_fpn' + slvl] = fpn_rpn_rois
-                return_dict['rpn_rois_prob_fpn' + slvl] = fpn_rpn_roi_probs
+                return_dict['rpn_rois_fpn' + str(lvl)] = fpn_rpn_rois
+                return_dict['rpn_rois_prob_fpn' + str(lvl)] = fpn_rpn_roi_probs
 
         if cfg.MODEL.FASTER_RCNN:
             # CollectAndDistributeFpnRpnProposals also labels proposals when in training mode
@@ -81,12 +81,30 @@ def collect(inputs, is_training):
     # rois are in [[batch_idx, x0, y0, x1, y2], ...] format
     # Combine predictions across all levels and retain the top scoring
     rois = np.concatenate(roi_inputs)
-    scores = np.concatenate(score_inputs).squeeze()
-    inds = np.argsort(-scores)[:post_nms_topN]
+    scores = np.concatenate(score_inputs).reshape(-1)
+    if is_training:
+        inds = _top_k(scores, post_nms_topN)
+    else:
+        # Keep the top proposals of each test image, so that a multi-image
+        # test minibatch gives the same proposals as one image at a time
+        inds = []
+        for im_i in np.unique(rois[:, 0]):
+            im_inds = np.where(rois[:, 0] == im_i)[0]
+            inds.append(im_inds[_top_k(scores[im_inds], post_nms_topN)])
+        inds = np.concatenate(inds) if len(inds) else np.zeros(0, dtype=np.int64)
     rois = rois[inds, :]
     return rois
 
 
+def _top_k(scores, k):
+    """Indices of the k highest scores, from highest to lowest."""
+    if 0 < k < len(scores):
+        # Partition to get the top k unsorted, then sort just those
+        inds = np.argpartition(-scores, k)[:k]
+        return inds[np.argsort(-scores[inds])]
+    return np.argsort(-scores)
+
+
 def distribute(rois, label_blobs):
     """To understand the output blob order see return value of
     roi_data.fast_rcnn.get_fast_rcnn_blob_names(is_training=False)
@@ -105,15 +123,8 @@ def distribute(rois, label_blobs):
     outputs[0] = rois
 
     # Create new roi blobs for each FPN level
-    # (See: utils.fpn.add_multilevel_roi_blobs which is similar but annoying
-    # to generalize to support this particular case.)
-    rois_idx_order = np.empty((0, ))
-    for output_idx, lvl in enumerate(range(lvl_min, lvl_max + 1)):
-        idx_lvl = np.where(lvls == lvl)[0]
-        blob_roi_level = rois[idx_lvl, :]
-        outputs[output_idx + 1] = blob_roi_level
-        rois_idx_order = np.concatenate((rois_idx_order, idx_lvl))
-    rois_idx_restore = np.argsort(rois_idx_order)
-    outputs[-1] = rois_idx_restore.astype(np.int32)
+    rois_lvls, rois_idx_restore = fpn_utils.split_rois_by_level(rois, lvls, lvl_min, lvl_max)
+    outputs[1:-1] = rois_lvls
+    outputs[-1] = rois_idx_restore
 
     return dict(zip(output_blob_names, outputs))
@@ -1,13 +1,20 @@
+from collections import OrderedDict
 import logging
 import numpy as np
 
+import torch
 from torch import nn
 
 from parsingrcnn.core.config import cfg
+from parsingrcnn.model.nms.nms_wrapper import nms_gpu
 import parsingrcnn.utils.boxes as box_utils
 
 logger = logging.getLogger(__name__)
 
+# Number of (H, W) anchor grids kept per op; training images of many sizes
+# would otherwise grow the cache without bound
+_ANCHOR_GRID_CACHE_SIZE = 32
+
 
 class GenerateProposalsOp(nn.Module):
     def __init__(self, anchors, spatial_scale):
@@ -15,6 +22,7 @@ class GenerateProposalsOp(nn.Module):
         self._anchors = anchors
         self._num_anchors = self._anchors.shape[0]
         self._feat_stride = 1. / spatial_scale
+        self._anchor_grids = OrderedDict()
 
     def forward(self, rpn_cls_prob, rpn_bbox_pred, im_info):
         """Op for generating RPN porposals.
@@ -42,141 +50,203 @@ class GenerateProposalsOp(nn.Module):
           - 'rpn_roi_probs': 1D tensor of objectness probability scores
             (extracted from rpn_cls_probs; see above).
         """
-        # 1. for each location i in a (H, W) grid:
-        #      generate A anchor boxes centered on cell i
-        #      apply predicted bbox deltas to each of the A anchors at cell i
-        # 2. clip predicted boxes to image
-        # 3. remove predicted boxes with either height or width < threshold
-        # 4. sort all (proposal, score) pairs by score from highest to lowest
-        # 5. take the top pre_nms_topN proposals before NMS
-        # 6. apply NMS with a loose threshold (0.7) to the remaining proposals
-        # 7. take after_nms_topN proposals after NMS
-        # 8. return the top proposals
-        
-        """Type conversion"""
-        # predicted probability of fg object for each RPN anchor
-        scores = rpn_cls_prob.data.cpu().numpy()
-        # predicted achors transformations
-        bbox_deltas = rpn_bbox_pred.data.cpu().numpy()
-        # input image (height, width, scale), in which scale is the scale factor
-        # applied to the original dataset image to get the network input image
-        im_info = im_info.data.cpu().numpy()
-
-        # 1. Generate proposals from bbox deltas and shifted anchors
-        height, width = scores.shape[-2:]
-        # Enumerate all shifted positions on the (H, W) grid
-        shift_x = np.arange(0, width) * self._feat_stride
-        shift_y = np.arange(0, height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y, copy=False)
-        # Convert to (K, 4), K=H*W, where the columns are (dx, dy, dx, dy)
-        # shift pointing to each grid location
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(),
-                            shift_y.ravel())).transpose()
-
-        # Broacast anchors over shifts to enumerate all anchors at all positions
-        # in the (H, W) grid:
-        #   - add A anchors of shape (1, A, 4) to
-        #   - K shifts of shape (K, 1, 4) to get
-        #   - all shifted anchors of shape (K, A, 4)
-        #   - reshape to (K*A, 4) shifted anchors
-        num_images = scores.shape[0]
-        A = self._num_anchors
-        K = shifts.shape[0]
-        all_anchors = self._anchors[np.newaxis, :, :] + shifts[:, np.newaxis, :]
-        all_anchors = all_anchors.reshape((K * A, 4))
-        # all_anchors = torch.from_numpy(all_anchors).type_as(scores)
-
-        rois = np.empty((0, 5), dtype=np.float32)
-        roi_probs = np.empty((0, 1), dtype=np.float32)
-        for im_i in range(num_images):
-            im_i_boxes, im_i_probs = self.proposals_for_one_image(
-                im_info[im_i, :], all_anchors, bbox_deltas[im_i, :, :, :],
-                scores[im_i, :, :, :])
-            batch_inds = im_i * np.ones(
-                (im_i_boxes.shape[0], 1), dtype=np.float32)
-            im_i_rois = np.hstack((batch_inds, im_i_boxes))
-            rois = np.append(rois, im_i_rois, axis=0)
-            roi_probs = np.append(roi_probs, im_i_probs, axis=0)
-
-        return rois, roi_probs  # Note: ndarrays
-
-    def proposals_for_one_image(self, im_info, all_anchors, bbox_deltas, scores):
-        # Get mode-dependent configuration
-        cfg_key = 'TRAIN' if self.training else 'TEST'
-        pre_nms_topN = cfg[cfg_key].RPN_PRE_NMS_TOP_N
-        post_nms_topN = cfg[cfg_key].RPN_POST_NMS_TOP_N
-        nms_thresh = cfg[cfg_key].RPN_NMS_THRESH
-        min_size = cfg[cfg_key].RPN_MIN_SIZE
-        # print('generate_proposals:', pre_nms_topN, post_nms_topN, nms_thresh, min_size)
-
-        # Transpose and reshape predicted bbox transformations to get them
-        # into the same order as the anchors:
-        #   - bbox deltas will be (4 * A, H, W) format from conv output
-        #   - transpose to (H, W, 4 * A)
-        #   - reshape to (H * W * A, 4) where rows are ordered by (H, W, A)
-        #     in slowest to fastest order to match the enumerated anchors
-        bbox_deltas = bbox_deltas.transpose((1, 2, 0)).reshape((-1, 4))
-
-        # Same story for the scores:
-        #   - scores are (A, H, W) format from conv output
-        #   - transpose to (H, W, A)
-        #   - reshape to (H * W * A, 1) where rows are ordered by (H, W, A)
-        #     to match the order of anchors and bbox_deltas
-        scores = scores.transpose((1, 2, 0)).reshape((-1, 1))
-        # print('pre_nms:', bbox_deltas.shape, scores.shape)
-
-        # 4. sort all (proposal, score) pairs by score from highest to lowest
-        # 5. take top pre_nms_topN (e.g. 6000)
-        if pre_nms_topN <= 0 or pre_nms_topN >= len(scores):
-            order = np.argsort(-scores.squeeze())
-        else:
-            # Avoid sorting possibly large arrays; First partition to get top K
-            # unsorted and then sort just those (~20x faster for 200k scores)
-            inds = np.argpartition(-scores.squeeze(),
-                                   pre_nms_topN)[:pre_nms_topN]
-            order = np.argsort(-scores[inds].squeeze())
-            order = inds[order]
-        bbox_deltas = bbox_deltas[order, :]
-        all_anchors = all_anchors[order, :]
-        scores = scores[order]
-
-        # Transform anchors into proposals via bbox transformations
-        proposals = box_utils.bbox_transform(all_anchors, bbox_deltas,
-                                             (1.0, 1.0, 1.0, 1.0))
-
-        # 2. clip proposals to image (may result in proposals with zero area
-        # that will be removed in the next step)
-        proposals = box_utils.clip_tiled_boxes(proposals, im_info[:2])
-
-        # 3. remove predicted boxes with either height or width < min_size
-        keep = _filter_boxes(proposals, min_size, im_info)
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-        # print('pre_nms:', proposals.shape, scores.shape)
-
-        # 6. apply loose nms (e.g. threshold = 0.7)
-        # 7. take after_nms_topN (e.g. 300)
-        # 8. return the top proposals (-> RoIs top)
+        return generate_proposals([self], [rpn_cls_prob], [rpn_bbox_pred], im_info)[0]
+
+    def anchor_grid(self, height, width, device):
+        """All shifted anchors of a (H, W) grid as a (H * W * A, 4) tensor,
+        with rows ordered by (H, W, A) from slowest to fastest. Grids are cached
+        by (H, W, stride, device).
+        """
+        key = (height, width, self._feat_stride, str(device))
+        grid = self._anchor_grids.get(key)
+        if grid is not None:
+            return grid
+        # Enumerate all shifted positions on the (H, W) grid as (K, 4),
+        # K = H * W, where the columns are (dx, dy, dx, dy)
+        shift_x = torch.arange(width, dtype=torch.float32, device=device) * self._feat_stride
+        shift_y = torch.arange(height, dtype=torch.float32, device=device) * self._feat_stride
+        shift_x = shift_x[None, :].expand(height, width).reshape(-1)
+        shift_y = shift_y[:, None].expand(height, width).reshape(-1)
+        shifts = torch.stack((shift_x, shift_y, shift_x, shift_y), dim=1)
+        # Broadcast the A anchors (1, A, 4) over the K shifts (K, 1, 4)
+        anchors = torch.from_numpy(self._anchors.astype(np.float32)).to(device)
+        grid = (anchors[None, :, :] + shifts[:, None, :]).reshape(-1, 4)
+        self._anchor_grids[key] = grid
+        if len(self._anchor_grids) > _ANCHOR_GRID_CACHE_SIZE:
+            self._anchor_grids.popitem(last=False)
+        return grid
+
+
+def generate_proposals(ops, rpn_cls_probs, rpn_bbox_preds, im_info):
+    """Generate the RPN proposals of all the images of a minibatch and all the
+    levels (one GenerateProposalsOp each, e.g. the FPN levels) at once.
+
+    Decoding, clipping, filtering and the pre NMS top-k run batched on the
+    device of the predictions, and one NMS covers all (image, level) pairs.
+    The results are the same as running each level and image on its own.
+
+    Returns:
+        a list with the (rpn_rois, rpn_roi_probs) ndarrays of each level, see
+        GenerateProposalsOp.forward
+    """
+    # 1. for each location i in a (H, W) grid:
+    #      generate A anchor boxes centered on cell i
+    #      apply predicted bbox deltas to each of the A anchors at cell i
+    # 2. clip predicted boxes to image
+    # 3. remove predicted boxes with either height or width < threshold
+    # 4. sort all (proposal, score) pairs by score from highest to lowest
+    # 5. take the top pre_nms_topN proposals before NMS
+    # 6. apply NMS with a loose threshold (0.7) to the remaining proposals
+    # 7. take after_nms_topN proposals after NMS
+    # 8. return the top proposals
+
+    # Get mode-dependent configuration
+    cfg_key = 'TRAIN' if ops[0].training else 'TEST'
+    pre_nms_topN = cfg[cfg_key].RPN_PRE_NMS_TOP_N
+    post_nms_topN = cfg[cfg_key].RPN_POST_NMS_TOP_N
+    nms_thresh = cfg[cfg_key].RPN_NMS_THRESH
+    min_size = cfg[cfg_key].RPN_MIN_SIZE
+
+    num_levels = len(ops)
+    device = rpn_cls_probs[0].device
+    # input image (height, width, scale), in which scale is the scale factor
+    # applied to the original dataset image to get the network input image
+    im_info = im_info.data.to(device).float()
+
+    proposals = []
+    scores = []
+    groups = []
+    with torch.no_grad():
+        for lvl, (op, lvl_scores, lvl_deltas) in enumerate(
+                zip(ops, rpn_cls_probs, rpn_bbox_preds)):
+            num_images, A, height, width = lvl_scores.shape
+            all_anchors = op.anchor_grid(height, width, device)
+
+            # Get the scores (A, H, W) and the bbox deltas (4 * A, H, W) of
+            # each image into the (H, W, A) order of the anchors
+            lvl_scores = lvl_scores.data.permute(0, 2, 3, 1).reshape(num_images, -1)
+            lvl_deltas = lvl_deltas.data.view(num_images, A, 4, height, width)
+            lvl_deltas = lvl_deltas.permute(0, 3, 4, 1, 2).reshape(num_images, -1, 4)
+
+            # 4. sort all (proposal, score) pairs by score from highest to lowest
+            # 5. take top pre_nms_topN (e.g. 6000)
+            k = lvl_scores.shape[1]
+            if 0 < pre_nms_topN < k:
+                k = pre_nms_topN
+            lvl_scores, order = lvl_scores.topk(k, dim=1, sorted=True)
+            lvl_deltas = lvl_deltas.gather(1, order[:, :, None].expand(-1, -1, 4))
+
+            # Transform anchors into proposals via bbox transformations
+            lvl_proposals = _bbox_transform(all_anchors[order], lvl_deltas)
+
+            # 2. clip proposals to image (may result in proposals with zero area
+            # that will be removed in the next step)
+            lvl_proposals = _clip_boxes(lvl_proposals, im_info)
+
+            # 3. remove predicted boxes with either height or width < min_size
+            keep = _filter_boxes(lvl_proposals, min_size, im_info)
+            im_inds = torch.arange(num_images, device=device)[:, None].expand(-1, k)
+            proposals.append(lvl_proposals[keep])
+            scores.append(lvl_scores[keep])
+            groups.append(im_inds[keep] * num_levels + lvl)
+
+        proposals = torch.cat(proposals)
+        scores = torch.cat(scores)
+        groups = torch.cat(groups)
+
+        # 6. apply loose nms (e.g. threshold = 0.7) to each (image, level)
         if nms_thresh > 0:
-            keep = box_utils.nms(np.hstack((proposals, scores)), nms_thresh)
-            # print('nms keep:', keep.shape)
-            if post_nms_topN > 0:
-                keep = keep[:post_nms_topN]
-            proposals = proposals[keep, :]
-            scores = scores[keep]
-        # print('final proposals:', proposals.shape, scores.shape)
-        return proposals, scores
+            keep = _batched_nms(proposals, scores, groups, nms_thresh)
+        else:
+            keep = np.arange(len(scores))
+        proposals = proposals.cpu().numpy()
+        scores = scores.cpu().numpy()
+        groups = groups.cpu().numpy()
+
+    # Order by (image, level), then by score from highest to lowest
+    keep = keep[np.argsort(groups[keep], kind='mergesort')]
+    # 7. take after_nms_topN (e.g. 300)
+    if nms_thresh > 0 and post_nms_topN > 0:
+        keep_groups = groups[keep]
+        rank = np.arange(len(keep)) - np.searchsorted(keep_groups, keep_groups)
+        keep = keep[rank < post_nms_topN]
+
+    # 8. return the top proposals (-> RoIs top)
+    outputs = []
+    for lvl in range(num_levels):
+        lvl_keep = keep[groups[keep] % num_levels == lvl]
+        batch_inds = (groups[lvl_keep] // num_levels).astype(np.float32)
+        rois = np.hstack((batch_inds[:, np.newaxis], proposals[lvl_keep]))
+        roi_probs = scores[lvl_keep].reshape(-1, 1)
+        outputs.append((rois.astype(np.float32, copy=False),
+                        roi_probs.astype(np.float32, copy=False)))
+    return outputs
+
+
+def _bbox_transform(boxes, deltas):
+    """box_utils.bbox_transform with unit weights for (..., 4) tensors."""
+    widths = boxes[..., 2] - boxes[..., 0] + 1.0
+    heights = boxes[..., 3] - boxes[..., 1] + 1.0
+    ctr_x = boxes[..., 0] + 0.5 * widths
+    ctr_y = boxes[..., 1] + 0.5 * heights
+
+    dx, dy, dw, dh = deltas.unbind(-1)
+    # Prevent sending too large values into torch.exp()
+    dw = dw.clamp(max=cfg.BBOX_XFORM_CLIP)
+    dh = dh.clamp(max=cfg.BBOX_XFORM_CLIP)
+
+    pred_ctr_x = dx * widths + ctr_x
+    pred_ctr_y = dy * heights + ctr_y
+    pred_w = torch.exp(dw) * widths
+    pred_h = torch.exp(dh) * heights
+
+    # x2, y2: "- 1" is correct; don't be fooled by the asymmetry
+    return torch.stack((
+        pred_ctr_x - 0.5 * pred_w,
+        pred_ctr_y - 0.5 * pred_h,
+        pred_ctr_x + 0.5 * pred_w - 1,
+        pred_ctr_y + 0.5 * pred_h - 1
+    ), dim=-1)
+
+
+def _clip_boxes(boxes, im_info):
+    """Clip the (N, R, 4) boxes of each image to its (height, width)."""
+    im_h = im_info[:, 0, None] - 1
+    im_w = im_info[:, 1, None] - 1
+    x1, y1, x2, y2 = boxes.unbind(-1)
+    return torch.stack((
+        torch.min(x1.clamp(min=0), im_w),
+        torch.min(y1.clamp(min=0), im_h),
+        torch.min(x2.clamp(min=0), im_w),
+        torch.min(y2.clamp(min=0), im_h)
+    ), dim=-1)
 
 
 def _filter_boxes(boxes, min_size, im_info):
-    """Only keep boxes with both sides >= min_size and center within the image.
-  """
+    """Mask (N, R) of the boxes with both sides >= min_size and center within
+    the image.
+    """
     # Scale min_size to match image scale
-    min_size *= im_info[2]
-    ws = boxes[:, 2] - boxes[:, 0] + 1
-    hs = boxes[:, 3] - boxes[:, 1] + 1
-    x_ctr = boxes[:, 0] + ws / 2.
-    y_ctr = boxes[:, 1] + hs / 2.
-    keep = np.where((ws >= min_size) & (hs >= min_size) &
-                    (x_ctr < im_info[1]) & (y_ctr < im_info[0]))[0]
-    return keep
+    min_size = min_size * im_info[:, 2, None]
+    ws = boxes[..., 2] - boxes[..., 0] + 1
+    hs = boxes[..., 3] - boxes[..., 1] + 1
+    x_ctr = boxes[..., 0] + ws / 2.
+    y_ctr = boxes[..., 1] + hs / 2.
+    return ((ws >= min_size) & (hs >= min_size) &
+            (x_ctr < im_info[:, 1, None]) & (y_ctr < im_info[:, 0, None]))
+
+
+def _batched_nms(boxes, scores, groups, thresh):
+    """NMS of the boxes of each group at once (see box_utils.batched_nms).
+    Returns the indices of the kept boxes as an ndarray.
+    """
+    if boxes.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    if boxes.is_cuda and nms_gpu is not None:
+        # Move the groups apart; the kernel expects the boxes sorted by score
+        boxes = boxes + groups.to(boxes.dtype)[:, None] * (boxes.max() + 1)
+        scores, order = scores.sort(descending=True)
+        keep = nms_gpu(torch.cat((boxes[order], scores[:, None]), dim=1), thresh)
+        return order[keep.long().view(-1)].cpu().numpy()
+    dets = torch.cat((boxes, scores[:, None]), dim=1).cpu().numpy()
+    return box_utils.batched_nms(dets, groups.cpu().numpy(), thresh)
@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from functools import wraps
 import importlib
 import logging
@@ -20,6 +21,7 @@ import parsingrcnn.modeling.keypoint_rcnn_heads as keypoint_rcnn_heads
 import parsingrcnn.modeling.parsing_rcnn_heads as parsing_rcnn_heads
 import parsingrcnn.modeling.uv_rcnn_heads as uv_rcnn_heads
 import parsingrcnn.utils.blob as blob_utils
+import parsingrcnn.utils.latency as latency_utils
 import parsingrcnn.utils.net as net_utils
 
 logger = logging.getLogger(__name__)
@@ -59,11 +61,13 @@ def check_inference(net_func):
     @wraps(net_func)
     def wrapper(self, *args, **kwargs):
         if not self.training:
-            if cfg.PYTORCH_VERSION_LESS_THAN_040:
-                return net_func(self, *args, **kwargs)
-            else:
-                with torch.no_grad():
+            # Each inference net is a stage of the latency recording
+            with latency_utils.stage(net_func.__name__):
+                if cfg.PYTORCH_VERSION_LESS_THAN_040:
                     return net_func(self, *args, **kwargs)
+                else:
+                    with torch.no_grad():
+                        return net_func(self, *args, **kwargs)
         else:
             raise ValueError('You should call this function only on inference.'
                               'Set the network in inference mode by net.eval().')
@@ -80,6 +84,9 @@ class Generalized_RCNN(nn.Module):
         self.orphans_in_detectron = None
         self.mapping_to_pytorch = None
         self.orphans_in_pytorch = None
+        # RoI features shared between heads, see roi_feature_cache
+        self._roi_feat_cache = None
+        self._roi_feat_blobs = None
 
         # Backbone for feature extraction
         self.Conv_Body = get_func(cfg.MODEL.CONV_BODY)()
@@ -173,13 +180,13 @@ class Generalized_RCNN(nn.Module):
         if self.training:
             roidb = list(map(lambda x: blob_utils.deserialize(x)[0], roidb))
 
-        device_id = im_data.get_device()
-
         return_dict = {}  # A dict to collect return variables
 
-        blob_conv = self.Conv_Body(im_data)
+        with latency_utils.stage('conv_body'):
+            blob_conv = self.Conv_Body(im_data)
 
-        rpn_ret = self.RPN(blob_conv, im_info, roidb)
+        with latency_utils.stage('rpn'):
+            rpn_ret = self.RPN(blob_conv, im_info, roidb)
 
         # if self.training:
         #     # can be used to infer fg/bg ratio
@@ -194,11 +201,12 @@ class Generalized_RCNN(nn.Module):
             return_dict['blob_conv'] = blob_conv
 
         if not cfg.MODEL.RPN_ONLY:
-            if cfg.MODEL.SHARE_RES5 and self.training:
-                box_feat, res5_feat = self.Box_Head(blob_conv, rpn_ret)
-            else:
-                box_feat = self.Box_Head(blob_conv, rpn_ret)
-            cls_score, bbox_pred = self.Box_Outs(box_feat)
+            with latency_utils.stage('box_head'):
+                if cfg.MODEL.SHARE_RES5 and self.training:
+                    box_feat, res5_feat = self.Box_Head(blob_conv, rpn_ret)
+                else:
+                    box_feat = self.Box_Head(blob_conv, rpn_ret)
+                cls_score, bbox_pred = self.Box_Outs(box_feat)
         else:
             # TODO: complete the returns for RPN only situation
             pass
@@ -309,6 +317,26 @@ class Generalized_RCNN(nn.Module):
 
         return return_dict
 
+    @contextmanager
+    def roi_feature_cache(self, blobs_in=None):
+        """Share the RoI features between the heads run in this context (e.g.
+        the mask, keypoint, parsing and uv heads of the same detections): an
+        RoI transform of the same features and rois, with the same method,
+        resolution, spatial scale and sampling ratio, runs only once.
+
+        With blobs_in, only the RoI transforms of these features are cached,
+        e.g. of the test scale image but not of its test-time augmentations,
+        whose features are to be freed after their last use.
+        """
+        saved = self._roi_feat_cache, self._roi_feat_blobs
+        if saved[0] is None:
+            self._roi_feat_cache = {}
+            self._roi_feat_blobs = blobs_in
+        try:
+            yield
+        finally:
+            self._roi_feat_cache, self._roi_feat_blobs = saved
+
     def roi_feature_transform(self, blobs_in, rpn_ret, blob_rois='rois', method='RoIPoolF',
                               resolution=7, spatial_scale=1. / 16., sampling_ratio=0, panet=False):
         """Add the specified RoI pooling method. The sampling_ratio argument
@@ -321,9 +349,37 @@ class Generalized_RCNN(nn.Module):
         assert method in {'RoIPoolF', 'RoICrop', 'RoIAlign'}, \
             'Unknown pooling method: {}'.format(method)
 
+        cache = self._roi_feat_cache
+        if cache is not None and (
+                self._roi_feat_blobs is None or blobs_in is self._roi_feat_blobs):
+            # The heads name their rois differently ('mask_rois', 'parsing_rois',
+            # ...), so the rois are keyed by value
+            key = (
+                id(blobs_in), rpn_ret[blob_rois].tobytes(), method, resolution,
+                tuple(spatial_scale) if isinstance(spatial_scale, list) else spatial_scale,
+                sampling_ratio, panet
+            )
+            if key in cache and cache[key][0] is blobs_in:
+                xform_out = cache[key][1]
+                # The PANet heads replace the items of the list
+                return list(xform_out) if panet else xform_out
+            xform_out = self._roi_feature_transform(
+                blobs_in, rpn_ret, blob_rois, method, resolution, spatial_scale,
+                sampling_ratio, panet)
+            # Holding blobs_in keeps its id from being reused
+            cache[key] = (blobs_in, xform_out)
+            return list(xform_out) if panet else xform_out
+
+        return self._roi_feature_transform(
+            blobs_in, rpn_ret, blob_rois, method, resolution, spatial_scale,
+            sampling_ratio, panet)
+
+    def _roi_feature_transform(self, blobs_in, rpn_ret, blob_rois, method,
+                               resolution, spatial_scale, sampling_ratio, panet):
+
         if isinstance(blobs_in, list):
             # FPN case: add RoIFeatureTransform to each FPN level
-            device_id = blobs_in[0].get_device()
+            device = blobs_in[0].device
             k_max = cfg.FPN.ROI_MAX_LEVEL  # coarsest level of pyramid
             k_min = cfg.FPN.ROI_MIN_LEVEL  # finest level of pyramid
             assert len(blobs_in) == k_max - k_min + 1
@@ -336,7 +392,7 @@ class Generalized_RCNN(nn.Module):
                 else:
                     bl_rois = blob_rois
                 if len(rpn_ret[bl_rois]):
-                    rois = Variable(torch.from_numpy(rpn_ret[bl_rois])).cuda(device_id)
+                    rois = self._rois_to_device(rpn_ret[bl_rois], device)
                     if method == 'RoIPoolF':
                         # Warning!: Not check if implementation matches Detectron
                         xform_out = RoIPoolFunction(resolution, resolution, sc)(bl_in, rois)
@@ -359,10 +415,10 @@ class Generalized_RCNN(nn.Module):
                 xform_shuffled = torch.cat(bl_out_list, dim=0)
 
                 # Unshuffle to match rois from dataloader
-                device_id = xform_shuffled.get_device()
+                device = xform_shuffled.device
                 restore_bl = rpn_ret[blob_rois + '_idx_restore_int32']
                 restore_bl = Variable(
-                    torch.from_numpy(restore_bl.astype('int64', copy=False))).cuda(device_id)
+                    torch.from_numpy(restore_bl.astype('int64', copy=False))).to(device)
                 xform_out = xform_shuffled[restore_bl]
             else:
                 return bl_out_list
@@ -371,8 +427,8 @@ class Generalized_RCNN(nn.Module):
             # rois: holds R regions of interest, each is a 5-tuple
             # (batch_idx, x1, y1, x2, y2) specifying an image batch index and a
             # rectangle (x1, y1, x2, y2)
-            device_id = blobs_in.get_device()
-            rois = Variable(torch.from_numpy(rpn_ret[blob_rois])).cuda(device_id)
+            device = blobs_in.device
+            rois = self._rois_to_device(rpn_ret[blob_rois], device)
             if method == 'RoIPoolF':
                 xform_out = RoIPoolFunction(resolution, resolution, spatial_scale)(blobs_in, rois)
             elif method == 'RoICrop':
@@ -388,6 +444,16 @@ class Generalized_RCNN(nn.Module):
 
         return xform_out
 
+    def _rois_to_device(self, rois, device):
+        """Copy an ndarray of rois to the device, once per roi_feature_cache."""
+        cache = self._roi_feat_cache
+        if cache is None:
+            return Variable(torch.from_numpy(rois)).to(device)
+        key = ('rois', rois.tobytes(), str(device))
+        if key not in cache:
+            cache[key] = Variable(torch.from_numpy(rois)).to(device)
+        return cache[key]
+
     @check_inference
     def convbody_net(self, data):
         """For inference. Run Conv Body only"""
@@ -96,14 +96,14 @@ class parsing_rcnn_outputs(nn.Module):
 
 def parsing_rcnn_losses(parsing_pred, parsing_int32, parsing_weights):
     """Mask R-CNN parsing specific losses."""
-    device_id = parsing_pred.get_device()
+    device = parsing_pred.device
     parsing_pred = torch.transpose(parsing_pred, 1, 3)
     parsing_pred = torch.transpose(parsing_pred, 1, 2)
     parsing_pred = parsing_pred.contiguous().view(-1, cfg.PRCNN.NUM_PARSING)
     parsing_int32 = Variable(torch.from_numpy(
-        parsing_int32.squeeze().astype('int64'))).cuda(device_id)
+        parsing_int32.squeeze().astype('int64'))).to(device)
     parsing_weights = Variable(
-        torch.from_numpy(parsing_weights.squeeze())).cuda(device_id)
+        torch.from_numpy(parsing_weights.squeeze())).to(device)
     loss = F.cross_entropy(parsing_pred, parsing_int32, reduce=False)
     if torch.sum(parsing_weights):
         loss = torch.sum(loss * parsing_weights) / torch.sum(parsing_weights)
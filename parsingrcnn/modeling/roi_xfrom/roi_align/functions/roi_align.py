@@ -1,6 +1,10 @@
 import torch
 from torch.autograd import Function
-from .._ext import roi_align
+try:
+    from .._ext import roi_align
+except ImportError:  # extension not built, e.g. on CPU-only inference hosts
+    roi_align = None
+from .roi_align_cpu import roi_align_forward_cpu
 
 
 # TODO use save_for_backward instead
@@ -27,7 +31,10 @@ class RoIAlignFunction(Function):
                                              self.spatial_scale, self.sampling_ratio, features,
                                              rois, output)
         else:
-            raise NotImplementedError
+            roi_align_forward_cpu(self.aligned_height,
+                                  self.aligned_width,
+                                  self.spatial_scale, self.sampling_ratio, features,
+                                  rois, output)
 
         return output
 
@@ -0,0 +1,65 @@
+"""Pure PyTorch RoIAlign used when the features live on the CPU.
+
+Mirrors the Detectron RoIAlign semantics of the CUDA kernel in
+../src/roi_align_kernel.cu (no half-pixel offset, adaptive sampling grid when
+sampling_ratio <= 0) so the same weights give the same outputs on CPU-only
+inference hosts.
+"""
+import math
+
+import torch
+
+
+def _interp_weights(coords, size):
+    """Return a (len(coords), size) matrix of 1-D bilinear interpolation weights.
+
+    Sampling points outside [-1, size] get zero weight, points inside are
+    clamped to the border exactly as in the CUDA kernel.
+    """
+    valid = ((coords >= -1.0) & (coords <= size)).type_as(coords)
+    coords = coords.clamp(min=0)
+    low = coords.floor().long()
+    over = low >= size - 1
+    low[over] = size - 1
+    high = low + 1
+    high[over] = size - 1
+    coords[over] = low[over].type_as(coords)
+
+    lw = coords - low.type_as(coords)
+    hw = 1. - lw
+    weights = coords.new(coords.size(0), size).zero_()
+    weights.scatter_add_(1, low.unsqueeze(1), (hw * valid).unsqueeze(1))
+    weights.scatter_add_(1, high.unsqueeze(1), (lw * valid).unsqueeze(1))
+    return weights
+
+
+def roi_align_forward_cpu(aligned_height, aligned_width, spatial_scale,
+                          sampling_ratio, features, rois, output):
+    """Same signature as roi_align.roi_align_forward_cuda; fills `output`."""
+    _, num_channels, data_height, data_width = features.size()
+    for n in range(rois.size(0)):
+        batch_ind = int(rois[n, 0])
+        x1, y1, x2, y2 = (rois[n, 1:5] * spatial_scale).tolist()
+        roi_width = max(x2 - x1, 1.)
+        roi_height = max(y2 - y1, 1.)
+        bin_h = roi_height / aligned_height
+        bin_w = roi_width / aligned_width
+        grid_h = sampling_ratio if sampling_ratio > 0 \
+            else int(math.ceil(roi_height / aligned_height))
+        grid_w = sampling_ratio if sampling_ratio > 0 \
+            else int(math.ceil(roi_width / aligned_width))
+
+        # Sampling points are separable in y and x, so bilinear interpolation
+        # reduces to two small matmuls: Wy * F * Wx^T
+        iy = torch.arange(0, aligned_height * grid_h).type_as(features)
+        ix = torch.arange(0, aligned_width * grid_w).type_as(features)
+        ys = y1 + (iy + .5) * bin_h / grid_h
+        xs = x1 + (ix + .5) * bin_w / grid_w
+        wy = _interp_weights(ys, data_height)
+        wx = _interp_weights(xs, data_width)
+
+        sampled = torch.matmul(torch.matmul(wy, features[batch_ind]), wx.t())
+        output[n] = sampled.view(
+            num_channels, aligned_height, grid_h, aligned_width, grid_w
+        ).mean(4).mean(2)
+    return output
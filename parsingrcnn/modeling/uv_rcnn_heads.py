@@ -123,8 +123,7 @@ class uv_rcnn_outputs(nn.Module):
         x_U = self.deconv_U(x)
         x_V = self.deconv_V(x)
 
-        device_id = x_Ann.get_device()
-        x_Ann_zero = torch.zeros(x_Ann.size()[0], 10, x_Ann.size()[2], x_Ann.size()[3]).cuda(device_id)
+        x_Ann_zero = x_Ann.new_zeros(x_Ann.size()[0], 10, x_Ann.size()[2], x_Ann.size()[3])
         x_Ann = torch.cat((x_Ann, x_Ann_zero), dim=1)
         x_Ann = self.upsample_Ann(x_Ann)
         x_Index = self.upsample_Index(x_Index)
@@ -34,7 +34,8 @@ class DataParallel(Module):
 
     Args:
         module: module to be parallelized
-        device_ids: CUDA devices (default: all devices)
+        device_ids: CUDA devices (default: all devices). An empty list keeps
+            the module on the CPU
         output_device: device location of output (default: device_ids[0])
         cpu_keywords: list of argument keywords that could be used in `forward` to
             indicating not moving the argument to gpu. Currently, only support
@@ -52,9 +53,12 @@ class DataParallel(Module):
                  cpu_keywords=[], minibatch=False, batch_outputs=True):
         super(DataParallel, self).__init__()
 
-        if not torch.cuda.is_available():
+        if not torch.cuda.is_available() or device_ids == []:
+            # CPU mode: run the module in-process on whatever device it is on
             self.module = module
             self.device_ids = []
+            self.dim = dim
+            self.minibatch = minibatch
             return
 
         if device_ids is None:
@@ -73,7 +77,14 @@ class DataParallel(Module):
 
     def forward(self, *inputs, **kwargs):
         if not self.device_ids:
-            return self.module(*inputs, **kwargs)
+            if self.minibatch:
+                # Inputs are given as one mini-batch per device; there is
+                # exactly one "device" here
+                inputs = [x[0] for x in inputs]
+                kwargs = dict([(k, v[0]) for k, v in kwargs.items()])
+            # Still gather, so that numpy outputs are converted to Variables
+            # the same way as on the GPU
+            return self.gather([self.module(*inputs, **kwargs)], -1)
 
         if self.minibatch:
             inputs_list, kwargs_list = [], []
@@ -62,6 +62,9 @@ def gather(outputs, target_device, dim=0):
         out = outputs[0]
         elem_type = type(out)
         if isinstance(out, Variable):
+            if target_device == -1 and len(outputs) == 1 and not out.is_cuda:
+                # Single output already on the CPU (CPU inference)
+                return out
             return Gather.apply(target_device, dim, *outputs)
         if out is None:
             return None
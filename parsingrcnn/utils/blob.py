@@ -61,6 +61,34 @@ def get_image_blob(im, target_scale, target_max_size):
     return blob, im_scale, im_info.astype(np.float32)
 
 
+def get_image_list_blob(ims, target_scale, target_max_size):
+    """Convert a list of images into a single (padded) network input.
+
+    Arguments:
+        ims (list): color images in BGR order
+
+    Returns:
+        blob (ndarray): a data blob holding all images
+        im_scales (ndarray): per image scale factors
+        im_info (ndarray): N x 3 array of [height, width, scale]. Height and
+            width are the ones get_image_blob would give for the image alone,
+            so that proposals are clipped the same way as without batching
+    """
+    processed_ims = []
+    im_scales = []
+    im_info = []
+    for im in ims:
+        processed_im, im_scale = prep_im_for_blob(
+            im, cfg.PIXEL_MEANS, cfg.PIXEL_STDS, [target_scale], target_max_size
+        )
+        height, width = get_max_shape([processed_im[0].shape[:2]])
+        processed_ims.append(processed_im[0])
+        im_scales.append(im_scale[0])
+        im_info.append([height, width, im_scale[0]])
+    blob = im_list_to_blob(processed_ims)
+    return blob, np.array(im_scales), np.array(im_info, dtype=np.float32)
+
+
 def im_list_to_blob(ims):
     """Convert a list of images into a network input. Assumes images were
     prepared using prep_im_for_blob or equivalent: i.e.
@@ -49,10 +49,62 @@ import warnings
 import numpy as np
 
 from parsingrcnn.core.config import cfg
-import parsingrcnn.utils.cython_bbox as cython_bbox
-import parsingrcnn.utils.cython_nms as cython_nms
-
-bbox_overlaps = cython_bbox.bbox_overlaps
+try:
+    import parsingrcnn.utils.cython_bbox as cython_bbox
+    import parsingrcnn.utils.cython_nms as cython_nms
+except ImportError:  # extensions not built; fall back to numpy
+    cython_bbox = None
+    cython_nms = None
+
+
+def _bbox_overlaps(boxes, query_boxes):
+    """Numpy version of cython_bbox.bbox_overlaps."""
+    boxes = boxes.astype(np.float32, copy=False)
+    query_boxes = query_boxes.astype(np.float32, copy=False)
+    iw = (
+        np.minimum(boxes[:, np.newaxis, 2], query_boxes[np.newaxis, :, 2]) -
+        np.maximum(boxes[:, np.newaxis, 0], query_boxes[np.newaxis, :, 0]) + 1
+    )
+    ih = (
+        np.minimum(boxes[:, np.newaxis, 3], query_boxes[np.newaxis, :, 3]) -
+        np.maximum(boxes[:, np.newaxis, 1], query_boxes[np.newaxis, :, 1]) + 1
+    )
+    inter = np.maximum(iw, 0) * np.maximum(ih, 0)
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    query_areas = (
+        (query_boxes[:, 2] - query_boxes[:, 0] + 1) *
+        (query_boxes[:, 3] - query_boxes[:, 1] + 1)
+    )
+    ua = areas[:, np.newaxis] + query_areas[np.newaxis, :] - inter
+    return np.where(inter > 0, inter / np.maximum(ua, 1e-12), 0).astype(np.float32)
+
+
+def _nms(dets, thresh):
+    """Numpy version of cython_nms.nms."""
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = dets[:, 4].argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        xx1 = np.maximum(x1[i], x1[order[1:]])
+        yy1 = np.maximum(y1[i], y1[order[1:]])
+        xx2 = np.minimum(x2[i], x2[order[1:]])
+        yy2 = np.minimum(y2[i], y2[order[1:]])
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[order[1:]] - inter)
+        order = order[1:][ovr < thresh]
+    return np.sort(np.array(keep, dtype=np.int64))
+
+
+bbox_overlaps = cython_bbox.bbox_overlaps if cython_bbox is not None else _bbox_overlaps
 
 
 def boxes_area(boxes):
@@ -321,9 +373,26 @@ def nms(dets, thresh):
     """Apply classic DPM-style greedy NMS."""
     if dets.shape[0] == 0:
         return []
+    if cython_nms is None:
+        return _nms(dets, thresh)
     return cython_nms.nms(dets, thresh)
 
 
+def batched_nms(dets, groups, thresh):
+    """Apply greedy NMS to the detections of each group (e.g. class) in a
+    single pass: the boxes of each group are moved apart so that boxes of
+    different groups never overlap. Returns the indices of the kept detections
+    in increasing order, like nms.
+    """
+    if dets.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    lo = dets[:, :4].min()
+    span = dets[:, :4].max() - lo + 1
+    dets = dets.astype(np.float32, copy=True)
+    dets[:, :4] += ((groups - groups.min()) * span - lo).astype(np.float32)[:, np.newaxis]
+    return np.asarray(nms(dets, thresh), dtype=np.int64)
+
+
 def soft_nms(
     dets, sigma=0.5, overlap_thresh=0.3, score_thresh=0.001, method='linear'
 ):
@@ -331,6 +400,7 @@ def soft_nms(
     if dets.shape[0] == 0:
         return dets, []
 
+    assert cython_nms is not None, 'Soft NMS needs the compiled cython_nms extension'
     methods = {'hard': 0, 'linear': 1, 'gaussian': 2}
     assert method in methods, 'Unknown soft_nms method: {}'.format(method)
 
@@ -42,20 +42,32 @@ def add_multilevel_roi_blobs(
     lvl_min: the finest (highest resolution) FPN level (e.g., 2)
     lvl_max: the coarest (lowest resolution) FPN level (e.g., 6)
     """
-    rois_idx_order = np.empty((0, ))
-    rois_stacked = np.zeros((0, 5), dtype=np.float32)  # for assert
     # target_lvls = remove_negative_area_roi_blobs(blobs, blob_prefix, rois, target_lvls)
-    for lvl in range(lvl_min, lvl_max + 1):
-        idx_lvl = np.where(target_lvls == lvl)[0]
-        blobs[blob_prefix + '_fpn' + str(lvl)] = rois[idx_lvl, :]
-        rois_idx_order = np.concatenate((rois_idx_order, idx_lvl))
-        rois_stacked = np.vstack(
-            [rois_stacked, blobs[blob_prefix + '_fpn' + str(lvl)]]
-        )
-    rois_idx_restore = np.argsort(rois_idx_order).astype(np.int32, copy=False)
+    rois_lvls, rois_idx_restore = split_rois_by_level(rois, target_lvls, lvl_min, lvl_max)
+    for lvl, rois_lvl in zip(range(lvl_min, lvl_max + 1), rois_lvls):
+        blobs[blob_prefix + '_fpn' + str(lvl)] = rois_lvl
     blobs[blob_prefix + '_idx_restore_int32'] = rois_idx_restore
-    # Sanity check that restore order is correct
-    assert (rois_stacked[rois_idx_restore] == rois).all()
+
+
+def split_rois_by_level(rois, target_lvls, lvl_min, lvl_max):
+    """Split rois by their FPN level with a single stable sort.
+
+    Returns the rois of each level from lvl_min to lvl_max (in their original
+    relative order) and rois_idx_restore, the int32 permutation restoring the
+    original order of the rois from the concatenation of the levels.
+    """
+    order = np.argsort(target_lvls, kind='mergesort')
+    starts = np.searchsorted(target_lvls[order], np.arange(lvl_min, lvl_max + 2))
+    rois_sorted = rois[order]
+    rois_lvls = [
+        rois_sorted[starts[i]:starts[i + 1]] for i in range(lvl_max - lvl_min + 1)
+    ]
+    rois_idx_restore = np.empty(len(order), dtype=np.int32)
+    rois_idx_restore[order] = np.arange(len(order), dtype=np.int32)
+    if cfg.DEBUG:
+        # Sanity check that restore order is correct
+        assert (np.vstack(rois_lvls)[rois_idx_restore] == rois).all()
+    return rois_lvls, rois_idx_restore
 
 
 def remove_negative_area_roi_blobs(blobs, blob_prefix, rois, target_lvls):
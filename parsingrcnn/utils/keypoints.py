@@ -90,13 +90,14 @@ def flip_keypoints(keypoints, keypoint_flip_map, keypoint_coords, width):
 def flip_heatmaps(heatmaps):
     """Flip heatmaps horizontally."""
     keypoints, flip_map = get_keypoints()
-    heatmaps_flipped = heatmaps.copy()
+    flip_inds = np.arange(len(keypoints))
     for lkp, rkp in flip_map.items():
         lid = keypoints.index(lkp)
         rid = keypoints.index(rkp)
-        heatmaps_flipped[:, rid, :, :] = heatmaps[:, lid, :, :]
-        heatmaps_flipped[:, lid, :, :] = heatmaps[:, rid, :, :]
-    heatmaps_flipped = heatmaps_flipped[:, :, :, ::-1]
+        flip_inds[rid] = lid
+        flip_inds[lid] = rid
+    # Swap the left and right channels and flip them in one indexing op
+    heatmaps_flipped = heatmaps[:, flip_inds, :, ::-1]
     return heatmaps_flipped
 
 
@@ -110,49 +111,33 @@ def heatmaps_to_keypoints(maps, rois):
     # consistency with keypoints_to_heatmap_labels by using the conversion from
     # Heckbert 1990: c = d + 0.5, where d is a discrete coordinate and c is a
     # continuous coordinate.
-    offset_x = rois[:, 0]
-    offset_y = rois[:, 1]
-
-    widths = rois[:, 2] - rois[:, 0]
-    heights = rois[:, 3] - rois[:, 1]
-    widths = np.maximum(widths, 1)
-    heights = np.maximum(heights, 1)
-    widths_ceil = np.ceil(widths)
-    heights_ceil = np.ceil(heights)
+    offset_x, offset_y, roi_map_widths, roi_map_heights, width_corrections, \
+        height_corrections = _get_roi_map_sizes(rois)
 
     # NCHW to NHWC for use with OpenCV
     maps = np.transpose(maps, [0, 2, 3, 1])
-    min_size = cfg.KRCNN.INFERENCE_MIN_SIZE
-    xy_preds = np.zeros(
-        (len(rois), 4, cfg.KRCNN.NUM_KEYPOINTS), dtype=np.float32)
+    K = cfg.KRCNN.NUM_KEYPOINTS
+    xy_preds = np.zeros((len(rois), 4, K), dtype=np.float32)
+    pos = np.zeros((len(rois), K), dtype=np.int64)
+    w = np.ones((len(rois), 1), dtype=np.int64)
     for i in range(len(rois)):
-        if min_size > 0:
-            roi_map_width = int(np.maximum(widths_ceil[i], min_size))
-            roi_map_height = int(np.maximum(heights_ceil[i], min_size))
-        else:
-            roi_map_width = widths_ceil[i]
-            roi_map_height = heights_ceil[i]
-        width_correction = widths[i] / roi_map_width
-        height_correction = heights[i] / roi_map_height
+        # Only the bicubic upsampling to the size of each roi runs per roi
         roi_map = cv2.resize(
-            maps[i], (roi_map_width, roi_map_height),
+            maps[i], (int(roi_map_widths[i]), int(roi_map_heights[i])),
             interpolation=cv2.INTER_CUBIC)
-        # Bring back to CHW
-        roi_map = np.transpose(roi_map, [2, 0, 1])
-        roi_map_probs = scores_to_probs(roi_map.copy())
-        w = roi_map.shape[2]
-        for k in range(cfg.KRCNN.NUM_KEYPOINTS):
-            pos = roi_map[k, :, :].argmax()
-            x_int = pos % w
-            y_int = (pos - x_int) // w
-            assert (roi_map_probs[k, y_int, x_int] ==
-                    roi_map_probs[k, :, :].max())
-            x = (x_int + 0.5) * width_correction
-            y = (y_int + 0.5) * height_correction
-            xy_preds[i, 0, k] = x + offset_x[i]
-            xy_preds[i, 1, k] = y + offset_y[i]
-            xy_preds[i, 2, k] = roi_map[k, y_int, x_int]
-            xy_preds[i, 3, k] = roi_map_probs[k, y_int, x_int]
+        w[i] = roi_map.shape[1]
+        # Bring back to CHW, flattened
+        roi_map = np.ascontiguousarray(roi_map.reshape(-1, K).T)
+        pos[i] = roi_map.argmax(axis=1)
+        xy_preds[i, 2] = roi_map[np.arange(K), pos[i]]
+        xy_preds[i, 3] = _spatial_probs_at(roi_map, xy_preds[i, 2])
+
+    x_int = pos % w
+    y_int = (pos - x_int) // w
+    x = (x_int + 0.5) * width_corrections[:, np.newaxis]
+    y = (y_int + 0.5) * height_corrections[:, np.newaxis]
+    xy_preds[:, 0] = x + offset_x[:, np.newaxis]
+    xy_preds[:, 1] = y + offset_y[:, np.newaxis]
 
     return xy_preds
 
@@ -167,53 +152,28 @@ def fast_heatmaps_to_keypoints(maps, rois):
     # consistency with keypoints_to_heatmap_labels by using the conversion from
     # Heckbert 1990: c = d + 0.5, where d is a discrete coordinate and c is a
     # continuous coordinate.
-    offset_x = rois[:, 0]
-    offset_y = rois[:, 1]
-
-    widths = rois[:, 2] - rois[:, 0]
-    heights = rois[:, 3] - rois[:, 1]
-    widths = np.maximum(widths, 1)
-    heights = np.maximum(heights, 1)
-    widths_ceil = np.ceil(widths)
-    heights_ceil = np.ceil(heights)
-
-    # NCHW to NHWC for use with OpenCV
-    maps = np.transpose(maps, [0, 2, 3, 1])
-    min_size = cfg.KRCNN.INFERENCE_MIN_SIZE  # default 0
-    xy_preds = np.zeros(
-        (len(rois), 4, cfg.KRCNN.NUM_KEYPOINTS), dtype=np.float32)
-    for i in range(len(rois)):
-        if min_size > 0:
-            roi_map_width = int(np.maximum(widths_ceil[i], min_size))
-            roi_map_height = int(np.maximum(heights_ceil[i], min_size))
-        else:
-            roi_map_width = widths_ceil[i]
-            roi_map_height = heights_ceil[i]
-        width_correction = widths[i] / roi_map_width
-        height_correction = heights[i] / roi_map_height
-
-        # roi_map = cv2.resize(
-        #     maps[i], (roi_map_width, roi_map_height),
-        #     interpolation=cv2.INTER_CUBIC)
-        # Bring back to CHW
-        roi_map = maps[i].copy()  # add
-        roi_map = np.transpose(roi_map, [2, 0, 1])  # HWC to CHW
-        roi_map_probs = scores_to_probs(roi_map.copy())
-        w = roi_map.shape[2]
-        for k in range(cfg.KRCNN.NUM_KEYPOINTS):
-            pos = roi_map[k, :, :].argmax()
-            x_int = pos % w
-            y_int = (pos - x_int) // w
-            assert (roi_map_probs[k, y_int, x_int] ==
-                    roi_map_probs[k, :, :].max())
-            x = (x_int * float(roi_map_width / w) + 0.5) * width_correction  # add
-            y = (y_int * float(roi_map_height / w) + 0.5) * height_correction  # add
-            # x = (x_int + 0.5) * width_correction
-            # y = (y_int + 0.5) * height_correction
-            xy_preds[i, 0, k] = x + offset_x[i]
-            xy_preds[i, 1, k] = y + offset_y[i]
-            xy_preds[i, 2, k] = roi_map[k, y_int, x_int]
-            xy_preds[i, 3, k] = roi_map_probs[k, y_int, x_int]
+    offset_x, offset_y, roi_map_widths, roi_map_heights, width_corrections, \
+        height_corrections = _get_roi_map_sizes(rois)
+
+    # The heatmaps are not resized, so all rois and keypoints go at once
+    R, K, H, W = maps.shape
+    scores = np.ascontiguousarray(maps.reshape(R * K, H * W))
+    pos = scores.argmax(axis=1)
+    logits = scores[np.arange(R * K), pos]
+    xy_preds = np.zeros((R, 4, K), dtype=np.float32)
+    xy_preds[:, 2] = logits.reshape(R, K)
+    xy_preds[:, 3] = _spatial_probs_at(scores, logits).reshape(R, K)
+
+    pos = pos.reshape(R, K)
+    x_int = pos % W
+    y_int = (pos - x_int) // W
+    # Size of a heatmap cell in the roi map (the heatmaps are square)
+    x_step = (roi_map_widths / W).astype(np.float64)[:, np.newaxis]
+    y_step = (roi_map_heights / W).astype(np.float64)[:, np.newaxis]
+    x = (x_int * x_step + 0.5) * width_corrections[:, np.newaxis]
+    y = (y_int * y_step + 0.5) * height_corrections[:, np.newaxis]
+    xy_preds[:, 0] = x + offset_x[:, np.newaxis]
+    xy_preds[:, 1] = y + offset_y[:, np.newaxis]
 
     return xy_preds
 
@@ -228,6 +188,66 @@ def gauss_heatmaps_to_keypoints(maps, rois):
     # consistency with keypoints_to_heatmap_labels by using the conversion from
     # Heckbert 1990: c = d + 0.5, where d is a discrete coordinate and c is a
     # continuous coordinate.
+    offset_x, offset_y, roi_map_widths, roi_map_heights, _, _ = _get_roi_map_sizes(rois)
+
+    # NCHW to NHWC for use with OpenCV
+    maps = np.transpose(maps, [0, 2, 3, 1])
+    K = cfg.KRCNN.NUM_KEYPOINTS
+    kps = np.arange(K)
+    border = 10
+    delta = 0.25
+    xy_preds = np.zeros((len(rois), 4, K), dtype=np.float32)
+    for i in range(len(rois)):
+        roi_map_width = roi_map_widths[i]
+        roi_map_height = roi_map_heights[i]
+        roi_map = cv2.resize(
+            maps[i], (int(roi_map_width), int(roi_map_height)),
+            interpolation=cv2.INTER_CUBIC)
+        h, w = roi_map.shape[:2]
+        roi_map = roi_map.reshape(h, w, K)
+
+        # Blur the normalized maps of all keypoints at once (as channels),
+        # zero padded by border pixels
+        dr_h = int(roi_map_height) + 2 * border
+        dr_w = int(roi_map_width) + 2 * border
+        dr = np.zeros((dr_h, dr_w, K))
+        dr[border:-border, border:-border] = \
+            roi_map / np.amax(roi_map.reshape(-1, K), axis=0)
+        dr = cv2.GaussianBlur(dr, (21, 21), 0).reshape(-1, K)
+        # Move from the peak a quarter pixel towards the second highest value
+        lb = dr.argmax(axis=0)
+        y, x = np.unravel_index(lb, (dr_h, dr_w))
+        dr[lb, kps] = 0
+        py, px = np.unravel_index(dr.argmax(axis=0), (dr_h, dr_w))
+        y = y - border
+        y_int = y
+        x = x - border
+        x_int = x
+        py = py - (border + y)
+        px = px - (border + x)
+        ln = (px ** 2 + py ** 2) ** 0.5
+        moved = ln > 1e-3
+        ln = np.where(moved, ln, 1)
+        x = np.where(moved, x + delta * px / ln, x)
+        y = np.where(moved, y + delta * py / ln, y)
+        x = np.maximum(0, np.minimum(x, roi_map_width))
+        y = np.maximum(0, np.minimum(y, roi_map_height))
+
+        roi_map = np.ascontiguousarray(np.transpose(roi_map, [2, 0, 1]))
+        logits = roi_map[kps, y_int, x_int]
+        xy_preds[i, 0] = x + offset_x[i]
+        xy_preds[i, 1] = y + offset_y[i]
+        xy_preds[i, 2] = logits
+        xy_preds[i, 3] = _spatial_probs_at(roi_map.reshape(K, -1), logits)
+
+    return xy_preds
+
+
+def _get_roi_map_sizes(rois):
+    """Return the top left corners (offset_x, offset_y) of the rois, the size
+    (roi_map_widths, roi_map_heights) their heatmaps are resized to and the
+    (width_corrections, height_corrections) from that size to the rois.
+    """
     offset_x = rois[:, 0]
     offset_y = rois[:, 1]
 
@@ -238,59 +258,27 @@ def gauss_heatmaps_to_keypoints(maps, rois):
     widths_ceil = np.ceil(widths)
     heights_ceil = np.ceil(heights)
 
-    # NCHW to NHWC for use with OpenCV
-    maps = np.transpose(maps, [0, 2, 3, 1])
     min_size = cfg.KRCNN.INFERENCE_MIN_SIZE
-    xy_preds = np.zeros(
-        (len(rois), 4, cfg.KRCNN.NUM_KEYPOINTS), dtype=np.float32)
-    for i in range(len(rois)):
-        if min_size > 0:
-            roi_map_width = int(np.maximum(widths_ceil[i], min_size))
-            roi_map_height = int(np.maximum(heights_ceil[i], min_size))
-        else:
-            roi_map_width = widths_ceil[i]
-            roi_map_height = heights_ceil[i]
-        width_correction = widths[i] / roi_map_width
-        height_correction = heights[i] / roi_map_height
-        roi_map = cv2.resize(
-            maps[i], (roi_map_width, roi_map_height),
-            interpolation=cv2.INTER_CUBIC)
-        # Bring back to CHW
-        roi_map = np.transpose(roi_map, [2, 0, 1])
-        roi_map_probs = scores_to_probs(roi_map.copy())
-        w = roi_map.shape[2]
-        for k in range(cfg.KRCNN.NUM_KEYPOINTS):
-            border = 10
-            single_map = roi_map[k] / np.amax(roi_map[k])
-            dr = np.zeros((int(roi_map_height) + 2*border, 
-                int(roi_map_width) + 2*border))
-
-            dr[border:-border, border:-border] = single_map.copy()
-            dr = cv2.GaussianBlur(dr, (21, 21), 0)
-            lb = dr.argmax()
-            y, x = np.unravel_index(lb, dr.shape)
-            dr[y, x] = 0
-            lb = dr.argmax()
-            py, px = np.unravel_index(lb, dr.shape)
-            y -= border
-            y_int = y
-            x -= border
-            x_int = x
-            py -= border + y
-            px -= border + x
-            ln = (px ** 2 + py ** 2) ** 0.5
-            delta = 0.25
-            if ln > 1e-3:
-                x += delta * px / ln
-                y += delta * py / ln
-            x = max(0, min(x, roi_map_width))
-            y = max(0, min(y, roi_map_height))
-            xy_preds[i, 0, k] = x + offset_x[i]
-            xy_preds[i, 1, k] = y + offset_y[i]
-            xy_preds[i, 2, k] = roi_map[k, y_int, x_int]
-            xy_preds[i, 3, k] = roi_map_probs[k, y_int, x_int]
-
-    return xy_preds
+    if min_size > 0:
+        roi_map_widths = np.maximum(widths_ceil, min_size).astype(np.int64)
+        roi_map_heights = np.maximum(heights_ceil, min_size).astype(np.int64)
+    else:
+        roi_map_widths = widths_ceil
+        roi_map_heights = heights_ceil
+    # In the precision of the rois, as with per roi scalars
+    width_corrections = (widths / roi_map_widths).astype(widths.dtype)
+    height_corrections = (heights / roi_map_heights).astype(heights.dtype)
+    return (offset_x, offset_y, roi_map_widths, roi_map_heights,
+            width_corrections, height_corrections)
+
+
+def _spatial_probs_at(scores, values):
+    """Probabilities, as given by scores_to_probs for each of the N x HW
+    flattened heatmaps scores, of a score value of each heatmap.
+    """
+    max_scores = scores.max(axis=1)
+    sums = np.sum(np.exp(scores - max_scores[:, np.newaxis]), axis=1)
+    return np.exp(values - max_scores) / sums
 
 
 def keypoints_to_heatmap_labels(keypoints, rois):
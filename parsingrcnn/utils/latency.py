@@ -0,0 +1,223 @@
+"""Per-stage latency recording for inference.
+
+A LatencyRecorder is a drop-in replacement for the `defaultdict(Timer)` of
+timers passed through test_net / im_detect_all: each timer is a stage, and
+every tic / toc pair is recorded as one sample. Stages opened inside another
+one (with `stage(name)`, or a timer ticked while another one runs in the same
+thread) are recorded under the path of their parents, e.g.
+
+    decode, preprocess                         (prefetch threads)
+    im_detect_bbox/conv_body, .../rpn, .../box_head
+    misc_bbox                                  (score threshold and NMS)
+    im_detect_parsing/parsing_net, misc_parsing, ...
+    parsing2png, vis, result_io
+
+`stage(name)` is a no-op unless a recorder is active (see `activate`), so
+the model code can be instrumented unconditionally. At the end of a run, `write` exports count, mean and
+p50 / p90 / p99 of each stage as JSON and CSV.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import csv
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+import torch
+
+from parsingrcnn.utils.timer import Timer
+
+# Recorder that stage() records into, set by LatencyRecorder.activate
+_active = None
+
+_PERCENTILES = (50, 90, 99)
+
+
+@contextmanager
+def _null_stage():
+    yield
+
+
+def stage(name):
+    """Context manager recording the time spent in a stage to the active
+    recorder, if any.
+    """
+    if _active is None:
+        return _null_stage()
+    return _active.stage(name)
+
+
+def activate(timers):
+    """Context manager making stage() record into timers if it is a
+    LatencyRecorder (no-op for other timers).
+    """
+    if isinstance(timers, LatencyRecorder):
+        return timers.activate()
+    return _null_stage()
+
+
+class StageTimer(Timer):
+    """Timer recording each tic / toc pair as a sample of its stage."""
+
+    def __init__(self, recorder, name):
+        self._recorder = recorder
+        self._name = name
+        super(StageTimer, self).__init__()
+
+    def tic(self):
+        self._path = self._recorder._push(self._name)
+        super(StageTimer, self).tic()
+
+    def toc(self, average=True):
+        self._recorder._sync()
+        result = super(StageTimer, self).toc(average)
+        self._recorder._pop(self._path, self.diff)
+        return result
+
+
+class LatencyRecorder(dict):
+    """Stage timers (as a dict of Timers) with the samples of every stage,
+    including the sub-stages, which are not entries of the dict.
+    """
+
+    def __init__(self, cuda_sync=False):
+        super(LatencyRecorder, self).__init__()
+        # Wait for queued CUDA kernels at the end of each stage, so that they
+        # are counted in the stage that launched them
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.samples = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __missing__(self, name):
+        timer = self[name] = StageTimer(self, name)
+        return timer
+
+    @contextmanager
+    def activate(self):
+        """Make stage() record into this recorder."""
+        global _active
+        saved = _active
+        _active = self
+        try:
+            yield self
+        finally:
+            _active = saved
+
+    @contextmanager
+    def stage(self, name):
+        path = self._push(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._sync()
+            self._pop(path, time.time() - start)
+
+    def add(self, path, seconds):
+        with self._lock:
+            self.samples.setdefault(path, []).append(seconds)
+
+    def summary(self):
+        """Return an OrderedDict of per stage statistics (in seconds)."""
+        summary = OrderedDict()
+        with self._lock:
+            samples = [(path, np.array(s)) for path, s in self.samples.items()]
+        for path, values in sorted(samples):
+            stats = OrderedDict([
+                ('count', int(values.size)),
+                ('total', float(values.sum())),
+                ('mean', float(values.mean()))
+            ])
+            for q, value in zip(_PERCENTILES, np.percentile(values, _PERCENTILES)):
+                stats['p%d' % q] = float(value)
+            stats['max'] = float(values.max())
+            summary[path] = stats
+        return summary
+
+    def write(self, output_dir, name):
+        """Write the summary to {name}.json and {name}.csv in output_dir and
+        return the paths.
+        """
+        summary = self.summary()
+        json_file = os.path.join(output_dir, name + '.json')
+        with open(json_file, 'w') as f:
+            json.dump(summary, f, indent=2)
+        csv_file = os.path.join(output_dir, name + '.csv')
+        with open(csv_file, 'w') as f:
+            writer = csv.writer(f)
+            fields = ['count', 'total', 'mean'] + ['p%d' % q for q in _PERCENTILES] + ['max']
+            writer.writerow(['stage'] + fields)
+            for path, stats in summary.items():
+                writer.writerow([path] + [stats[k] for k in fields])
+        return json_file, csv_file
+
+    def format_summary(self):
+        """Summary as log friendly lines, in milliseconds."""
+        lines = ['{:<40} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+            'stage', 'count', 'mean', 'p50', 'p90', 'p99')]
+        for path, stats in self.summary().items():
+            lines.append('{:<40} {:>7d} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                path, stats['count'], 1000 * stats['mean'], 1000 * stats['p50'],
+                1000 * stats['p90'], 1000 * stats['p99']))
+        return '\n'.join(lines)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _push(self, name):
+        stack = self._stack()
+        stack.append(name)
+        return '/'.join(stack)
+
+    def _pop(self, path, seconds):
+        stack = self._stack()
+        if stack:
+            stack.pop()
+        self.add(path, seconds)
+
+    def _sync(self):
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+
+
+class SampledProfiler(object):
+    """Capture a torch.autograd.profiler trace of every `every`-th call of
+    `profile`, up to `limit` traces, as chrome traces in output_dir.
+    """
+
+    def __init__(self, output_dir, every=0, limit=10):
+        self.output_dir = output_dir
+        self.every = every
+        self.limit = limit
+        self.num_calls = 0
+        self.num_traces = 0
+
+    @contextmanager
+    def profile(self, name):
+        sampled = (
+            self.every > 0 and self.num_traces < self.limit and
+            self.num_calls % self.every == 0
+        )
+        self.num_calls += 1
+        if not sampled:
+            yield
+            return
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        with torch.autograd.profiler.profile(
+                use_cuda=torch.cuda.is_available()) as prof:
+            yield
+        prof.export_chrome_trace(os.path.join(self.output_dir, name + '.json'))
+        self.num_traces += 1
@@ -274,6 +274,39 @@ def voc_ap(rec, prec, use_07_metric=False):
     return ap
 
 
+def encode_parsing(parsing, x_0, y_0, im_h, im_w):
+    """Box-local representation of an instance parsing: the uint8 label map of
+    the part of the instance box inside the image, its top left corner in the
+    image and the image size. Memory scales with the instance area instead of
+    the image area.
+    """
+    return {
+        'parsing': parsing.astype(np.uint8, copy=False),
+        'offset': (int(x_0), int(y_0)),
+        'size': (int(im_h), int(im_w))
+    }
+
+
+def parsing_crop(parsing):
+    """Return the label map of an instance parsing and its top left corner
+    (x_0, y_0) in the image. Full image label maps are supported too.
+    """
+    if isinstance(parsing, dict):
+        x_0, y_0 = parsing['offset']
+        return parsing['parsing'], x_0, y_0
+    return parsing, 0, 0
+
+
+def decode_parsing(parsing):
+    """Return the full image label map of an instance parsing."""
+    if not isinstance(parsing, dict):
+        return parsing
+    crop, x_0, y_0 = parsing_crop(parsing)
+    im_parsing = np.zeros(parsing['size'], dtype=np.uint8)
+    im_parsing[y_0:y_0 + crop.shape[0], x_0:x_0 + crop.shape[1]] = crop
+    return im_parsing
+
+
 def cal_one_mean_iou(image_array, label_array, NUM_CLASSES):
     hist = fast_hist(label_array, image_array, NUM_CLASSES).astype(np.float)
     num_cor_pix = np.diag(hist)
@@ -283,6 +316,24 @@ def cal_one_mean_iou(image_array, label_array, NUM_CLASSES):
     return iu
 
 
+def cal_one_mean_iou_parsing(parsing, label_array, NUM_CLASSES):
+    """Same as cal_one_mean_iou for an instance parsing (see encode_parsing),
+    without building its full image label map: ground truth pixels outside
+    the box count as predicted background.
+    """
+    crop, x_0, y_0 = parsing_crop(parsing)
+    label_crop = label_array[y_0:y_0 + crop.shape[0], x_0:x_0 + crop.shape[1]]
+    hist = fast_hist(label_crop, crop, NUM_CLASSES).astype(np.float)
+    k = label_array < NUM_CLASSES
+    k_crop = label_crop < NUM_CLASSES
+    hist[:, 0] += np.bincount(label_array[k], minlength=NUM_CLASSES) - \
+        np.bincount(label_crop[k_crop], minlength=NUM_CLASSES)
+    num_cor_pix = np.diag(hist)
+    num_gt_pix = hist.sum(1)
+    iu = num_cor_pix / (num_gt_pix + hist.sum(0) - num_cor_pix)
+    return iu
+
+
 def get_gt():
     assert len(cfg.TEST.DATASETS) == 1, \
         'Parsing only support one dataset now'
@@ -327,24 +378,49 @@ def eval_seg_ap(all_boxes, all_parsings):
     ovthresh_seg = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
     confidence = []
     image_ids  = []
-    Local_segs_ptr = []
+    ovmaxs = []
+    jmaxs = []
+    seg_iou_maxs = []
+    pcp_ds = []
+
+    class_recs_temp, npos = get_gt()
+
+    # Match every parsing with the ground truth of its image. The parsings are
+    # visited in image order, so that they can be streamed from the result
+    # store and the ground truth of each image is read only once
+    for img_index in trange(len(all_parsings), desc='Calculating IoU ..'):
+        parsings = all_parsings[img_index]
+        if len(parsings) == 0:
+            continue
+        masks_gt = [cv2.imread(anno_add, 0)
+                    for anno_add in class_recs_temp[img_index]['anno_adds']]
+        boxes = all_boxes[img_index]
+        for idx, mask_pred in enumerate(parsings):
+            ovmax = -np.inf
+            jmax = -1
+            seg_iou_max = None
+            pcp_d = 0
+            for i, mask_gt in enumerate(masks_gt):
+                seg_iou = cal_one_mean_iou_parsing(mask_pred, mask_gt, nb_class)
+
+                mean_seg_iou = np.nanmean(seg_iou)
+                if mean_seg_iou > ovmax:
+                    ovmax = mean_seg_iou
+                    seg_iou_max = seg_iou
+                    jmax = i
+                    mask_gt_u = np.unique(mask_gt)
+                    pcp_d = len(mask_gt_u[np.logical_and(mask_gt_u>0, mask_gt_u<nb_class)])
 
-    for img_index, parsings in enumerate(all_parsings):
-        for idx, rect in enumerate(parsings):
-            score = all_boxes[img_index][idx][4]
             image_ids.append(img_index)
-            confidence.append(score)
-            Local_segs_ptr.append(idx)
+            confidence.append(boxes[idx][4])
+            ovmaxs.append(ovmax)
+            jmaxs.append(jmax)
+            seg_iou_maxs.append(seg_iou_max)
+            pcp_ds.append(pcp_d)
 
     confidence = np.array(confidence)
-    Local_segs_ptr = np.array(Local_segs_ptr)
-
     sorted_ind = np.argsort(-confidence)
-    sorted_scores = np.sort(-confidence)
-    Local_segs_ptr = Local_segs_ptr[sorted_ind]
-    image_ids =  [image_ids[x]  for x in sorted_ind]
 
-    class_recs_temp, npos = get_gt()
     class_recs = [copy.deepcopy(class_recs_temp) for _ in range(len(ovthresh_seg))]
     nd = len(image_ids)
     tp_seg = [np.zeros(nd) for _ in range(len(ovthresh_seg))]
@@ -352,36 +428,20 @@ def eval_seg_ap(all_boxes, all_parsings):
     pcp_list= [[] for _ in range(len(ovthresh_seg))]
 
     for d in trange(nd, desc='Calculating AP and PCP ..'):
+        k = sorted_ind[d]
         R = []
         for j in range(len(ovthresh_seg)):
-            R.append(class_recs[j][image_ids[d]])
-        ovmax = -np.inf
-        jmax = -1
-
-        parsings = all_parsings[image_ids[d]]
-        mask0 = parsings[Local_segs_ptr[d]]
-
-        mask_pred = mask0.astype(np.int)
-
-        for i in range(len(R[0]['anno_adds'])):
-            mask_gt = cv2.imread(R[0]['anno_adds'][i], 0)
-
-            seg_iou= cal_one_mean_iou(mask_pred.astype(np.uint8), mask_gt, nb_class)
-
-            mean_seg_iou = np.nanmean(seg_iou)
-            if mean_seg_iou > ovmax:
-                ovmax =  mean_seg_iou
-                seg_iou_max = seg_iou 
-                jmax = i
-                mask_gt_u = np.unique(mask_gt)
+            R.append(class_recs[j][image_ids[k]])
+        ovmax = ovmaxs[k]
+        jmax = jmaxs[k]
 
         for j in range(len(ovthresh_seg)):   
             if ovmax > ovthresh_seg[j]:
                 if not R[j]['det'][jmax]:
                     tp_seg[j][d] = 1.
                     R[j]['det'][jmax] = 1
-                    pcp_d = len(mask_gt_u[np.logical_and(mask_gt_u>0, mask_gt_u<nb_class)])
-                    pcp_n = float(np.sum(seg_iou_max[1:]>ovthresh_seg[j]))
+                    pcp_d = pcp_ds[k]
+                    pcp_n = float(np.sum(seg_iou_maxs[k][1:]>ovthresh_seg[j]))
                     if pcp_d > 0:
                         pcp_list[j].append(pcp_n/pcp_d)
                     else:
@@ -437,10 +497,12 @@ def parsing2png(cls_boxes_i, cls_parss_i, output_dir, img_name, img_shape):
         for k in range(len(_inx)):
             if scores[_inx[k]] < cfg.PRCNN.SCORE:
                 continue
-            parsing = parsings[_inx[k]]
+            parsing, x_0, y_0 = parsing_crop(parsings[_inx[k]])
             txt_result += ' {} {}'.format(str(ins_id), str(scores[_inx[k]]))
-            parsing_png = np.where(parsing > 0, parsing, parsing_png)
-            parsing_ins = np.where(parsing > 0, ins_id, parsing_ins)
+            fg = parsing > 0
+            region = (slice(y_0, y_0 + parsing.shape[0]), slice(x_0, x_0 + parsing.shape[1]))
+            parsing_png[region][fg] = parsing[fg]
+            parsing_ins[region][fg] = ins_id
             ins_id += 1
         txt_result += '\n'
         cv2.imwrite(save_name, parsing_png)
@@ -0,0 +1,88 @@
+"""Bounded background prefetching of inputs (image decode, preprocessing)."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import time
+
+
+class Prefetcher(object):
+    """Iterate over `load_func(item)` for every item in `items`, in order, while
+    a pool of background threads loads up to `depth` items ahead of the consumer.
+
+    cv2 and numpy release the GIL in image decoding, resizing and arithmetic, so
+    threads are enough to overlap input loading with the forward pass. With
+    depth <= 0 items are loaded synchronously in the consumer thread.
+
+    Counters (see `stats`):
+      - queue depth: number of already loaded items waiting when the consumer
+        asks for the next one (0 means the pipeline ran dry)
+      - stall time: time the consumer spent waiting for an item to be loaded
+    """
+
+    def __init__(self, items, load_func, depth=2, num_workers=1):
+        self._items = items
+        self._load_func = load_func
+        self._depth = depth
+        self._num_workers = max(num_workers, 1)
+        self.num_fetched = 0
+        self.num_stalls = 0
+        self.stall_time = 0.
+        self.total_depth = 0
+        self.max_depth = 0
+
+    def __iter__(self):
+        if self._depth <= 0:
+            for item in self._items:
+                tic = time.time()
+                out = self._load_func(item)
+                self._update_counters(0, time.time() - tic)
+                yield out
+            return
+
+        pool = ThreadPool(self._num_workers)
+        pending = deque()
+        items = iter(self._items)
+
+        def fill():
+            while len(pending) < self._depth:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                pending.append(pool.apply_async(self._load_func, (item,)))
+
+        try:
+            fill()
+            while pending:
+                depth = sum(1 for res in pending if res.ready())
+                tic = time.time()
+                out = pending.popleft().get()
+                self._update_counters(depth, time.time() - tic)
+                # Queue the next item before handing this one to the consumer
+                fill()
+                yield out
+        finally:
+            pool.terminate()
+
+    def _update_counters(self, depth, stall):
+        self.num_fetched += 1
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+        self.stall_time += stall
+        if depth == 0:
+            self.num_stalls += 1
+
+    def stats(self):
+        """Return the prefetch counters as a dict."""
+        return dict(
+            num_fetched=self.num_fetched,
+            num_stalls=self.num_stalls,
+            stall_time=self.stall_time,
+            mean_depth=self.total_depth / max(self.num_fetched, 1),
+            max_depth=self.max_depth,
+        )
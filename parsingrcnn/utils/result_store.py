@@ -0,0 +1,206 @@
+"""Append-only, per-image sharded on-disk store of test results.
+
+A store is a directory holding chunk files, each a pickled dict
+{image index: results of the image}, and an index file (index.json) listing
+the chunks with the images they hold plus free-form metadata. The results of
+an image are a dict with keys 'boxes', 'segms', 'keyps', 'parss' and 'uvs'
+(the per class lists returned by im_detect_all, or None) and 'txt' (the
+parsing2png summary line, or None).
+
+The index is rewritten atomically after every chunk, so a store only ever
+lists complete chunks and can be read (or appended to) after a crash. The
+index is flagged 'complete' once the run writing the store has finished.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import json
+import os
+
+from parsingrcnn.utils.io import load_object
+from parsingrcnn.utils.io import save_object
+
+RESULT_KEYS = ('boxes', 'segms', 'keyps', 'parss', 'uvs')
+
+_INDEX_FILE = 'index.json'
+
+
+def load_index(store_dir):
+    """Return the index of a store (None if there is no store)."""
+    index_file = os.path.join(store_dir, _INDEX_FILE)
+    if not os.path.exists(index_file):
+        return None
+    with open(index_file, 'r') as f:
+        return json.load(f)
+
+
+def _write_json_atomic(obj, file_name):
+    tmp_file = file_name + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(obj, f)
+    os.rename(tmp_file, file_name)
+
+
+class ResultWriter(object):
+    """Write test results as images complete.
+
+    Results are buffered in memory for at most `chunk_size` images. Writing to
+    an existing store appends to it (its metadata is kept).
+    """
+
+    def __init__(self, store_dir, chunk_size=50, meta=None):
+        self.store_dir = store_dir
+        self.chunk_size = max(chunk_size, 1)
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self._index = load_index(store_dir)
+        if self._index is None:
+            self._index = {'meta': meta or {}, 'chunks': []}
+        self._index['complete'] = False
+        _write_json_atomic(self._index, os.path.join(store_dir, _INDEX_FILE))
+        self._buffer = {}
+
+    @property
+    def meta(self):
+        return self._index['meta']
+
+    def completed_images(self):
+        """Indices of the images whose results are on disk."""
+        return set(
+            im_idx for chunk in self._index['chunks'] for im_idx in chunk['images']
+        )
+
+    def add(self, im_idx, results):
+        self._buffer[int(im_idx)] = results
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._buffer) == 0:
+            return
+        chunk_file = 'chunk_{:06d}.pkl'.format(len(self._index['chunks']))
+        tmp_file = os.path.join(self.store_dir, chunk_file + '.tmp')
+        save_object(self._buffer, tmp_file)
+        os.rename(tmp_file, os.path.join(self.store_dir, chunk_file))
+        self._index['chunks'].append(
+            {'file': chunk_file, 'images': sorted(self._buffer.keys())}
+        )
+        _write_json_atomic(self._index, os.path.join(self.store_dir, _INDEX_FILE))
+        self._buffer = {}
+
+    def close(self):
+        self.flush()
+
+    def mark_complete(self):
+        """Flag the store as holding the results of a finished run."""
+        self.flush()
+        self._index['complete'] = True
+        _write_json_atomic(self._index, os.path.join(self.store_dir, _INDEX_FILE))
+
+
+class ResultReader(object):
+    """Read-only view over one or more result stores, e.g. the stores written
+    by the ranges or shards of a test run. Only the chunks being accessed are
+    kept in memory (at most `cache_size` of them).
+    """
+
+    def __init__(self, store_dirs, cache_size=2):
+        if not isinstance(store_dirs, (list, tuple)):
+            store_dirs = [store_dirs]
+        self.metas = []
+        self.complete = []
+        self._chunk_files = []
+        self._im_to_chunk = {}
+        for store_dir in store_dirs:
+            index = load_index(store_dir)
+            assert index is not None, \
+                'No result store found in \'{}\''.format(store_dir)
+            self.metas.append(index['meta'])
+            self.complete.append(index.get('complete', False))
+            for chunk in index['chunks']:
+                for im_idx in chunk['images']:
+                    self._im_to_chunk[im_idx] = len(self._chunk_files)
+                self._chunk_files.append(os.path.join(store_dir, chunk['file']))
+        self._cache_size = max(cache_size, 1)
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._im_to_chunk)
+
+    def __contains__(self, im_idx):
+        return im_idx in self._im_to_chunk
+
+    def image_ids(self):
+        return sorted(self._im_to_chunk.keys())
+
+    def get(self, im_idx):
+        """Return the results of an image."""
+        return self._load_chunk(self._im_to_chunk[im_idx])[im_idx]
+
+    def iter_results(self):
+        """Yield (image index, results) for all images, one chunk at a time."""
+        for chunk_file in self._chunk_files:
+            chunk = load_object(chunk_file)
+            for im_idx in sorted(chunk.keys()):
+                yield im_idx, chunk[im_idx]
+
+    def get_all_results(self, num_classes, num_images, start=0):
+        """Return all_boxes, all_segms, all_keyps, all_parss and all_uvs for the
+        images [start, start + num_images), in the format built by test_net
+        (all_boxes[cls][image] etc.) but read lazily from the store. Only
+        the chunks in the reader cache are in memory, so the results should be
+        visited image-major (all the classes of an image, image after image)
+        for each chunk to be read once.
+        """
+        return tuple(
+            [LazyClassResults(self, key, cls_idx, num_images, start)
+             for cls_idx in range(num_classes)]
+            for key in RESULT_KEYS
+        )
+
+    def _load_chunk(self, chunk_idx):
+        if chunk_idx in self._cache:
+            self._cache[chunk_idx] = self._cache.pop(chunk_idx)
+        else:
+            if len(self._cache) >= self._cache_size:
+                self._cache.popitem(last=False)
+            self._cache[chunk_idx] = load_object(self._chunk_files[chunk_idx])
+        return self._cache[chunk_idx]
+
+
+class LazyClassResults(object):
+    """The results of one class for every image (e.g. all_boxes[cls]), read
+    from a result store on access. Images without results give [].
+    """
+
+    def __init__(self, reader, key, cls_idx, num_images, start=0):
+        self._reader = reader
+        self._key = key
+        self._cls_idx = cls_idx
+        self._num_images = num_images
+        self._start = start
+
+    def __len__(self):
+        return self._num_images
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._num_images
+        if not 0 <= i < self._num_images:
+            raise IndexError('image index out of range')
+        im_idx = self._start + i
+        if self._cls_idx == 0 or im_idx not in self._reader:
+            # Nothing is stored for __background__
+            return []
+        im_res = self._reader.get(im_idx)[self._key]
+        if im_res is None:
+            return []
+        return im_res[self._cls_idx]
+
+    def __iter__(self):
+        for i in range(self._num_images):
+            yield self[i]
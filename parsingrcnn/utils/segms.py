@@ -286,3 +286,53 @@ def rle_masks_to_boxes(masks):
         boxes[i, :] = (x0, y0, x1, y1)
 
     return boxes, np.where(keep)[0]
+
+
+def box_masks_to_rles(box_masks, im_h, im_w):
+    """Encode binary masks given box-locally into COCO RLEs of the full image.
+
+    Arguments:
+        box_masks (list): (mask, x_0, y_0) of each instance, with the uint8
+            mask of the part of its box inside the image and its top left
+            corner in the image
+        im_h, im_w (int): image size
+
+    Returns:
+        list of RLEs, the same as mask_util.encode of the full image masks. The
+        runs are found on the box-local masks and all RLEs are compressed in
+        one mask_util.frPyObjects call, without pasting any full image mask.
+    """
+    if len(box_masks) == 0:
+        return []
+    uncompressed = []
+    for mask, x_0, y_0 in box_masks:
+        # COCO RLEs run over the pixels in column-major order. With a zero
+        # row above and below each column, +1 / -1 steps down a column are
+        # the starts / ends of runs of ones
+        crop_h, crop_w = mask.shape
+        cols = np.zeros((crop_w, crop_h + 2), dtype=np.int8)
+        cols[:, 1:-1] = mask.T != 0
+        steps = np.diff(cols, axis=1)
+        col_starts, row_starts = np.nonzero(steps == 1)
+        col_ends, row_ends = np.nonzero(steps == -1)
+        starts = (x_0 + col_starts) * im_h + y_0 + row_starts
+        ends = (x_0 + col_ends) * im_h + y_0 + row_ends
+        # A run reaching the bottom of the image goes on at the top of the
+        # next column
+        merged = starts[1:] == ends[:-1]
+        if merged.any():
+            starts = starts[np.r_[True, ~merged]]
+            ends = ends[np.r_[~merged, True]]
+
+        bounds = np.empty(2 * len(starts) + 2, dtype=np.int64)
+        bounds[0] = 0
+        bounds[1:-1:2] = starts
+        bounds[2:-1:2] = ends
+        bounds[-1] = im_h * im_w
+        counts = np.diff(bounds)
+        # Runs alternate from a (possibly empty) run of zeros, and the last
+        # run is never empty
+        if len(counts) > 1 and counts[-1] == 0:
+            counts = counts[:-1]
+        uncompressed.append({'size': [im_h, im_w], 'counts': counts.tolist()})
+    return mask_util.frPyObjects(uncompressed, im_h, im_w)
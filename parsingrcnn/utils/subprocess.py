@@ -13,9 +13,14 @@
 # limitations under the License.
 ##############################################################################
 
-"""Primitives for running multiple single-GPU jobs in parallel over subranges of
-data. These are used for running multi-GPU inference. Subprocesses are used to
-avoid the GIL since inference may involve non-trivial amounts of Python code.
+"""Primitives for running inference over a dataset in a pool of worker
+processes. These are used for running multi-GPU (or multi-process CPU)
+inference. Subprocesses are used to avoid the GIL since inference may involve
+non-trivial amounts of Python code.
+
+Workers pull small tasks (e.g. chunks of image indices) from a shared queue as
+they become idle, so a slow part of the dataset does not leave the other
+workers waiting, and send their outputs back to the parent over a pipe.
 """
 
 # from __future__ import absolute_import
@@ -23,38 +28,35 @@ avoid the GIL since inference may involve non-trivial amounts of Python code.
 # from __future__ import print_function
 # from __future__ import unicode_literals
 
-from io import IOBase
 import logging
+import multiprocessing
 import os
-import subprocess
-from six.moves import shlex_quote
-from six.moves import cPickle as pickle
-import yaml
-import numpy as np
+import traceback
+from six.moves import queue
+
 import torch
 
+from parsingrcnn.core.config import assert_and_infer_cfg
 from parsingrcnn.core.config import cfg
+from parsingrcnn.core.config import merge_cfg_from_cfg
 
 logger = logging.getLogger(__name__)
 
+_OUTPUT = 'output'
+_DONE = 'done'
+_ERROR = 'error'
+
+# Seconds between checks that the workers are still alive
+_POLL_INTERVAL = 10
 
-def process_in_parallel(
-        tag, total_range_size, binary, output_dir,
-        load_ckpt, load_detectron, opts=''):
-    """Run the specified binary NUM_GPUS times in parallel, each time as a
-    subprocess that uses one GPU. The binary must accept the command line
-    arguments `--range {start} {end}` that specify a data processing range.
+
+def get_worker_devices(num_workers=0):
+    """Return one entry per worker: the GPU index it runs on, or None for a CPU
+    worker. On CUDA there is one worker per visible GPU (cfg.NUM_GPUS of them);
+    on the CPU there are num_workers workers.
     """
-    # Snapshot the current cfg state in order to pass to the inference
-    # subprocesses
-    cfg_file = os.path.join(output_dir, '{}_range_config.yaml'.format(tag))
-    with open(cfg_file, 'w') as f:
-        yaml.dump(cfg, stream=f)
-    subprocess_env = os.environ.copy()
-    processes = []
-    NUM_GPUS = torch.cuda.device_count()
-    subinds = np.array_split(range(total_range_size), NUM_GPUS)
-    # Determine GPUs to use
+    if cfg.DEVICE == 'cpu':
+        return [None] * max(num_workers, 1)
     cuda_visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES')
     if cuda_visible_devices:
         gpu_inds = list(map(int, cuda_visible_devices.split(',')))
@@ -62,86 +64,98 @@ def process_in_parallel(
             'Hiding GPU indices using the \'-1\' index is not supported'
     else:
         gpu_inds = range(cfg.NUM_GPUS)
-    gpu_inds = list(gpu_inds)
-    # Run the binary in cfg.NUM_GPUS subprocesses
-    for i, gpu_ind in enumerate(gpu_inds):
-        start = subinds[i][0]
-        end = subinds[i][-1] + 1
-        subprocess_env['CUDA_VISIBLE_DEVICES'] = str(gpu_ind)
-        # cmd = ('python {binary} --range {start} {end} --cfg {cfg_file} --set {opts} '
-        #        '--output_dir {output_dir}')
-        cmd = ('python3 {binary} --range {start} {end} --cfg {cfg_file} --gpu_id {gpu_id}')
-        # if load_ckpt is not None:
-        #     cmd += ' --load_ckpt {load_ckpt}'
-        # elif load_detectron is not None:
-        #     cmd += ' --load_detectron {load_detectron}'
-        cmd = cmd.format(
-            binary=shlex_quote(binary),
-            start=int(start),
-            end=int(end),
-            cfg_file=shlex_quote(cfg_file),
-            gpu_id=str(gpu_ind),
-            output_dir=output_dir,
-            load_ckpt=load_ckpt,
-            load_detectron=load_detectron,
-            opts=' '.join([shlex_quote(opt) for opt in opts])
+    return list(gpu_inds)
+
+
+def process_in_pool(tag, tasks, worker_func, worker_args=(), devices=(None,)):
+    """Run `worker_func` in one subprocess per entry of `devices` and yield the
+    outputs of all workers as they arrive.
+
+    `worker_func(task_iter, *worker_args)` must be a module level function. It
+    is called once per worker, after the parent's cfg has been copied in, and
+    should yield outputs while consuming `task_iter`, which pulls the tasks from
+    the shared queue until none are left. A worker on device d only sees GPU d
+    (CUDA_VISIBLE_DEVICES); a CPU worker (device None) gets an equal share of
+    the CPU threads.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    task_queue = ctx.Queue()
+    output_queue = ctx.Queue()
+    num_tasks = 0
+    for task in tasks:
+        task_queue.put(task)
+        num_tasks += 1
+    for _ in devices:
+        task_queue.put(None)
+    num_threads = max(torch.get_num_threads() // len(devices), 1)
+
+    processes = []
+    for worker_id, device in enumerate(devices):
+        p = ctx.Process(
+            target=_worker_loop,
+            args=(worker_id, device, num_threads, cfg, task_queue, output_queue,
+                  worker_func, worker_args)
         )
-        logger.info('{} range command {}: {}'.format(tag, i, cmd))
-        if i == 0:
-            subprocess_stdout = subprocess.PIPE
+        p.daemon = True
+        p.start()
+        processes.append(p)
+    logger.info('{}: {:d} tasks on {:d} workers (devices: {})'.format(
+        tag, num_tasks, len(devices), devices))
+
+    finished = set()
+    try:
+        while len(finished) < len(processes):
+            try:
+                kind, worker_id, out = output_queue.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                for worker_id, p in enumerate(processes):
+                    # A worker that exits cleanly has sent _DONE (or _ERROR)
+                    # first, so only a non-zero exit code means it was lost
+                    assert worker_id in finished or p.exitcode in (None, 0), \
+                        '{} worker {} died (exit code: {})'.format(
+                            tag, worker_id, p.exitcode)
+                continue
+            if kind == _OUTPUT:
+                yield out
+            elif kind == _DONE:
+                finished.add(worker_id)
+            else:
+                raise RuntimeError(
+                    '{} worker {} failed:\n{}'.format(tag, worker_id, out))
+        for p in processes:
+            p.join()
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+
+
+def _worker_loop(worker_id, device, num_threads, parent_cfg, task_queue,
+                 output_queue, worker_func, worker_args):
+    """Body of a pool subprocess."""
+    try:
+        if device is not None:
+            # Must be set before CUDA is initialized in this process
+            os.environ['CUDA_VISIBLE_DEVICES'] = str(device)
         else:
-            filename = os.path.join(
-                output_dir, '%s_range_%s_%s.stdout' % (tag, start, end)
-            )
-            subprocess_stdout = open(filename, 'w')
-        p = subprocess.Popen(
-            cmd,
-            shell=True,
-            env=subprocess_env,
-            stdout=subprocess_stdout,
-            stderr=subprocess.STDOUT,
-            bufsize=1
-        )
-        processes.append((i, p, start, end, subprocess_stdout))
-    # Log output from inference processes and collate their results
-    outputs = []
-    for i, p, start, end, subprocess_stdout in processes:
-        log_subprocess_output(i, p, output_dir, tag, start, end)
-        if isinstance(subprocess_stdout, IOBase):
-            subprocess_stdout.close()
-        range_file = os.path.join(
-            output_dir, '%s_range_%s_%s.pkl' % (tag, start, end)
+            torch.set_num_threads(num_threads)
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(levelname)s [worker {}] %(filename)s:%(lineno)4d: '
+                   '%(message)s'.format(worker_id)
         )
-        range_data = pickle.load(open(range_file, 'rb'))
-        outputs.append(range_data)
-    return outputs
+        merge_cfg_from_cfg(parent_cfg)
+        assert_and_infer_cfg()
 
+        def task_iter():
+            while True:
+                task = task_queue.get()
+                if task is None:
+                    return
+                yield task
 
-def log_subprocess_output(i, p, output_dir, tag, start, end):
-    """Capture the output of each subprocess and log it in the parent process.
-    The first subprocess's output is logged in realtime. The output from the
-    other subprocesses is buffered and then printed all at once (in order) when
-    subprocesses finish.
-    """
-    outfile = os.path.join(
-        output_dir, '%s_range_%s_%s.stdout' % (tag, start, end)
-    )
-    logger.info('# ' + '-' * 76 + ' #')
-    logger.info(
-        'stdout of subprocess %s with range [%s, %s]' % (i, start + 1, end)
-    )
-    logger.info('# ' + '-' * 76 + ' #')
-    if i == 0:
-        # Stream the piped stdout from the first subprocess in realtime
-        with open(outfile, 'w') as f:
-            for line in iter(p.stdout.readline, b''):
-                print(line.rstrip().decode('ascii'))
-                f.write(str(line, encoding='ascii'))
-        p.stdout.close()
-        ret = p.wait()
-    else:
-        # For subprocesses >= 1, wait and dump their log file
-        ret = p.wait()
-        with open(outfile, 'r') as f:
-            print(''.join(f.readlines()))
-    assert ret == 0, 'Range subprocess failed (exit code: {})'.format(ret)
+        for out in worker_func(task_iter(), *worker_args):
+            output_queue.put((_OUTPUT, worker_id, out))
+        output_queue.put((_DONE, worker_id, None))
+    except Exception:
+        output_queue.put((_ERROR, worker_id, traceback.format_exc()))
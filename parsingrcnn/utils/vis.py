@@ -31,6 +31,7 @@ from collections import defaultdict
 
 import parsingrcnn.utils.colormap as colormap_utils
 import parsingrcnn.utils.keypoints as keypoint_utils
+import parsingrcnn.utils.parsing as parsing_utils
 from parsingrcnn.core.config import cfg
 from parsingrcnn.utils.timer import Timer
 
@@ -220,6 +221,7 @@ def vis_keypoints(img, kps, show_parss=False):
 
 def vis_parsing(img, parsing, colormap, show_segms=True):
     """Visualizes a single binary parsing."""
+    parsing = parsing_utils.decode_parsing(parsing)
     img = img.astype(np.float32)
     idx = np.nonzero(parsing)
 
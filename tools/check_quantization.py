@@ -0,0 +1,109 @@
+"""Measure the accuracy lost by int8 quantization of the RoI heads
+(see parsingrcnn/core/quantize.py): test the float model and the quantized
+model on the test datasets of the config and report the metric deltas
+(box AP, parsing mIoU / APp, ...):
+
+    python tools/check_quantization.py --cfg <cfg> --mode static \
+        TEST.DATASETS "('CIHP_val',)"
+
+The float and quantized runs write to the 'float' and '<mode>' subdirectories
+of the output directory. Static quantization is calibrated on
+TEST.QUANTIZE.CALIBRATION_DATASET (by default TRAIN.DATASETS[0]), never on the
+test datasets.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import cv2
+import os
+import pprint
+import time
+
+import _init_paths  # pylint: disable=unused-import
+from parsingrcnn.core.config import cfg, merge_cfg_from_file, merge_cfg_from_list, assert_and_infer_cfg
+from parsingrcnn.core.test_engine import run_inference
+import parsingrcnn.utils.logging as logging
+
+cv2.ocl.setUseOpenCL(False)
+
+parser = argparse.ArgumentParser(description='Check the accuracy of a quantized model',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--cfg', dest='cfg_file',
+                    help='optional config file',
+                    default='./cfgs/maskrcnn/mscoco/e2e_mask_rcnn_R-50-FPN_1x.yaml', type=str)
+parser.add_argument('--weights', default=None, type=str,
+                    help='.pth checkpoint or .pkl detectron weights (default: cfg.TEST.WEIGHTS)')
+parser.add_argument('--mode', choices=['dynamic', 'static'], default=None,
+                    help='quantization mode, overrides cfg.TEST.QUANTIZE.MODE')
+parser.add_argument('--output_dir', default=None, type=str,
+                    help='output directory (default: {cfg.CKPT}/test_quantization)')
+parser.add_argument('opts', help='See parsingrcnn/core/config.py for all options',
+                    default=None,
+                    nargs=argparse.REMAINDER)
+args = parser.parse_args()
+
+
+def run(mode):
+    """Test with cfg.TEST.QUANTIZE.MODE set to mode; return the results and the
+    wall time.
+    """
+    cfg.immutable(False)
+    cfg.TEST.QUANTIZE.MODE = mode
+    cfg.immutable(True)
+    args.output_dir = os.path.join(output_dir, mode or 'float')
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    start = time.time()
+    results = run_inference(
+        args, multi_gpu_testing=cfg.TEST.NUM_WORKERS > 1)
+    return results, time.time() - start
+
+
+if __name__ == '__main__':
+    logger = logging.setup_logging(__name__)
+    logger.info('Called with args:')
+    logger.info(args)
+
+    if args.cfg_file is not None:
+        merge_cfg_from_file(args.cfg_file)
+    if args.opts is not None:
+        merge_cfg_from_list(args.opts)
+    # Quantized kernels only run on the CPU
+    cfg.DEVICE = 'cpu'
+    cfg.NUM_GPUS = 1
+    mode = args.mode or cfg.TEST.QUANTIZE.MODE
+    assert mode, 'Give a quantization mode (--mode or TEST.QUANTIZE.MODE)'
+    weights = args.weights or cfg.TEST.WEIGHTS
+    assert_and_infer_cfg()
+    logger.info('Testing with config:')
+    logger.info(pprint.pformat(cfg))
+
+    output_dir = args.output_dir or os.path.join(cfg.CKPT, 'test_quantization')
+    args.cuda = False
+    _, ext = os.path.splitext(weights)
+    if ext == '.pth':
+        args.load_detectron = ''
+        args.load_ckpt = weights
+    elif ext == '.pkl':
+        args.load_detectron = weights
+        args.load_ckpt = ''
+    else:
+        raise KeyError('Unknown Model Type: {}'.format(ext))
+
+    float_results, float_time = run('')
+    quant_results, quant_time = run(mode)
+
+    logger.info('Quantization check ({}): float {:.1f}s, int8 {:.1f}s'.format(
+        mode, float_time, quant_time))
+    for dataset_name, tasks in float_results.items():
+        print(dataset_name)
+        for task, metrics in tasks.items():
+            for metric, float_value in metrics.items():
+                quant_value = quant_results[dataset_name][task][metric]
+                print(' {:<10} {:<8}: float {:.4f}  {} {:.4f}  delta {:+.4f}'.format(
+                    task, metric, float_value, mode, quant_value,
+                    quant_value - float_value))
@@ -0,0 +1,80 @@
+"""Export a model as a self-contained inference bundle
+(see parsingrcnn/core/bundle.py), e.g. for fast-starting CPU workers:
+
+    python tools/export_bundle.py --cfg <cfg> --weights <model>.pth --device cpu \
+        --output <model>_cpu.bundle
+    python tools/serve_net.py --bundle <model>_cpu.bundle --device cpu
+
+The conv body is traced for the export device; export separate bundles for CPU
+and CUDA workers.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import pprint
+import sys
+
+import torch
+
+import _init_paths  # pylint: disable=unused-import
+from parsingrcnn.core.bundle import export_inference_bundle
+from parsingrcnn.core.config import cfg, merge_cfg_from_file, merge_cfg_from_list, assert_and_infer_cfg
+from parsingrcnn.core.test_engine import initialize_model_from_cfg
+import parsingrcnn.utils.logging as logging
+
+parser = argparse.ArgumentParser(description='Export an inference bundle',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--cfg', dest='cfg_file',
+                    help='optional config file',
+                    default='./cfgs/maskrcnn/mscoco/e2e_mask_rcnn_R-50-FPN_1x.yaml', type=str)
+parser.add_argument('--weights', default=None, type=str,
+                    help='.pth checkpoint or .pkl detectron weights (default: cfg.TEST.WEIGHTS)')
+parser.add_argument('--device', choices=['cuda', 'cpu'], default=None,
+                    help='device the conv body is traced for, overrides cfg.DEVICE')
+parser.add_argument('--output', required=True, type=str, help='bundle file')
+parser.add_argument('--no_trace', action='store_true',
+                    help='store the conv body weights instead of a TorchScript trace')
+parser.add_argument('opts', help='See parsingrcnn/core/config.py for all options',
+                    default=None,
+                    nargs=argparse.REMAINDER)
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    logger = logging.setup_logging(__name__)
+    logger.info('Called with args:')
+    logger.info(args)
+
+    if args.cfg_file is not None:
+        merge_cfg_from_file(args.cfg_file)
+    if args.opts is not None:
+        merge_cfg_from_list(args.opts)
+    if args.device is not None:
+        cfg.DEVICE = args.device
+    if cfg.DEVICE == 'cuda' and not torch.cuda.is_available():
+        sys.exit("Need a CUDA device to run the code (or use --device cpu).")
+    cfg.NUM_GPUS = 1
+    weights = args.weights or cfg.TEST.WEIGHTS
+    assert_and_infer_cfg()
+    logger.info('Exporting with config:')
+    logger.info(pprint.pformat(cfg))
+
+    args.cuda = cfg.DEVICE == 'cuda'
+    _, ext = os.path.splitext(weights)
+    if ext == '.pth':
+        args.load_detectron = ''
+        args.load_ckpt = weights
+    elif ext == '.pkl':
+        args.load_detectron = weights
+        args.load_ckpt = ''
+    else:
+        raise KeyError('Unknown Model Type: {}'.format(ext))
+    # The float weights are bundled; cfg.TEST.QUANTIZE is applied on load
+    model = initialize_model_from_cfg(args, quantize=False)
+
+    export_inference_bundle(model, args.output, trace_conv_body=not args.no_trace)
@@ -0,0 +1,62 @@
+"""Evaluate the shard result stores written by `test_net_multipro.py --shard i/N`
+on one or more machines.
+
+The shard stores (detection_shard_{i}_of_{N} in each test output directory) are
+read in place, one chunk at a time, so the whole dataset is never held in
+memory. Use the config of the test runs.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import pprint
+
+import _init_paths  # pylint: disable=unused-import
+from parsingrcnn.core.config import cfg, merge_cfg_from_file, merge_cfg_from_list, assert_and_infer_cfg
+from parsingrcnn.core.test_engine import evaluate_shards
+from parsingrcnn.datasets import task_evaluation
+import parsingrcnn.utils.logging as logging
+
+parser = argparse.ArgumentParser(description='Evaluate the shards of a sharded test run',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--cfg', dest='cfg_file',
+                    help='config file of the test runs',
+                    default='./cfgs/maskrcnn/mscoco/e2e_mask_rcnn_R-50-FPN_1x.yaml', type=str)
+parser.add_argument('--shards', required=True, nargs='+',
+                    help='result store directories of all the shards')
+parser.add_argument('--output_dir', default=None, type=str,
+                    help='evaluation output directory (default: {cfg.CKPT}/test)')
+parser.add_argument('opts', help='See parsingrcnn/core/config.py for all options',
+                    default=None,
+                    nargs=argparse.REMAINDER)
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    logger = logging.setup_logging(__name__)
+    logger.info('Called with args:')
+    logger.info(args)
+
+    if args.cfg_file is not None:
+        merge_cfg_from_file(args.cfg_file)
+    if args.opts is not None:
+        merge_cfg_from_list(args.opts)
+    assert_and_infer_cfg()
+    logger.info('Testing with config:')
+    logger.info(pprint.pformat(cfg))
+
+    output_dir = args.output_dir or os.path.join(cfg.CKPT, 'test')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    results = evaluate_shards(args.shards, output_dir)
+    task_evaluation.check_expected_results(
+        results,
+        atol=cfg.EXPECTED_RESULTS_ATOL,
+        rtol=cfg.EXPECTED_RESULTS_RTOL
+    )
+    task_evaluation.log_copy_paste_friendly_results(results)
@@ -0,0 +1,113 @@
+"""Serve a model over HTTP with dynamic request batching
+(see parsingrcnn/core/inference_server.py).
+
+With --bundle the model and its config are loaded from an inference bundle
+(see tools/export_bundle.py), which starts faster. Otherwise, without --weights
+the model keeps its random initialization, which is enough
+to try the service, e.g. with a tiny backbone on the CPU:
+
+    python tools/serve_net.py --cfg <cfg> --device cpu --port 8000
+
+and, from another process:
+
+    from parsingrcnn.core.inference_server import InferenceClient
+    detections = InferenceClient(port=8000).detect(cv2.imread('demo.jpg'))
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import cv2
+import os
+import pprint
+import sys
+
+import torch
+
+import _init_paths  # pylint: disable=unused-import
+from parsingrcnn.core.bundle import load_inference_bundle
+from parsingrcnn.core.config import cfg, merge_cfg_from_file, merge_cfg_from_list, assert_and_infer_cfg
+from parsingrcnn.core.inference_server import InferenceServer
+from parsingrcnn.core.test_engine import initialize_model_from_cfg
+import parsingrcnn.utils.logging as logging
+
+# OpenCL may be enabled by default in OpenCV3; disable it because it's not
+# thread safe and causes unwanted GPU memory allocations.
+cv2.ocl.setUseOpenCL(False)
+
+parser = argparse.ArgumentParser(description='Serve a model over HTTP',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--cfg', dest='cfg_file',
+                    help='optional config file',
+                    default='./cfgs/maskrcnn/mscoco/e2e_mask_rcnn_R-50-FPN_1x.yaml', type=str)
+parser.add_argument('--weights', default=None, type=str,
+                    help='.pth checkpoint or .pkl detectron weights (default: random weights)')
+parser.add_argument('--bundle', default=None, type=str,
+                    help='inference bundle holding the model and its config '
+                         '(--cfg, --weights, --device and opts are ignored)')
+parser.add_argument('--device', choices=['cuda', 'cpu'], default=None,
+                    help='inference device, overrides cfg.DEVICE')
+parser.add_argument('--host', default='127.0.0.1', type=str)
+parser.add_argument('--port', default=8000, type=int)
+parser.add_argument('--max_batch_size', default=4, type=int,
+                    help='maximum number of requests run through the network together')
+parser.add_argument('--max_wait_ms', default=10., type=float,
+                    help='maximum time a request waits for others to join its batch')
+parser.add_argument('--thresh', default=0., type=float,
+                    help='leave out instances scoring below this threshold')
+parser.add_argument('opts', help='See parsingrcnn/core/config.py for all options',
+                    default=None,
+                    nargs=argparse.REMAINDER)
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    logger = logging.setup_logging(__name__)
+    logger.info('Called with args:')
+    logger.info(args)
+
+    if args.bundle is not None:
+        # The bundle runs on the device it was exported for
+        model = load_inference_bundle(args.bundle)
+    else:
+        if args.cfg_file is not None:
+            merge_cfg_from_file(args.cfg_file)
+        if args.opts is not None:
+            merge_cfg_from_list(args.opts)
+        if args.device is not None:
+            cfg.DEVICE = args.device
+        if cfg.DEVICE == 'cuda' and not torch.cuda.is_available():
+            sys.exit("Need a CUDA device to run the code (or use --device cpu).")
+        cfg.NUM_GPUS = 1
+        assert_and_infer_cfg()
+
+        args.cuda = cfg.DEVICE == 'cuda'
+        args.load_ckpt = ''
+        args.load_detectron = ''
+        if args.weights is None:
+            logger.warning('No weights given, serving a randomly initialized model')
+        elif os.path.splitext(args.weights)[1] == '.pth':
+            args.load_ckpt = args.weights
+        elif os.path.splitext(args.weights)[1] == '.pkl':
+            args.load_detectron = args.weights
+        else:
+            raise KeyError('Unknown Model Type: {}'.format(args.weights))
+        model = initialize_model_from_cfg(args)
+    assert not cfg.TEST.PRECOMPUTED_PROPOSALS, \
+        'The inference service needs a model with in-network proposals'
+    logger.info('Serving with config:')
+    logger.info(pprint.pformat(cfg))
+
+    server = InferenceServer(
+        model, args.host, args.port,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000.,
+        thresh=args.thresh
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Batching stats: {}'.format(server.batcher.stats()))
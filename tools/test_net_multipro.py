@@ -28,10 +28,22 @@ parser.add_argument('--cfg', dest='cfg_file',
                     default='./cfgs/maskrcnn/mscoco/e2e_mask_rcnn_R-50-FPN_1x.yaml', type=str)
 parser.add_argument('--gpu_id', type=str, default='0', help='gpu id for evaluation')
 parser.add_argument('--range', help='start (inclusive) and end (exclusive) indices', type=int, nargs=2)
+parser.add_argument('--shard', default=None, type=str,
+                    help='run only shard i/N of the dataset (e.g. 0/4) and write its result '
+                         'store for tools/merge_shards.py')
+parser.add_argument('--device', choices=['cuda', 'cpu'], default=None,
+                    help='inference device, overrides cfg.DEVICE')
+parser.add_argument('--resume', action='store_true',
+                    help='skip the images already in the result store of a previous run')
 parser.add_argument('opts', help='See parsingrcnn/core/config.py for all options',
                     default=None,
                     nargs=argparse.REMAINDER)
 args = parser.parse_args()
+if args.shard is not None:
+    assert args.range is None, '--shard and --range are exclusive'
+    args.shard = tuple(map(int, args.shard.split('/')))
+    assert len(args.shard) == 2 and 0 <= args.shard[0] < args.shard[1], \
+        '--shard must be i/N with 0 <= i < N'
 
 os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
 
@@ -62,20 +74,25 @@ def get_weights(mode='final'):
 
   
 if __name__ == '__main__':
-    if not torch.cuda.is_available():
-        sys.exit("Need a CUDA device to run the code.")
-
     logger = logging.setup_logging(__name__)
     logger.info('Called with args:')
     logger.info(args)
 
     cfg.NUM_GPUS = len(args.gpu_id.split(','))
-    multi_gpu_testing = True if cfg.NUM_GPUS > 1 else False
     # assert (torch.cuda.device_count() == 1) ^ bool(args.multi_gpu_testing)
     if args.cfg_file is not None:
         merge_cfg_from_file(args.cfg_file)
     if args.opts is not None:
         merge_cfg_from_list(args.opts)
+    if args.device is not None:
+        cfg.DEVICE = args.device
+    if cfg.DEVICE == 'cuda' and not torch.cuda.is_available():
+        sys.exit("Need a CUDA device to run the code (or use --device cpu).")
+    if cfg.DEVICE == 'cpu':
+        cfg.NUM_GPUS = 1
+        multi_gpu_testing = True if cfg.TEST.NUM_WORKERS > 1 else False
+    else:
+        multi_gpu_testing = True if cfg.NUM_GPUS > 1 else False
     logger.info('Testing with config:')
     logger.info(pprint.pformat(cfg))
 
@@ -84,8 +101,7 @@ if __name__ == '__main__':
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     args.output_dir = output_dir
-    args.test_net_file, _ = os.path.splitext(__file__)  # For test_engine.multi_gpu_test_net_on_dataset
-    args.cuda = True    # manually set args.cuda
+    args.cuda = cfg.DEVICE == 'cuda'
 
     cfg.TEST.WEIGHTS = get_weights()
     logger.info('Loading weights %s', cfg.TEST.WEIGHTS)
@@ -104,4 +120,5 @@ if __name__ == '__main__':
         args,
         ind_range=args.range,
         multi_gpu_testing=multi_gpu_testing,
-        check_expected_results=True)
+        check_expected_results=True,
+        shard=args.shard)
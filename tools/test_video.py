@@ -0,0 +1,130 @@
+"""Run a model on a video file or a camera as a stream of frames
+(see parsingrcnn/core/test_video.py):
+
+    python tools/test_video.py --cfg <cfg> --video <video>.mp4 \
+        --output <video>_vis.mp4 TEST.VIDEO.KEYFRAME_INTERVAL 8 TEST.VIDEO.ADAPTIVE True
+
+--video also takes a camera index (e.g. 0).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import cv2
+import os
+import pprint
+import sys
+
+import torch
+
+import _init_paths  # pylint: disable=unused-import
+from parsingrcnn.core.config import cfg, merge_cfg_from_file, merge_cfg_from_list, assert_and_infer_cfg
+from parsingrcnn.core.test_engine import initialize_model_from_cfg
+from parsingrcnn.core.test_video import VideoDetector
+import parsingrcnn.utils.logging as logging
+from parsingrcnn.utils.timer import Timer
+import parsingrcnn.utils.vis as vis_utils
+
+cv2.ocl.setUseOpenCL(False)
+
+parser = argparse.ArgumentParser(description='Test a model on a video stream',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--cfg', dest='cfg_file',
+                    help='optional config file',
+                    default='./cfgs/maskrcnn/mscoco/e2e_mask_rcnn_R-50-FPN_1x.yaml', type=str)
+parser.add_argument('--weights', default=None, type=str,
+                    help='.pth checkpoint or .pkl detectron weights (default: cfg.TEST.WEIGHTS)')
+parser.add_argument('--device', choices=['cuda', 'cpu'], default=None,
+                    help='overrides cfg.DEVICE')
+parser.add_argument('--video', required=True, type=str, help='video file or camera index')
+parser.add_argument('--output', default=None, type=str,
+                    help='optional video file of the visualized detections')
+parser.add_argument('--max_frames', default=0, type=int, help='stop after this many frames (0: all)')
+parser.add_argument('--log_every', default=100, type=int, help='log the speed every this many frames')
+parser.add_argument('opts', help='See parsingrcnn/core/config.py for all options',
+                    default=None,
+                    nargs=argparse.REMAINDER)
+args = parser.parse_args()
+
+
+def read_frames(capture, max_frames=0):
+    """Yield the frames of a cv2.VideoCapture."""
+    num_frames = 0
+    while max_frames <= 0 or num_frames < max_frames:
+        ok, frame = capture.read()
+        if not ok:
+            return
+        num_frames += 1
+        yield frame
+
+
+if __name__ == '__main__':
+    logger = logging.setup_logging(__name__)
+    logger.info('Called with args:')
+    logger.info(args)
+
+    if args.cfg_file is not None:
+        merge_cfg_from_file(args.cfg_file)
+    if args.opts is not None:
+        merge_cfg_from_list(args.opts)
+    if args.device is not None:
+        cfg.DEVICE = args.device
+    if cfg.DEVICE == 'cuda' and not torch.cuda.is_available():
+        sys.exit("Need a CUDA device to run the code (or use --device cpu).")
+    cfg.NUM_GPUS = 1
+    weights = args.weights or cfg.TEST.WEIGHTS
+    assert_and_infer_cfg()
+    logger.info('Testing with config:')
+    logger.info(pprint.pformat(cfg))
+
+    args.cuda = cfg.DEVICE == 'cuda'
+    _, ext = os.path.splitext(weights)
+    if ext == '.pth':
+        args.load_detectron = ''
+        args.load_ckpt = weights
+    elif ext == '.pkl':
+        args.load_detectron = weights
+        args.load_ckpt = ''
+    else:
+        raise KeyError('Unknown Model Type: {}'.format(ext))
+    model = initialize_model_from_cfg(args)
+
+    capture = cv2.VideoCapture(int(args.video) if args.video.isdigit() else args.video)
+    if not capture.isOpened():
+        sys.exit('Cannot open the video {}'.format(args.video))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.
+    writer = None
+
+    detector = VideoDetector(model)
+    timer = Timer()
+    for i, im in enumerate(read_frames(capture, args.max_frames)):
+        timer.tic()
+        (cls_boxes, cls_segms, cls_keyps, cls_parsings, cls_uvs), _ = detector.detect(im)
+        timer.toc()
+
+        if args.output:
+            if writer is None:
+                writer = cv2.VideoWriter(
+                    args.output, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                    (im.shape[1], im.shape[0]))
+            writer.write(vis_utils.vis_one_image_opencv(
+                im, cls_boxes, segms=cls_segms, keypoints=cls_keyps,
+                parsing=cls_parsings, uv=cls_uvs))
+
+        if (i + 1) % args.log_every == 0:
+            logger.info('Frame {:d}: {:.1f} fps, {:d} keyframes, interval {:d}, change {:.2f}'.format(
+                i + 1, 1. / timer.average_time, detector.num_keyframes,
+                detector.interval, detector.change))
+
+    capture.release()
+    if writer is not None:
+        writer.release()
+    if detector.frame_idx > 0:
+        logger.info('{:d} frames ({:d} keyframes) in {:.1f}s: {:.1f} fps'.format(
+            detector.frame_idx, detector.num_keyframes, timer.total_time,
+            1. / timer.average_time))
+    for k, v in detector.timers.items():
+        logger.info(' | {}: {:.3f}s'.format(k, v.average_time))